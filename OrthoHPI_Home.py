@@ -1,8 +1,8 @@
-import utils
 import web_utils
+import instrumentation
 import streamlit as st
-import pandas as pd
 import plotly.express as px
+import plotly.graph_objects as go
 import holoviews as hv
 from css import style
 from holoviews import opts, dim
@@ -10,6 +10,7 @@ hv.extension('bokeh')
 from streamlit_bokeh import streamlit_bokeh
 
 st.set_page_config(layout="wide", page_title="OrthoHPI 2.0", menu_items={})
+instrumentation.start_rerun('home')
 st.session_state.sidebar_state = 'collapsed'
 style.load_css()
 
@@ -24,13 +25,8 @@ elif page == "About":
         
 
 # Read dataset
-config = utils.read_config('config.yml')
-predictions = utils.read_parquet_file(input_file='data/predictions.parquet')
-predictions['weight'] = predictions['weight'].astype(float)
-tissues = utils.read_parquet_file(input_file='data/tissues_cell_types.parquet')
-pred_tissues = pd.merge(predictions, tissues.rename({'Gene': 'target'}, axis=1), on='target', how='left')
-tissues = None
-ontology = utils.read_parquet_file(input_file='data/go_ontology.parquet')
+with instrumentation.span('home.load_summaries'):
+    home_summaries = web_utils.load_home_summaries()
 
 #Initialize variables
 df_select = None
@@ -41,54 +37,15 @@ enrichment_table = None
 enrichment = None
 
 
-def filter_tissues(config, df):
-    tissue_df = []
-    mapped_tissues = config['tissues']
-    for ident in df['taxid1'].unique():
-        tissues = [mapped_tissues[t].lower() for t in config['parasites'][int(ident)]['tissues']]
-        aux = df[(df['taxid1']==ident) & (df['Tissue'].isin(tissues))]
-        tissue_df.append(aux)
-    
-    tissue_df = pd.concat(tissue_df)
-    
-    return tissue_df
-
-
-@st.cache_data
-def generate_tissue_cell_type_box(df, config):
-    aux = df.copy()
-    aux['Cell type'] = aux['Cell type'].fillna("Not available")
-    aux = filter_tissues(config, aux)
-    counts_tissues = aux.groupby(['taxid1', 'Tissue']).count()['taxid2'].reset_index()
-    counts_tissues = counts_tissues.rename({'taxid2':'edges_tissue'}, axis=1)
-    counts_cells = aux.groupby(['taxid1', 'Tissue', 'Cell type']).count()['taxid2'].reset_index()
-    counts_cells = counts_cells.rename({'taxid2':'edges_cell_type'}, axis=1)
-    aux = pd.merge(aux, counts_tissues, on=['taxid1', 'Tissue'], how='left')
-    aux = pd.merge(aux, counts_cells, on=['taxid1', 'Tissue', 'Cell type'], how='left')
-    fig = px.icicle(aux, path=[px.Constant("Parasites"), 'taxid1_label', 'Tissue', 'Cell type'], values='edges_cell_type',
+def generate_tissue_cell_type_box(counts):
+    fig = px.icicle(counts, path=[px.Constant("Parasites"), 'taxid1_label', 'Tissue', 'Cell type'], values='edges_cell_type_sum',
                   color='edges_cell_type', hover_data=['edges_tissue', 'edges_cell_type', 'taxid1', 'taxid1_label', 'pTPM'],
                   color_continuous_scale='Burgyl', height=900, width=1200, maxdepth=-1)
 
     return fig
 
-def generate_circos_plot(df_pred):
-    nodes = set()
-    links = []
-    seen = set()
-    i = 0
-    for g1, df1 in df_pred.groupby('taxid1_label'):
-        j = i + 1
-        for g2, df2 in df_pred.groupby('taxid1_label'):
-            if g1 != g2 and (g1, g2) not in seen:
-                nodes.update([(i, g1[0]+'. '+g1.split(' ')[1]), (j, g2[0]+'. '+g2.split(' ')[1])])
-                links.append((i, j, len(set(df1['target'].tolist()).intersection(df2['target'].tolist()))))
-                seen.update([(g1, g2), (g2, g1)])
-                
-                j += 1
-        i += 1
-
-    links = pd.DataFrame(links, columns=['source', 'target', 'value'])
-    nodes = hv.Dataset(pd.DataFrame(list(nodes), columns = ['index', 'name']), 'index')
+def generate_circos_plot(links, nodes):
+    nodes = hv.Dataset(nodes, 'index')
 
     chord = hv.Chord((links, nodes)).select(value=(1, None))
     chord.opts(
@@ -97,14 +54,22 @@ def generate_circos_plot(df_pred):
 
     return chord
 
-def generate_boxplot_score_stats(df):
-    fig = px.box(df.sort_values("taxid1"), x="taxid1_label", y="weight", color='taxid1', labels={"weight":"score", "taxid1_label": "parasites"})
-    fig.update_traces(showlegend=False)
+def generate_boxplot_score_stats(scores):
+    fig = go.Figure()
+    colors = px.colors.qualitative.Plotly
+    for i, row in enumerate(scores.sort_values("taxid1").itertuples(index=False)):
+        color = colors[i % len(colors)]
+        fig.add_trace(go.Box(x=[row.taxid1_label], q1=[row.q1], median=[row.median], q3=[row.q3], lowerfence=[row.lowerfence],
+                             upperfence=[row.upperfence], name=row.taxid1, marker_color=color, showlegend=False))
+        if len(row.outliers) > 0:
+            fig.add_trace(go.Scatter(x=[row.taxid1_label] * len(row.outliers), y=list(row.outliers), mode='markers',
+                                     marker_color=color, name=row.taxid1, showlegend=False))
+    fig.update_layout(xaxis_title="parasites", yaxis_title="score")
 
     return fig
 
-def generate_barplot_stats(df):
-    fig = px.bar(df.groupby(["taxid1_label"]).count().reset_index().sort_values("taxid2"), x="taxid1_label", y="weight", color='taxid1_label',  labels={"weight":"count", "taxid1_label": "parasites"})
+def generate_barplot_stats(scores):
+    fig = px.bar(scores.sort_values("edges", kind="stable"), x="taxid1_label", y="edges", color='taxid1_label',  labels={"edges":"count", "taxid1_label": "parasites"})
     fig.update_traces(showlegend=False)
     return fig
 
@@ -131,30 +96,32 @@ st.markdown("---")
 chart1, chart2 = st.columns(2)
 
 
-with chart1:
+with chart1, instrumentation.span('home.circos'):
     st.subheader("Circos Plot of Common Host Interactors")
-    circos_plot = generate_circos_plot(predictions)
+    circos_plot = generate_circos_plot(home_summaries['shared_links'], home_summaries['shared_nodes'])
     streamlit_bokeh(hv.render(circos_plot), use_container_width=True)
 
-stats_figs = generate_stats_plots(predictions)
-predictions = None
-stats_cols = st.columns(len(stats_figs))
-i = 0
-for stats_fig, title in stats_figs:
-    with stats_cols[i]:
-        st.subheader(title)
-        st.plotly_chart(stats_fig, use_container_width=True)
-    i += 1
-
-fig = generate_tissue_cell_type_box(pred_tissues, config)
-with chart2:
+with instrumentation.span('home.score_stats'):
+    stats_figs = generate_stats_plots(home_summaries['parasite_scores'])
+    stats_cols = st.columns(len(stats_figs))
+    i = 0
+    for stats_fig, title in stats_figs:
+        with stats_cols[i]:
+            st.subheader(title)
+            st.plotly_chart(stats_fig, use_container_width=True)
+        i += 1
+
+with instrumentation.span('home.tissue_cell_types'):
+    fig = generate_tissue_cell_type_box(home_summaries['tissue_cell_types'])
+with chart2, instrumentation.span('home.tissue_cell_types_chart'):
     st.subheader("Summary of Interactions per Tissue and Cell type")
     st.plotly_chart(fig, use_container_width=True)
-    pred_tissues = None
 
 st.markdown("---")
 
 
 # Footer
 with st.container():
-    web_utils.footer()
\ No newline at end of file
+    web_utils.footer()
+
+web_utils.show_diagnostics()
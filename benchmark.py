@@ -0,0 +1,597 @@
+import os
+import gc
+import sys
+import json
+import time
+import gzip
+import shutil
+import zipfile
+import argparse
+import platform
+import subprocess
+import tracemalloc
+import numpy as np
+import pandas as pd
+import yaml
+import bundles
+import centrality
+import downloader
+import enrichment
+import enrichment_store
+import filters
+import go
+import go_store
+import homology
+import hpa
+import main
+import utils
+
+FIXTURE_VERSION = 1
+FIXTURE_URL = 'https://fixtures.invalid/'
+HOST_TAXID = 9606
+# number of elements generated at each scale (large is close to the size of the real STRING, eggNOG, jensenlab and HPA files)
+SCALES = {'small': {'parasites': 3, 'host_proteins': 2000, 'parasite_proteins': 1000, 'groups': 1500, 'group_links': 20000,
+                    'aliases': 10, 'tissue_rows': 10, 'hpa_rows': 20, 'go_terms': 2000, 'go_annotations': 8},
+          'medium': {'parasites': 6, 'host_proteins': 8000, 'parasite_proteins': 4000, 'groups': 6000, 'group_links': 150000,
+                     'aliases': 40, 'tissue_rows': 40, 'hpa_rows': 80, 'go_terms': 10000, 'go_annotations': 15},
+          'large': {'parasites': 12, 'host_proteins': 20000, 'parasite_proteins': 8000, 'groups': 20000, 'group_links': 600000,
+                    'aliases': 120, 'tissue_rows': 150, 'hpa_rows': 300, 'go_terms': 45000, 'go_annotations': 25}}
+STAGES = ['get_eggnog_groups', 'get_links', 'get_tissues', 'parse_string_aliases', 'read_cell_types', 'read_obo',
+          'read_go_annotations', 'calculate_enrichment', 'read_enrichment', 'generate_graph']
+CELL_TYPES = ['enterocytes', 'paneth cells', 'goblet cells', 'hepatocytes', 'kupffer cells', 'macrophages', 'T-cells',
+              'B-cells', 'fibroblasts', 'endothelial cells', 'smooth muscle cells', 'keratinocytes', 'melanocytes',
+              'alveolar cells type 1', 'alveolar cells type 2', 'cardiomyocytes', 'neutrophils', 'monocytes']
+ALIAS_SOURCES = ['Ensembl_gene', 'BLAST_UniProt_AC', 'Ensembl_HGNC_UniProt_ID(supplied_by_UniProt)', 'Ensembl_protein',
+                 'Ensembl_transcript', 'BioMart_HUGO', 'Ensembl_EntrezGene', 'BLAST_KEGG_NAME', 'Ensembl_RefSeq']
+
+
+def get_species(sizes):
+    """
+    Synthetic species of a benchmark: the human host and a number of parasites with STRING-like protein identifiers
+    :param dict sizes: number of elements generated (see SCALES)
+    :return: dictionary. Key -> taxid, value -> array of protein identifiers
+    """
+    species = {HOST_TAXID: np.array(['{}.ENSP{:011d}'.format(HOST_TAXID, i) for i in range(sizes['host_proteins'])], dtype=object)}
+    for p in range(sizes['parasites']):
+        taxid = 100001 + p
+        species[taxid] = np.array(['{}.XP_{:09d}.1'.format(taxid, i) for i in range(sizes['parasite_proteins'])], dtype=object)
+
+    return species
+
+
+def get_protein_names(proteins):
+    """
+    Synthetic preferred names of the proteins of a species
+    :param ndarray proteins: protein identifiers
+    :return: array of names
+    """
+    return np.char.add('GENE', np.arange(len(proteins)).astype(str)).astype(object)
+
+
+def get_gene_ids(proteins):
+    """
+    Synthetic Ensembl gene identifiers of the host proteins (same number as the protein identifier)
+    :param ndarray proteins: protein identifiers
+    :return: array of gene identifiers
+    """
+    return np.array([p.split('.')[1].replace('ENSP', 'ENSG') for p in proteins], dtype=object)
+
+
+def get_config(sizes, tissues):
+    """
+    Configuration of a benchmark: the urls point to the fixture files (never downloaded, they are registered in the manifest)
+    :param dict sizes: number of elements generated (see SCALES)
+    :param dict tissues: tissues section of the configuration file (BTO identifier -> tissue name)
+    :return: dictionary with the content of the configuration file
+    """
+    bto_ids = sorted(tissues)
+    config = {'urls': {'string_protein_url': FIXTURE_URL + 'TAXID.protein.info.v11.5.txt.gz',
+                       'string_COG_url': FIXTURE_URL + 'COG.links.detailed.v11.5.txt.gz',
+                       'string_alias_url': FIXTURE_URL + 'TAXID.protein.aliases.v11.5.txt.gz',
+                       'eggNOG_members_url': FIXTURE_URL + '2759_members.tsv.gz',
+                       'go_ontology_url': FIXTURE_URL + 'go.obo',
+                       'hpa_single_cell_tissue_url': FIXTURE_URL + 'rna_single_cell_type_tissue.tsv.zip'},
+              'pipeline': {'download_workers': 1, 'workers': 1},
+              'web': {'centrality_exact_max_nodes': 2000, 'centrality_pivots': 200, 'centrality_cache_size': 128},
+              'hosts': {HOST_TAXID: {'label': 'Homo sapiens', 'color': '#525252',
+                                     'tissues_url': FIXTURE_URL + 'human_tissue_experiments_full.tsv',
+                                     'compartments_url': FIXTURE_URL + 'human_compartment_integrated_full.tsv'}},
+              'tissues': dict(tissues),
+              'parasites': {}}
+    for p, taxid in enumerate(t for t in get_species(sizes) if t != HOST_TAXID):
+        config['parasites'][taxid] = {'label': 'Parasite {}'.format(p + 1), 'color': '#{:06x}'.format((p * 2654435761) % 0xFFFFFF),
+                                      'tissues': [bto_ids[(p + i) % len(bto_ids)] for i in range(1 + p % 3)]}
+
+    return config
+
+
+def write_protein_info(data_dir, taxid, proteins):
+    """
+    STRING protein info file (TAXID.protein.info.v11.5.txt.gz)
+    :param str data_dir: path to the fixtures data directory
+    :param int taxid: taxonomic identifier of the species
+    :param ndarray proteins: protein identifiers
+    """
+    df = pd.DataFrame({'#string_protein_id': proteins, 'preferred_name': get_protein_names(proteins),
+                       'protein_size': 100 + np.arange(len(proteins)) % 900, 'annotation': 'Synthetic protein'})
+    df.to_csv(os.path.join(data_dir, '{}.protein.info.v11.5.txt.gz'.format(taxid)), sep='\t', index=False)
+
+
+def write_aliases(data_dir, taxid, proteins, n_aliases, rng):
+    """
+    STRING aliases file (TAXID.protein.aliases.v11.5.txt.gz) with n_aliases aliases per protein from different sources
+    :param str data_dir: path to the fixtures data directory
+    :param int taxid: taxonomic identifier of the species
+    :param ndarray proteins: protein identifiers
+    :param int n_aliases: number of aliases per protein
+    :param rng: numpy random generator
+    """
+    n = len(proteins)
+    alias_proteins = np.repeat(proteins, n_aliases)
+    sources = np.array(ALIAS_SOURCES, dtype=object)[np.tile(np.arange(n_aliases) % len(ALIAS_SOURCES), n)]
+    aliases = np.char.add('ALIAS', rng.integers(0, 10 * n * n_aliases, size=n * n_aliases).astype(str)).astype(object)
+    # the sources used by the pipeline have the identifiers it expects (Ensembl genes, UniProt accessions)
+    genes = np.repeat(get_gene_ids(proteins) if taxid == HOST_TAXID else proteins, n_aliases)
+    is_gene = sources == 'Ensembl_gene'
+    aliases[is_gene] = genes[is_gene]
+    is_uniprot = np.isin(sources, ALIAS_SOURCES[1:3])
+    aliases[is_uniprot] = np.char.add('P', np.repeat(np.arange(n), n_aliases)[is_uniprot].astype(str))
+    df = pd.DataFrame({'#string_protein_id': alias_proteins, 'alias': aliases, 'source': sources})
+    df.to_csv(os.path.join(data_dir, '{}.protein.aliases.v11.5.txt.gz'.format(taxid)), sep='\t', index=False)
+
+
+def write_members(data_dir, species, n_groups, rng):
+    """
+    eggNOG members file (2759_members.tsv.gz). Every protein belongs to a group and a third of the host
+    proteins to a second one, group sizes are skewed as in eggNOG
+    :param str data_dir: path to the fixtures data directory
+    :param dict species: synthetic species (see get_species)
+    :param int n_groups: number of groups
+    :param rng: numpy random generator
+    :return: array with the group names
+    """
+    group_names = np.array(['KOG{:05d}'.format(i) if i % 2 == 0 else 'ENOG50{:05d}'.format(i) for i in range(n_groups)], dtype=object)
+    weights = 1.0 / (np.arange(n_groups) + 10.0)
+    weights /= weights.sum()
+    members = []
+    for taxid, proteins in species.items():
+        extra = proteins[rng.random(len(proteins)) < 0.33] if taxid == HOST_TAXID else proteins[:0]
+        proteins = np.concatenate([proteins, extra])
+        members.append(pd.DataFrame({'group': rng.choice(n_groups, size=len(proteins), p=weights), 'protein': proteins,
+                                     'taxid': str(taxid)}))
+    members = pd.concat(members, ignore_index=True).drop_duplicates(subset=['group', 'protein'])
+    members = members.groupby('group', sort=True).agg(proteins=('protein', ','.join), n_proteins=('protein', 'size'),
+                                                      species=('taxid', lambda t: ','.join(pd.unique(t))),
+                                                      n_species=('taxid', 'nunique'))
+    with gzip.open(os.path.join(data_dir, '2759_members.tsv.gz'), 'wt') as out:
+        out.write('#taxonomic_level\tgroup\tn_proteins\tn_species\tproteins\tspecies\n')
+        for group, row in zip(group_names[members.index.values], members.itertuples(index=False)):
+            out.write('2759\t{}\t{}\t{}\t{}\t{}\n'.format(group, row.n_proteins, row.n_species, row.proteins, row.species))
+
+    return group_names
+
+
+def write_group_links(data_dir, group_names, n_links, rng):
+    """
+    STRING links between eggNOG groups (COG.links.detailed.v11.5.txt.gz), around half of them with
+    experimental or database scores above the cutoff used by the pipeline
+    :param str data_dir: path to the fixtures data directory
+    :param ndarray group_names: group names
+    :param int n_links: number of links
+    :param rng: numpy random generator
+    """
+    group1 = rng.integers(0, len(group_names), size=n_links)
+    group2 = rng.integers(0, len(group_names), size=n_links)
+    scores = {col: np.zeros(n_links, dtype=np.int32) for col in ['neighborhood', 'fusion', 'cooccurence', 'coexpression']}
+    scores['experimental'] = np.where(rng.random(n_links) < 0.4, rng.integers(600, 1000, size=n_links), rng.integers(0, 600, size=n_links))
+    scores['database'] = np.where(rng.random(n_links) < 0.2, rng.integers(700, 1000, size=n_links), 0)
+    scores['textmining'] = rng.integers(0, 1000, size=n_links)
+    scores['combined_score'] = np.maximum(scores['experimental'], scores['database'])
+    df = pd.DataFrame({'group1': group_names[group1], 'group2': group_names[group2]})
+    for col, values in scores.items():
+        df[col] = values
+    df.to_csv(os.path.join(data_dir, 'COG.links.detailed.v11.5.txt.gz'), sep=' ', index=False)
+
+
+def write_jensenlab_files(data_dir, proteins, tissues, n_rows, rng):
+    """
+    jensenlab tissues and compartments files (human_tissue_experiments_full.tsv and human_compartment_integrated_full.tsv)
+    with n_rows annotations per host protein, a fraction of them to the tissues and compartments in the configuration
+    :param str data_dir: path to the fixtures data directory
+    :param ndarray proteins: host protein identifiers
+    :param dict tissues: tissues section of the configuration file (BTO identifier -> tissue name)
+    :param int n_rows: number of annotations per protein
+    :param rng: numpy random generator
+    """
+    n = len(proteins) * n_rows
+    ensp = np.repeat(np.array([p.split('.', 1)[1] for p in proteins], dtype=object), n_rows)
+    names = np.repeat(get_protein_names(proteins), n_rows)
+    bto_ids = np.array(sorted(tissues) + ['BTO:{:07d}'.format(i) for i in range(3000, 3000 + 4 * len(tissues))], dtype=object)
+    terms = rng.integers(0, len(bto_ids), size=n)
+    df = pd.DataFrame({'protein': ensp, 'name': names, 'term': bto_ids[terms], 'tissue': 'tissue',
+                       'source': 'UniProtKB-RC', 'evidence': 'NA', 'score': np.round(rng.uniform(0, 5, size=n), 3)})
+    with open(os.path.join(data_dir, 'human_tissue_experiments_full.tsv'), 'w') as out:
+        out.write('#synthetic jensenlab tissues file\n')
+        df.to_csv(out, sep='\t', index=False, header=False)
+
+    go_ids = np.array(['GO:0005886'] + ['GO:{:07d}'.format(i) for i in range(5000, 5040)], dtype=object)
+    df = pd.DataFrame({'protein': ensp, 'name': names, 'term': go_ids[rng.integers(0, len(go_ids), size=n)],
+                       'compartment': 'compartment', 'score': np.round(rng.uniform(0, 5, size=n), 3)})
+    with open(os.path.join(data_dir, 'human_compartment_integrated_full.tsv'), 'w') as out:
+        out.write('#synthetic jensenlab compartments file\n')
+        df.to_csv(out, sep='\t', index=False, header=False)
+
+
+def write_hpa_archive(data_dir, proteins, tissues, n_rows, rng):
+    """
+    HPA single cell type tissue archive (rna_single_cell_type_tissue.tsv.zip) with n_rows clusters per host gene,
+    a third of them without expression
+    :param str data_dir: path to the fixtures data directory
+    :param ndarray proteins: host protein identifiers
+    :param dict tissues: tissues section of the configuration file (BTO identifier -> tissue name)
+    :param int n_rows: number of rows per gene
+    :param rng: numpy random generator
+    """
+    n = len(proteins) * n_rows
+    tissue_names = np.array(sorted(set(tissues.values())) + sorted(hpa.TISSUES_MAPPING) + ['testis', 'pancreas', 'adipose tissue'], dtype=object)
+    tissue = rng.integers(0, len(tissue_names), size=n)
+    cluster = rng.integers(0, 20, size=n)
+    df = pd.DataFrame({'Gene': np.repeat(get_gene_ids(proteins), n_rows), 'Gene name': np.repeat(get_protein_names(proteins), n_rows),
+                       'Tissue': tissue_names[tissue], 'Cluster': np.char.add('c-', cluster.astype(str)),
+                       'Cell type': np.array(CELL_TYPES, dtype=object)[(tissue * 7 + cluster) % len(CELL_TYPES)],
+                       'Read count': rng.integers(0, 5000, size=n),
+                       'pTPM': np.where(rng.random(n) < 0.33, 0.0, np.round(rng.lognormal(2, 1.5, size=n), 1))})
+    with zipfile.ZipFile(os.path.join(data_dir, 'rna_single_cell_type_tissue.tsv.zip'), 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('rna_single_cell_type_tissue.tsv', df.to_csv(sep='\t', index=False))
+
+
+def get_term_names(n_terms):
+    """
+    Names of the synthetic GO terms
+    :param int n_terms: number of terms
+    :return: array of names
+    """
+    return np.array(['synthetic process {}'.format(i) for i in range(n_terms)], dtype=object)
+
+
+def write_obo(data_dir, n_terms, rng):
+    """
+    GO ontology file (go.obo): a DAG with three roots, one or two is_a parents per term, part_of
+    relationships and some obsolete terms
+    :param str data_dir: path to the fixtures data directory
+    :param int n_terms: number of terms
+    :param rng: numpy random generator
+    """
+    names = get_term_names(n_terms)
+    namespaces = ['biological_process', 'molecular_function', 'cellular_component']
+    n_obsolete = n_terms // 50
+    with open(os.path.join(data_dir, 'go.obo'), 'w') as out:
+        out.write('format-version: 1.2\ndata-version: releases/synthetic\nontology: go\n\n')
+        for i in range(n_terms):
+            out.write('[Term]\nid: GO:{:07d}\nname: {}\nnamespace: {}\n'.format(i, names[i], namespaces[i % 3]))
+            if i >= n_terms - n_obsolete:
+                out.write('is_obsolete: true\n\n')
+                continue
+            if i >= 3:
+                # parents are earlier terms of the same namespace, so the hierarchy has no cycles
+                for parent in sorted(set(rng.integers(0, (i - i % 3) // 3, size=1 + int(rng.random() < 0.3)) * 3 + i % 3)):
+                    out.write('is_a: GO:{:07d} ! {}\n'.format(parent, names[parent]))
+                if rng.random() < 0.1:
+                    parent = int(rng.integers(0, i))
+                    out.write('relationship: part_of GO:{:07d} ! {}\n'.format(parent, names[parent]))
+            out.write('\n')
+        out.write('[Typedef]\nid: part_of\nname: part of\nis_transitive: true\n')
+
+
+def get_go_annotations(species, n_terms, n_annotations, rng):
+    """
+    GO annotations of the synthetic proteins (as in gos.parquet), skewed so term sizes cover the range tested
+    :param dict species: synthetic species (see get_species)
+    :param int n_terms: number of terms
+    :param int n_annotations: number of annotations per protein
+    :param rng: numpy random generator
+    :return: dataframe with columns #string_protein_id, description and taxid
+    """
+    weights = 1.0 / (np.arange(n_terms) + 20.0)
+    weights /= weights.sum()
+    names = get_term_names(n_terms)
+    annotations = []
+    for taxid, proteins in species.items():
+        annotations.append(pd.DataFrame({'#string_protein_id': np.repeat(proteins, n_annotations),
+                                         'description': names[rng.choice(n_terms, size=len(proteins) * n_annotations, p=weights)],
+                                         'taxid': taxid}))
+
+    return pd.concat(annotations, ignore_index=True).drop_duplicates(subset=['#string_protein_id', 'description'])
+
+
+def register_fixtures(data_dir, config):
+    """
+    Records the fixture files in the download manifest so the pipeline takes them as downloaded (no network access)
+    :param str data_dir: path to the fixtures data directory
+    :param dict config: content of the configuration file
+    """
+    urls = {url.split('/')[-1]: url for url in config['urls'].values()}
+    for filename in sorted(os.listdir(data_dir)):
+        filepath = os.path.join(data_dir, filename)
+        if filename == downloader.MANIFEST_FILE or not os.path.isfile(filepath):
+            continue
+        url = urls.get(filename, FIXTURE_URL + filename)
+        downloader.update_manifest(data_dir, filename, {'url': url, 'size': os.path.getsize(filepath), 'etag': None,
+                                                        'last_modified': None, 'sha256': downloader.sha256sum(filepath),
+                                                        'mtime': os.path.getmtime(filepath)})
+
+
+def generate_fixtures(fixture_dir, sizes, tissues, seed=42):
+    """
+    Writes the synthetic inputs of a benchmark (reused if they were generated with the same sizes and seed):
+        config.yml: configuration pointing to the fixture files
+        data/: STRING protein info and aliases per species, eggNOG members, COG links, jensenlab tissues and
+                compartments, HPA single cell archive and GO ontology, all registered in the download manifest
+
+    :param str fixture_dir: path to the fixtures directory
+    :param dict sizes: number of elements generated (see SCALES)
+    :param dict tissues: tissues section of the configuration file (BTO identifier -> tissue name)
+    :param int seed: random seed (fixtures are reproducible)
+    :return: path to the configuration file
+    """
+    config_file = os.path.join(fixture_dir, 'config.yml')
+    info_file = os.path.join(fixture_dir, 'fixtures.json')
+    info = {'version': FIXTURE_VERSION, 'sizes': sizes, 'seed': seed, 'tissues': tissues}
+    if os.path.isfile(info_file) and os.path.isfile(config_file):
+        with open(info_file, 'r') as f:
+            if json.load(f) == info:
+                return config_file
+
+    start = time.time()
+    if os.path.isdir(fixture_dir):
+        shutil.rmtree(fixture_dir)
+    data_dir = os.path.join(fixture_dir, 'data')
+    os.makedirs(data_dir)
+    rng = np.random.default_rng(seed)
+    species = get_species(sizes)
+    config = get_config(sizes, tissues)
+    for taxid, proteins in species.items():
+        write_protein_info(data_dir, taxid, proteins)
+        write_aliases(data_dir, taxid, proteins, sizes['aliases'], rng)
+    group_names = write_members(data_dir, species, sizes['groups'], rng)
+    write_group_links(data_dir, group_names, sizes['group_links'], rng)
+    write_jensenlab_files(data_dir, species[HOST_TAXID], tissues, sizes['tissue_rows'], rng)
+    write_hpa_archive(data_dir, species[HOST_TAXID], tissues, sizes['hpa_rows'], rng)
+    write_obo(data_dir, sizes['go_terms'], rng)
+    get_go_annotations(species, sizes['go_terms'], sizes['go_annotations'], rng).to_parquet(os.path.join(fixture_dir, 'gos.parquet'), index=False)
+    register_fixtures(data_dir, config)
+    with open(config_file, 'w') as out:
+        yaml.safe_dump(config, out, sort_keys=False)
+    with open(info_file, 'w') as out:
+        out.write(json.dumps(info))
+    print("Generated fixtures in {} ({:.1f} s)".format(fixture_dir, time.time() - start))
+
+    return config_file
+
+
+def remove_paths(paths):
+    """
+    Removes cached outputs so each measure starts cold
+    :param list paths: files or directories
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.isfile(path):
+            os.remove(path)
+
+
+def get_stages(fixture_dir, config_file):
+    """
+    Benchmarked stages of the pipeline and the web app, run on the fixtures (from the fixtures directory).
+    The inputs of each stage are prepared once with the real upstream stages (not measured).
+
+    :param str fixture_dir: path to the fixtures directory
+    :param str config_file: path to the configuration file
+    :return: list of (name, setup, run) tuples, setup removes the caches of the stage
+    """
+    config = utils.read_config(filepath=config_file)
+    data_dir = 'data'
+    members_file = os.path.join(data_dir, '2759_members.tsv.gz')
+    links_file = os.path.join(data_dir, 'COG.links.detailed.v11.5.txt.gz')
+    tissues_file = os.path.join(data_dir, 'human_tissue_experiments_full.tsv')
+    predictions_file = os.path.join(fixture_dir, 'predictions.parquet')
+    proteins = {}
+    for taxid in list(config['hosts']) + list(config['parasites']):
+        proteins.update(main.parse_proteins(string_file=config['urls']['string_protein_url'], taxid=taxid))
+    host_proteins = {p: n for p, n in proteins.items() if p.startswith('{}.'.format(HOST_TAXID))}
+
+    valid_groups = homology.get_eggnog_groups(filepath=members_file, proteins=list(proteins.keys()))
+    homology.get_links(filepath=links_file, valid_groups=valid_groups, proteins=proteins, ouput_filepath=predictions_file,
+                       config_file=config_file)
+    predictions = pd.read_parquet(predictions_file)
+    predictions['weight'] = predictions['weight'].astype(float)
+    # network of the parasite with most predictions, sorted by weight as in its bundle
+    network = predictions[predictions['taxid1'] == predictions['taxid1'].value_counts().index[0]] if len(predictions) > 0 else predictions
+    network = network.sort_values(by='weight', ascending=False, kind='stable').reset_index(drop=True)
+    go_df = pd.read_parquet(os.path.join(fixture_dir, 'gos.parquet'))
+    term_index = enrichment.build_term_index(go_df)
+    go_dir = os.path.join(fixture_dir, 'go_annotations')
+    go_store.build_store([df for _, df in go_df.groupby('taxid', sort=False)], go_dir)
+    go_df = None
+    # enrichment of the network precomputed by the pipeline (only at the benchmarked score)
+    network_taxid = network['taxid1'].iloc[0] if len(network) > 0 else 0
+    bundle_dir = os.path.join(fixture_dir, 'parasite_bundles')
+    bundle_file = bundles.get_bundle_path(bundle_dir, network_taxid)
+    os.makedirs(os.path.dirname(bundle_file), exist_ok=True)
+    network.to_parquet(bundle_file, index=False)
+    enrichment_dir = os.path.join(fixture_dir, 'enrichment')
+    enrichment_store.build_enrichment_store(bundle_dir, go_dir, enrichment_dir, scores=[0.5])
+    valid_tissues = filters.get_valid_tissues(config['parasites'])
+    index_dir = homology.get_index_dir(members_file)
+
+    stages = [('get_eggnog_groups', lambda: remove_paths([index_dir]),
+               lambda: homology.get_eggnog_groups(filepath=members_file, proteins=list(proteins.keys()))),
+              ('get_links', lambda: remove_paths([predictions_file]),
+               lambda: homology.get_links(filepath=links_file, valid_groups=valid_groups, proteins=proteins,
+                                          ouput_filepath=predictions_file, config_file=config_file)),
+              ('get_tissues', lambda: remove_paths([os.path.join(data_dir, 'filters')]),
+               lambda: filters.get_tissues(tissues_file, host_proteins, cutoff=2.5, mapping=config['tissues'], valid_tissues=valid_tissues)),
+              ('parse_string_aliases', lambda: remove_paths([os.path.join(data_dir, 'aliases')]),
+               lambda: utils.parse_string_aliases(config_file=config_file, sources=['Ensembl_gene'], taxid=str(HOST_TAXID))),
+              ('read_cell_types', lambda: remove_paths([os.path.join(data_dir, 'hpa')]),
+               lambda: hpa.read_cell_types(config_file)),
+              ('read_obo', lambda: None, lambda: go.read_obo(os.path.join(data_dir, 'go.obo'))),
+              ('read_go_annotations', lambda: None,
+               lambda: enrichment.build_term_index(go_store.read_annotations(go_dir, [HOST_TAXID, int(network_taxid)]))),
+              ('calculate_enrichment', lambda: None, lambda: utils.calculate_enrichment(network, term_index=term_index)),
+              ('read_enrichment', lambda: None, lambda: enrichment_store.read_enrichment(enrichment_dir, network_taxid, 0.5)),
+              ('generate_graph', lambda: centrality._cache.clear(),
+               lambda: centrality.generate_graph(bundles.slice_by_score(network, 0.5), ('benchmark',), settings=config['web']))]
+
+    return stages
+
+
+def measure(setup, run, repeat=3):
+    """
+    Wall time of a stage (repeat runs, each one after its setup) and peak memory allocated by Python
+    and numpy during an extra run (tracemalloc slows the code down, so it is not used while timing)
+
+    :param function setup: function run before each measure (not measured)
+    :param function run: function measured
+    :param int repeat: number of timed runs
+    :return: dictionary with the seconds of each run, the best one and the peak memory (MB)
+    """
+    seconds = []
+    for _ in range(repeat):
+        setup()
+        gc.collect()
+        start = time.perf_counter()
+        run()
+        seconds.append(round(time.perf_counter() - start, 4))
+    setup()
+    gc.collect()
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {'seconds': seconds, 'best': min(seconds), 'peak_mb': round(peak / 1024 ** 2, 2)}
+
+
+def get_commit():
+    """
+    Commit of the code benchmarked (marked as dirty if there are uncommitted changes)
+    :return: short hash or 'unknown' outside a git repository
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=root, capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=root, capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+    return commit + ('-dirty' if status.strip() else '')
+
+
+def run_benchmark(config_file, scales, output_dir, repeat=3, stages=None, seed=42):
+    """
+    Runs the benchmark at each scale: generates (or reuses) the fixtures and measures every stage on them.
+    Stages run from the fixtures directory, so their downloads and caches never touch the real data directory.
+
+    :param str config_file: path to the configuration file (its tissues are used in the fixtures)
+    :param list scales: names of the scales (see SCALES)
+    :param str output_dir: path to the directory where the fixtures are generated
+    :param int repeat: number of timed runs of each stage
+    :param list stages: names of the stages measured (default: all)
+    :param int seed: random seed of the fixtures
+    :return: dictionary with the results (JSON serializable)
+    """
+    tissues = utils.read_config(filepath=config_file, field='tissues')
+    results = {'commit': get_commit(), 'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+               'platform': platform.platform(), 'processor': platform.processor(), 'cpus': os.cpu_count(),
+               'pandas': pd.__version__, 'numpy': np.__version__, 'repeat': repeat, 'seed': seed, 'scales': {}}
+    cwd = os.getcwd()
+    for scale in scales:
+        fixture_dir = os.path.abspath(os.path.join(output_dir, 'fixtures', scale))
+        fixture_config = generate_fixtures(fixture_dir, SCALES[scale], tissues, seed=seed)
+        results['scales'][scale] = {'sizes': SCALES[scale], 'stages': {}}
+        os.chdir(fixture_dir)
+        try:
+            for name, setup, run in get_stages(fixture_dir, fixture_config):
+                if stages is not None and name not in stages:
+                    continue
+                result = measure(setup, run, repeat=repeat)
+                results['scales'][scale]['stages'][name] = result
+                print("{:<8} {:<22} {:>9.3f} s {:>10.1f} MB".format(scale, name, result['best'], result['peak_mb']))
+        finally:
+            os.chdir(cwd)
+
+    return results
+
+
+def save_results(results, results_file):
+    """
+    Stores the results of a benchmark as JSON
+    :param dict results: results of run_benchmark
+    :param str results_file: path to the results file
+    """
+    os.makedirs(os.path.dirname(results_file) or '.', exist_ok=True)
+    with open(results_file, 'w') as out:
+        out.write(json.dumps(results, indent=2))
+
+
+def compare(baseline_file, results_file, tolerance=0.2):
+    """
+    Compares the results of two benchmarks (i.e. two commits) stage by stage
+
+    :param str baseline_file: path to the results of the reference commit
+    :param str results_file: path to the results of the commit evaluated
+    :param float tolerance: relative increase of time or memory above which a stage is reported as a regression
+    :return: list of (scale, stage, metric, ratio) regressions
+    """
+    with open(baseline_file, 'r') as f:
+        baseline = json.load(f)
+    with open(results_file, 'r') as f:
+        results = json.load(f)
+    regressions = []
+    print("{} -> {}".format(baseline['commit'], results['commit']))
+    for scale, scale_results in results['scales'].items():
+        if scale not in baseline['scales']:
+            continue
+        if scale_results['sizes'] != baseline['scales'][scale]['sizes']:
+            print("{}: fixtures of different sizes, skipped".format(scale))
+            continue
+        for name, result in scale_results['stages'].items():
+            reference = baseline['scales'][scale]['stages'].get(name)
+            if reference is None:
+                continue
+            ratios = {metric: result[metric] / reference[metric] if reference[metric] > 0 else 1.0 for metric in ['best', 'peak_mb']}
+            flags = [metric for metric, ratio in ratios.items() if ratio > 1 + tolerance]
+            regressions.extend((scale, name, metric, ratios[metric]) for metric in flags)
+            print("{:<8} {:<22} {:>9.3f} s -> {:>9.3f} s ({:>5.2f}x) {:>10.1f} MB -> {:>10.1f} MB ({:>5.2f}x){}".format(
+                scale, name, reference['best'], result['best'], ratios['best'], reference['peak_mb'], result['peak_mb'],
+                ratios['peak_mb'], '  REGRESSION' if flags else ''))
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline benchmark of the OrthoHPI pipeline and web app on synthetic data')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run', help='measure the stages and store the results as JSON')
+    run_parser.add_argument('--config', default='config.yml', help='configuration file (its tissues are used in the fixtures)')
+    run_parser.add_argument('--scales', nargs='+', default=['small', 'medium'], choices=list(SCALES))
+    run_parser.add_argument('--stages', nargs='+', default=None, choices=STAGES)
+    run_parser.add_argument('--repeat', type=int, default=3)
+    run_parser.add_argument('--seed', type=int, default=42)
+    run_parser.add_argument('--dir', default=os.path.join('data', 'benchmarks'), help='directory of the fixtures and results')
+    run_parser.add_argument('--output', default=None, help='results file (default: <dir>/<commit>.json)')
+    compare_parser = subparsers.add_parser('compare', help='compare the results of two commits')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('results')
+    compare_parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        results = run_benchmark(args.config, args.scales, args.dir, repeat=args.repeat, stages=args.stages, seed=args.seed)
+        results_file = args.output or os.path.join(args.dir, '{}.json'.format(results['commit']))
+        save_results(results, results_file)
+        print("Results stored in {}".format(results_file))
+    else:
+        sys.exit(1 if compare(args.baseline, args.results, tolerance=args.tolerance) else 0)
@@ -0,0 +1,155 @@
+import os
+import numpy as np
+import pandas as pd
+import prediction_store
+import utils
+
+# thresholds of the confidence score slider of the web app (0.4 to 0.9, step 0.01)
+SCORE_GRID = np.round(np.arange(0.4, 0.9 + 1e-9, 0.01), 2)
+
+
+def get_parasite_tissues(config, taxid):
+    """
+    Tissues relevant in the lifecycle of a parasite (as named in the tissues_cell_types annotation)
+    :param dict config: content of the configuration file
+    :param int taxid: taxonomic identifier of the parasite
+    :return: list of tissue names
+    """
+    mapped_tissues = config['tissues']
+
+    return [mapped_tissues[t].lower() for t in config['parasites'][int(taxid)]['tissues']]
+
+
+def encode_categories(df, max_ratio=0.5):
+    """
+    Converts the string columns with many repeated values into categorical columns
+    :param DataFrame df: dataframe to encode
+    :param float max_ratio: maximum ratio of unique values to rows for a column to be encoded
+    :return: encoded dataframe
+    """
+    for col in df.columns:
+        if df[col].dtype == object or pd.api.types.is_string_dtype(df[col]):
+            if df[col].nunique() <= max_ratio * len(df):
+                df[col] = df[col].astype('category')
+
+    return df
+
+
+def get_bundle_path(bundle_dir, taxid):
+    """
+    Path to the partition of a parasite in the bundles dataset
+    :param str bundle_dir: path to the bundles dataset
+    :param int taxid: taxonomic identifier of the parasite
+    :return: path to the partition file
+    """
+    return os.path.join(bundle_dir, 'taxid1={}'.format(taxid), 'part-0.parquet')
+
+
+def build_parasite_bundles(config_file, store_dir, tissues_file, output_dir):
+    """
+    Precomputes the data shown in the web pages for each parasite: predictions (read from the prediction
+    store, so the scores are floats) joined with the tissue and cell type annotation, filtered to the tissues
+    relevant for the parasite, with categorical columns and sorted by weight. Writes a dataset partitioned by taxid1
+    (i.e. data/parasite_bundles/taxid1=5833/part-0.parquet) to a temporary directory that is moved into place once complete.
+
+    :param str config_file: path to the configuration file
+    :param str store_dir: path to the prediction store
+    :param str tissues_file: path to the tissues and cell types annotation file
+    :param str output_dir: path to the bundles dataset
+    """
+    config = utils.read_config(config_file)
+    predictions = prediction_store.read_predictions(store_dir)
+    tissues = utils.read_parquet_file(input_file=tissues_file)
+    pred_tissues = pd.merge(predictions, tissues.rename({'Gene': 'target'}, axis=1), on='target', how='left')
+    predictions = None
+    tissues = None
+
+    tmp_dir = utils.get_tmp_path(output_dir)
+    os.makedirs(tmp_dir)
+    for taxid, df in pred_tissues.groupby('taxid1', observed=True):
+        df = df[df['Tissue'].isin(get_parasite_tissues(config, taxid))]
+        df = df.sort_values(by='weight', ascending=False, kind='stable').reset_index(drop=True)
+        # the categories of the store cover all the parasites
+        for col in df.columns:
+            if isinstance(df[col].dtype, pd.CategoricalDtype):
+                df[col] = df[col].cat.remove_unused_categories()
+        df = encode_categories(df)
+        df['taxid1'] = df['taxid1'].astype(str)
+        filepath = get_bundle_path(tmp_dir, taxid)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        df.to_parquet(filepath, index=False)
+    utils.replace_dir(tmp_dir, output_dir)
+
+
+def read_parasite_bundle(bundle_dir, taxid):
+    """
+    Reads the partition of a parasite from the bundles dataset
+    :param str bundle_dir: path to the bundles dataset
+    :param int taxid: taxonomic identifier of the parasite
+    :return: dataframe with the parasite predictions and their tissue and cell type annotation
+    """
+    df = pd.read_parquet(get_bundle_path(bundle_dir, taxid))
+
+    return df
+
+
+def get_bundle_taxids(bundle_dir):
+    """
+    Lists the parasites available in the bundles dataset
+    :param str bundle_dir: path to the bundles dataset
+    :return: list of taxonomic identifiers
+    """
+    taxids = []
+    if os.path.isdir(bundle_dir):
+        for name in os.listdir(bundle_dir):
+            if name.startswith('taxid1='):
+                taxids.append(int(name.split('=')[1]))
+
+    return sorted(taxids)
+
+
+def get_score_offset(weights, score):
+    """
+    Number of predictions with a weight above or equal to a score (binary search)
+    :param ndarray weights: weights of the predictions sorted in descending order (as in the bundles)
+    :param float score: minimum weight
+    :return: offset of the first prediction below the score
+    """
+    lo = 0
+    hi = len(weights)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if weights[mid] >= score:
+            lo = mid + 1
+        else:
+            hi = mid
+
+    return lo
+
+
+def get_score_index(weights, scores=SCORE_GRID):
+    """
+    Offset index of the score thresholds: position of the first prediction below each score
+    :param ndarray weights: weights of the predictions sorted in descending order (as in the bundles)
+    :param ndarray scores: score thresholds indexed
+    :return: dictionary. Key -> score, value -> offset
+    """
+    return {float(score): get_score_offset(weights, score) for score in scores}
+
+
+def slice_by_score(df, score, index=None):
+    """
+    Predictions with a weight above or equal to a score. As the predictions are sorted by weight, they are
+    the first rows, so the result is a slice (no copy) found with the offset index or a binary search.
+    Filtering the rows (i.e. by tissue) keeps the order, but the index of the whole bundle no longer applies.
+
+    :param DataFrame df: predictions sorted by weight in descending order
+    :param float score: minimum weight
+    :param dict index: offset index of the rows of df (see get_score_index)
+    :return: dataframe
+    """
+    offset = index.get(score) if index is not None else None
+    if offset is None:
+        offset = get_score_offset(df['weight'].values, score)
+
+    return df.iloc[:offset]
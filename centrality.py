@@ -0,0 +1,150 @@
+import threading
+from collections import OrderedDict
+import networkx as nx
+import pandas as pd
+import bundles
+import utils
+import instrumentation
+
+# process-wide cache of node centralities. Key -> (parasite, score, tissues, cell types, data version), value -> centrality
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+
+@instrumentation.timed()
+def compute_centrality(G, exact_max_nodes=2000, pivots=200, seed=42):
+    """
+    Betweenness centrality of the nodes of a network. Exact for small networks and approximated
+    by sampling k pivot nodes when the network has more than exact_max_nodes nodes
+
+    :param graph G: networkx graph
+    :param int exact_max_nodes: maximum number of nodes for which the exact centrality is computed
+    :param int pivots: number of pivot nodes sampled in the approximation
+    :param int seed: random seed used to sample the pivots (results are reproducible)
+    :return: dictionary with the centrality of each node
+    """
+    if G.number_of_nodes() > exact_max_nodes:
+        return nx.betweenness_centrality(G, k=min(pivots, G.number_of_nodes()), weight='weight', seed=seed)
+
+    return nx.betweenness_centrality(G, weight='weight')
+
+
+def get_centrality(G, key, settings=None, precomputed=None):
+    """
+    Node centrality of a network, cached by the filters that generated it
+
+    :param graph G: networkx graph
+    :param tuple key: (parasite, score, tissues, cell types, data version) used to cache the result
+    :param dict settings: centrality settings (web section of the configuration): centrality_exact_max_nodes,
+                            centrality_pivots and centrality_cache_size
+    :param dict precomputed: centralities computed by the pipeline for this network (used if available)
+    :return: dictionary with the centrality of each node
+    """
+    if settings is None:
+        settings = {}
+    if precomputed is not None and set(precomputed.keys()) >= set(G.nodes()):
+        return precomputed
+
+    with _lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+
+    centrality = compute_centrality(G, exact_max_nodes=settings.get('centrality_exact_max_nodes', 2000),
+                                    pivots=settings.get('centrality_pivots', 200))
+    with _lock:
+        _cache[key] = centrality
+        while len(_cache) > settings.get('centrality_cache_size', 128):
+            _cache.popitem(last=False)
+
+    return centrality
+
+
+@instrumentation.timed()
+def generate_graph(df, centrality_key, settings=None, precomputed=None):
+    """
+    Network shown in the web app: nodes colored, labeled, shaped and sized by their centrality.
+    All the predictions given are built as edges, so they must be already filtered by score (see bundles.slice_by_score).
+
+    :param DataFrame df: predictions of the network (wide format) above the score threshold
+    :param tuple centrality_key: (parasite, score, tissues, cell types, data version) used to cache the centrality
+    :param dict settings: centrality settings (web section of the configuration)
+    :param dict precomputed: centralities computed by the pipeline for this network (used if available)
+    :return: networkx graph
+    """
+    G = nx.from_pandas_edgelist(df, 'source', 'target', 'weight')
+    colors = dict(df[['source', 'source_color']].drop_duplicates().values)
+    colors.update(dict(df[['target', 'target_color']].drop_duplicates().values))
+    nx.set_node_attributes(G, colors, 'color')
+    labels = dict(df[['source', 'source_name']].drop_duplicates().values)
+    labels.update(dict(df[['target', 'target_name']].drop_duplicates().values))
+    nx.set_node_attributes(G, labels, 'label')
+    shapes = dict(df[['source', 'source_shape']].drop_duplicates().values)
+    shapes.update(dict(df[['target', 'target_shape']].drop_duplicates().values))
+    nx.set_node_attributes(G, shapes, 'shape')
+    centrality = get_centrality(G, centrality_key, settings=settings, precomputed=precomputed)
+    max_centrality = max(centrality.values(), default=0)
+    sizes = {}
+    for k,v in centrality.items():
+        value = v*60/max_centrality if max_centrality > 0 else 0
+        if value < 20:
+            value = 20
+        sizes[k] =  value
+    nx.set_node_attributes(G, sizes, 'size')
+
+    widths = {}
+    for n1,n2,w in df[['source', 'target', 'weight']].values:
+        value = w*0.5/0.9
+        if value < 0.05:
+            value = 0.05
+        widths[(n1, n2)] = value
+    nx.set_edge_attributes(G, widths, 'value')
+    nx.set_edge_attributes(G, '#999999', 'color')
+
+
+    return G
+
+
+@instrumentation.timed()
+def precompute_centralities(config_file, bundle_dir, output_file, scores=bundles.SCORE_GRID):
+    """
+    Computes the centrality of the nodes in the network of each parasite (all tissues and cell types) at each
+    score threshold of the slider, so the web app does not need to compute them. The network of a threshold is
+    the one shown (the predictions above it, see bundles.slice_by_score), identified by its number of predictions
+    (offset): thresholds that select the same predictions share their centralities.
+
+    :param str config_file: path to the configuration file
+    :param str bundle_dir: path to the per-parasite bundles dataset
+    :param str output_file: path to the output file (columns: taxid1, offset, node, centrality)
+    :param list scores: score thresholds precomputed
+    """
+    settings = utils.read_config(filepath=config_file, field='web') or {}
+    centralities = []
+    for taxid in bundles.get_bundle_taxids(bundle_dir):
+        df = bundles.read_parasite_bundle(bundle_dir, taxid)
+        offsets = sorted(set(bundles.get_score_offset(df['weight'].values, score) for score in scores))
+        for offset in offsets:
+            G = nx.from_pandas_edgelist(df.iloc[:offset], 'source', 'target', 'weight')
+            centrality = compute_centrality(G, exact_max_nodes=settings.get('centrality_exact_max_nodes', 2000),
+                                            pivots=settings.get('centrality_pivots', 200))
+            centralities.append(pd.DataFrame({'taxid1': taxid, 'offset': offset, 'node': list(centrality.keys()),
+                                              'centrality': list(centrality.values())}))
+        instrumentation.add_rows(len(offsets))
+
+    centralities = pd.concat(centralities) if centralities else pd.DataFrame(columns=['taxid1', 'offset', 'node', 'centrality'])
+    utils.save_to_parquet(centralities, output_file)
+
+
+def read_precomputed(centralities_df, taxid, offset):
+    """
+    Centralities precomputed by the pipeline for the network of a parasite at a score threshold
+    :param DataFrame centralities_df: precomputed centralities (columns: taxid1, offset, node, centrality)
+    :param int taxid: taxonomic identifier of the parasite
+    :param int offset: number of predictions in the network (see bundles.get_score_offset)
+    :return: dictionary with the centrality of each node or None if it was not precomputed
+    """
+    df = centralities_df[(centralities_df['taxid1'] == int(taxid)) & (centralities_df['offset'] == int(offset))]
+    if df.empty:
+        return None
+
+    return dict(zip(df['node'], df['centrality']))
@@ -0,0 +1,180 @@
+import os
+import threading
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+import utils
+import instrumentation
+
+CACHE_DIR = '.cache'
+
+# process-wide cache shared by all the sessions of the web app. Key -> (kind, filepath, columns), value -> dictionary with mtime and object
+_cache = {}
+_lock = threading.RLock()
+# one lock per cache key, held while the object is loaded. Key -> (kind, filepath, columns), value -> lock
+_key_locks = {}
+
+
+def get_mtime(filepath):
+    """
+    Modification time of a file (used to invalidate the cached datasets)
+    :param str filepath: path to the file
+    :return: modification time in nanoseconds
+    """
+    return os.stat(filepath).st_mtime_ns
+
+
+def get_object(filepath, loader, kind='object', columns=None):
+    """
+    Loads an object from a file once per process and returns the same object until the file changes
+    :param str filepath: path to the file
+    :param callable loader: function that loads the file (receives the filepath)
+    :param str kind: type of object cached (used in the cache key)
+    :param tuple columns: columns loaded (used in the cache key)
+    :return: the loaded object
+    """
+    key = (kind, filepath, columns)
+    mtime = get_mtime(filepath)
+    with _lock:
+        entry = _cache.get(key)
+        if entry is not None and entry['mtime'] == mtime:
+            return entry['object']
+        key_lock = _key_locks.setdefault(key, threading.RLock())
+    # only the sessions that need the same object wait for it to be loaded
+    with key_lock:
+        with _lock:
+            entry = _cache.get(key)
+        if entry is None or entry['mtime'] != mtime:
+            entry = {'mtime': mtime, 'object': loader(filepath)}
+            with _lock:
+                _cache[key] = entry
+
+    return entry['object']
+
+
+def get_feather_path(filepath, mtime):
+    """
+    Path to the uncompressed Arrow (feather) copy of a parquet file that can be memory-mapped
+    :param str filepath: path to the parquet file
+    :param int mtime: modification time of the parquet file
+    :return: path to the feather file
+    """
+    name = os.path.basename(filepath).split('.')[0]
+    cache_dir = os.path.join(os.path.dirname(filepath), CACHE_DIR)
+
+    return os.path.join(cache_dir, '{}.{}.arrow'.format(name, mtime))
+
+
+def read_mapped_table(filepath):
+    """
+    Reads a parquet file as a memory-mapped Arrow table. The file is converted once into an uncompressed
+    Arrow file next to it (.cache directory) that is mapped instead of read, so the data is shared through
+    the OS page cache and the table buffers are not copied into the process memory.
+
+    :param str filepath: path to the parquet file
+    :return: Arrow table
+    """
+    if not filepath.endswith('.parquet'):
+        return feather.read_table(filepath, memory_map=True)
+    mtime = get_mtime(filepath)
+    feather_path = get_feather_path(filepath, mtime)
+    if not os.path.isfile(feather_path):
+        os.makedirs(os.path.dirname(feather_path), exist_ok=True)
+        prefix = os.path.basename(feather_path).rsplit('.', 2)[0] + '.'
+        # the web app may run several processes: one converts the file, the others wait for it
+        with utils.file_lock(os.path.join(os.path.dirname(feather_path), prefix.rstrip('.'))):
+            if not os.path.isfile(feather_path):
+                for old in os.listdir(os.path.dirname(feather_path)):
+                    if old.startswith(prefix) and old.endswith('.arrow'):
+                        os.remove(os.path.join(os.path.dirname(feather_path), old))
+                tmp_path = utils.get_tmp_path(feather_path)
+                feather.write_feather(pq.read_table(filepath), tmp_path, compression='uncompressed')
+                os.replace(tmp_path, feather_path)
+
+    return feather.read_table(feather_path, memory_map=True)
+
+
+def get_table(filepath, columns=None):
+    """
+    Read-only Arrow table of a dataset, loaded once per process (memory-mapped)
+    :param str filepath: path to the parquet or feather file
+    :param list columns: columns to select (optional)
+    :return: Arrow table
+    """
+    table = get_object(filepath, read_mapped_table, kind='table')
+    if columns is not None:
+        table = table.select(columns)
+
+    return table
+
+
+def get_frame(filepath, columns=None):
+    """
+    Pandas dataframe of a dataset, loaded once per process and shared by all sessions.
+    Numeric and categorical columns are views over the memory-mapped Arrow buffers. The dataframe
+    must be treated as read-only: filter or copy it instead of modifying it in place.
+
+    :param str filepath: path to the parquet or feather file
+    :param list columns: columns to select (optional)
+    :return: dataframe
+    """
+    columns = tuple(columns) if columns is not None else None
+
+    def loader(path):
+        table = get_table(path, columns=list(columns) if columns is not None else None)
+        return table.to_pandas(split_blocks=True)
+
+    return get_object(filepath, loader, kind='frame', columns=columns)
+
+
+def get_config(filepath='config.yml', field=None):
+    """
+    Content of the configuration file, read once per process
+    :param str filepath: path to configuration file
+    :param str field: field to be obtained from the configuration
+    :return: dictionary with the content of the configuration or the field specified
+    """
+    content = get_object(filepath, utils.read_config, kind='config')
+    if field is not None and content is not None and field in content:
+        return content[field]
+
+    return content
+
+
+def get_process_memory():
+    """
+    Memory used by the current process
+    :return: dictionary with the resident set size and its peak (bytes)
+    """
+    return instrumentation.get_process_memory()
+
+
+def memory_usage():
+    """
+    Memory used by the datasets cached in this process
+    :return: list of dictionaries with the dataset, rows, size of the Arrow table (memory-mapped) and
+                of the pandas dataframe (process memory), plus a total entry with the process memory
+    """
+    stats = []
+    with _lock:
+        entries = list(_cache.items())
+    for (kind, filepath, columns), entry in entries:
+        obj = entry['object']
+        if kind == 'table':
+            stats.append({'dataset': filepath, 'kind': kind, 'rows': obj.num_rows, 'bytes': obj.nbytes, 'mapped': True})
+        elif kind == 'frame':
+            stats.append({'dataset': filepath, 'kind': kind, 'rows': len(obj),
+                          'bytes': int(obj.memory_usage(deep=True).sum()), 'mapped': False})
+    process = get_process_memory()
+    stats.append({'dataset': 'process', 'kind': 'total', 'rows': None, 'bytes': process['rss'],
+                  'peak_bytes': process['peak_rss'], 'arrow_allocated_bytes': pa.total_allocated_bytes()})
+
+    return stats
+
+
+def clear():
+    """
+    Removes all the cached datasets of this process
+    """
+    with _lock:
+        _cache.clear()
@@ -0,0 +1,290 @@
+import os
+import json
+import fcntl
+import hashlib
+import threading
+import contextlib
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+HEADER = {'user-agent':'Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/51.0.2704.103 Safari/537.36'}
+MANIFEST_FILE = 'manifest.json'
+CHUNK_SIZE = 1024 * 1024
+
+_manifest_lock = threading.Lock()
+
+
+def read_manifest(data_dir):
+    """
+    Reads the download manifest of a data directory
+    :param str data_dir: path to the data directory
+    :return: dictionary with the manifest entries. Key -> filename, value -> url, size, etag, last_modified, sha256
+    """
+    manifest_path = os.path.join(data_dir, MANIFEST_FILE)
+    manifest = {}
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+
+    return manifest
+
+
+@contextlib.contextmanager
+def manifest_lock(data_dir):
+    """
+    Holds an exclusive lock on the manifest of a data directory, shared by the threads of this process
+    and by other processes (a lock file next to the manifest)
+    :param str data_dir: path to the data directory
+    """
+    with _manifest_lock:
+        with open(os.path.join(data_dir, MANIFEST_FILE + '.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def update_manifest(data_dir, filename, entry):
+    """
+    Adds or replaces the entry of a downloaded file in the manifest. The manifest is read and written
+    under a file lock and replaced atomically, so concurrent downloads (threads or processes) keep every entry.
+    :param str data_dir: path to the data directory
+    :param str filename: name of the downloaded file
+    :param dict entry: url, size, etag, last_modified and sha256 of the file
+    """
+    with manifest_lock(data_dir):
+        manifest = read_manifest(data_dir)
+        manifest[filename] = entry
+        tmp_path = os.path.join(data_dir, MANIFEST_FILE + '.{}.{}.tmp'.format(os.getpid(), threading.get_ident()))
+        with open(tmp_path, 'w') as out:
+            out.write(json.dumps(manifest, indent=2, sort_keys=True))
+        os.replace(tmp_path, os.path.join(data_dir, MANIFEST_FILE))
+
+
+def sha256sum(filepath):
+    """
+    Computes the sha256 checksum of a file
+    :param str filepath: path to the file
+    :return: hexadecimal digest
+    """
+    sha = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha.update(block)
+
+    return sha.hexdigest()
+
+
+def checksum(filepath):
+    """
+    Returns the sha256 checksum of a file, using the manifest entry when the file is unchanged since it was downloaded
+    :param str filepath: path to the file
+    :return: hexadecimal digest
+    """
+    data_dir, filename = os.path.split(filepath)
+    entry = read_manifest(data_dir).get(filename)
+    if entry is not None and entry.get('size') == os.path.getsize(filepath) and entry.get('mtime') == os.path.getmtime(filepath):
+        return entry['sha256']
+
+    return sha256sum(filepath)
+
+
+def file_key(filepath):
+    """
+    Identifies the content of a file without reading it, to key caches of data derived from it: the sha256
+    of the manifest entry when the file is unchanged since it was downloaded, otherwise its size and modification time
+    :param str filepath: path to the file
+    :return: string key
+    """
+    data_dir, filename = os.path.split(filepath)
+    entry = read_manifest(data_dir).get(filename)
+    stat = os.stat(filepath)
+    if entry is not None and entry.get('size') == stat.st_size and entry.get('mtime') == stat.st_mtime:
+        return entry['sha256']
+
+    return '{}:{}'.format(stat.st_size, stat.st_mtime_ns)
+
+
+def is_complete(filepath, entry):
+    """
+    Checks whether a file on disk corresponds to the manifest entry of a complete download
+    :param str filepath: path to the file
+    :param dict entry: manifest entry
+    :return: bool
+    """
+    return entry is not None and os.path.isfile(filepath) and os.path.getsize(filepath) == entry['size']
+
+
+def remote_size(url, session):
+    """
+    Asks the server for the size of a file without downloading it
+    :param str url: URL address of the file
+    :param session: requests session
+    :return: size in bytes or None if it is not available
+    """
+    try:
+        r = session.head(url, allow_redirects=True, timeout=30)
+        if r.ok and 'Content-Length' in r.headers:
+            return int(r.headers['Content-Length'])
+    except requests.RequestException:
+        pass
+
+    return None
+
+
+def get_session():
+    """
+    Requests session used for the downloads (sends the user-agent of HEADER with every request)
+    :return: requests session
+    """
+    session = requests.Session()
+    session.headers.update(HEADER)
+
+    return session
+
+
+def get_range_size(response):
+    """
+    Size of the remote file reported in the Content-Range header of a range response (i.e. 'bytes */1234')
+    :param response: requests response
+    :return: size in bytes or None if it is not available
+    """
+    content_range = response.headers.get('Content-Range', '')
+    size = content_range.split('/')[-1]
+    if content_range.startswith('bytes') and size.isdigit():
+        return int(size)
+
+    return None
+
+
+def publish_download(url, filepath, size, etag, last_modified, digest):
+    """
+    Moves a complete '.part' file into place and records it in the manifest
+    :param str url: URL address of the file
+    :param str filepath: path to the downloaded file
+    :param int size: size of the file in bytes
+    :param str etag: ETag of the file (None if the server did not send it)
+    :param str last_modified: Last-Modified header of the file
+    :param str digest: sha256 checksum of the file
+    """
+    part_path = filepath + '.part'
+    os.replace(part_path, filepath)
+    if os.path.isfile(part_path + '.json'):
+        os.remove(part_path + '.json')
+    data_dir, filename = os.path.split(filepath)
+    update_manifest(data_dir, filename, {'url': url, 'size': size, 'etag': etag, 'last_modified': last_modified,
+                                         'sha256': digest, 'mtime': os.path.getmtime(filepath)})
+
+
+def download(url, data_dir='data', session=None, chunk_size=CHUNK_SIZE):
+    """
+    Downloads a file streaming it into a temporary '.part' file that is renamed once complete, so
+    interrupted downloads are never taken as complete. A previous partial download is resumed with an
+    HTTP range request when the server supports it. Size, ETag and sha256 are recorded in the manifest.
+
+    :param str url: URL address where to download the data from
+    :param str data_dir: path to directory where to download the data
+    :param session: requests session (optional, see get_session)
+    :param int chunk_size: number of bytes written at once
+    :return: filepath to the downloaded data
+    """
+    if session is None:
+        session = get_session()
+    filename = url.split('/')[-1]
+    filepath = os.path.join(data_dir, filename)
+    entry = read_manifest(data_dir).get(filename)
+    if is_complete(filepath, entry):
+        return filepath
+
+    if entry is None and os.path.isfile(filepath):
+        # file downloaded before the manifest existed, keep it if it is complete
+        size = remote_size(url, session)
+        if size is None or size == os.path.getsize(filepath):
+            update_manifest(data_dir, filename, {'url': url, 'size': os.path.getsize(filepath), 'etag': None,
+                                                 'last_modified': None, 'sha256': sha256sum(filepath),
+                                                 'mtime': os.path.getmtime(filepath)})
+            return filepath
+
+    part_path = filepath + '.part'
+    part_info_path = part_path + '.json'
+    headers = {}
+    offset = 0
+    part_info = {}
+    sha = hashlib.sha256()
+    if os.path.isfile(part_path) and os.path.isfile(part_info_path):
+        with open(part_info_path, 'r') as f:
+            part_info = json.load(f)
+        if part_info.get('url') == url:
+            offset = os.path.getsize(part_path)
+            headers['Range'] = 'bytes={}-'.format(offset)
+            if part_info.get('etag') is not None:
+                headers['If-Range'] = part_info['etag']
+
+    with session.get(url, headers=headers, stream=True, timeout=60) as r:
+        if r.status_code == 416:
+            # the range starts at the end of the file: the partial download may already be complete
+            size = get_range_size(r)
+            if size is None:
+                size = remote_size(url, session)
+            if offset > 0 and size == offset:
+                publish_download(url, filepath, offset, part_info.get('etag'), r.headers.get('Last-Modified'), sha256sum(part_path))
+                return filepath
+            # the range is not valid anymore, start again
+            os.remove(part_path)
+            return download(url, data_dir=data_dir, session=session, chunk_size=chunk_size)
+        r.raise_for_status()
+        if r.status_code != 206:
+            offset = 0
+        etag = r.headers.get('ETag')
+        with open(part_info_path, 'w') as out:
+            out.write(json.dumps({'url': url, 'etag': etag}))
+        mode = 'ab' if offset > 0 else 'wb'
+        if offset > 0:
+            with open(part_path, 'rb') as f:
+                for block in iter(lambda: f.read(chunk_size), b''):
+                    sha.update(block)
+        with open(part_path, mode) as out:
+            for block in r.iter_content(chunk_size=chunk_size):
+                out.write(block)
+                sha.update(block)
+
+        size = os.path.getsize(part_path)
+        expected = r.headers.get('Content-Length')
+        if expected is not None and r.headers.get('Content-Encoding') is None and size != offset + int(expected):
+            raise IOError("Incomplete download of {}: {} of {} bytes".format(url, size, offset + int(expected)))
+
+    publish_download(url, filepath, size, etag, r.headers.get('Last-Modified'), sha.hexdigest())
+
+    return filepath
+
+
+def download_all(urls, data_dir='data', workers=4):
+    """
+    Downloads a list of files concurrently with a bounded pool of threads
+    :param list urls: URL addresses where to download the data from
+    :param str data_dir: path to directory where to download the data
+    :param int workers: maximum number of simultaneous downloads
+    :return: dictionary with the downloaded files. Key -> url, value -> filepath
+    """
+    files = {}
+    errors = {}
+    session = get_session()
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(download, url, data_dir, session): url for url in dict.fromkeys(urls)}
+        for future in as_completed(futures):
+            url = futures[future]
+            try:
+                files[url] = future.result()
+            except Exception as err:
+                errors[url] = err
+
+    if len(errors) > 0:
+        raise IOError("The following files could not be downloaded: {}".format(
+                        ', '.join('{} ({})'.format(url, err) for url, err in errors.items())))
+
+    return files
@@ -0,0 +1,197 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.stats import hypergeom
+from statsmodels.stats.multitest import multipletests
+
+
+def build_term_index(go_df):
+    """
+    Builds a protein x term incidence index from a GO annotation dataframe. The index only
+    depends on the annotations of the species of interest, so it can be built once per taxid set
+    and reused for every network that is tested against it.
+
+    :param DataFrame go_df: GO annotations with columns '#string_protein_id' and 'description'
+    :return: dictionary with the encoded proteins and terms, the sparse term x protein incidence matrix,
+                the number of annotations per term and a term --> annotation rows index
+    """
+    term_codes, terms = pd.factorize(go_df['description'])
+    protein_codes, proteins = pd.factorize(go_df['#string_protein_id'])
+    # duplicated annotations are summed up so counts match the number of rows per term
+    incidence = sparse.csr_matrix((np.ones(len(term_codes), dtype=np.int64), (term_codes, protein_codes)),
+                                  shape=(len(terms), len(proteins)))
+    order = np.argsort(term_codes, kind='stable')
+    offsets = np.searchsorted(term_codes[order], np.arange(len(terms) + 1))
+
+    return {'terms': np.asarray(terms, dtype=object),
+            'proteins': np.asarray(proteins, dtype=object),
+            'protein_lookup': pd.Index(proteins),
+            'term_codes': term_codes,
+            'protein_codes': protein_codes,
+            'incidence': incidence,
+            'term_size': np.asarray(incidence.sum(axis=1)).ravel(),
+            'row_order': order,
+            'row_offsets': offsets}
+
+
+def _binary_search(pmf, d, lo, hi):
+    """
+    Vectorized version of the binary search scipy uses to find the other tail of the
+    hypergeometric distribution in the two-sided Fisher's exact test.
+
+    :param callable pmf: function returning the probability of each position for the searched tables
+    :param array d: value to search for each table
+    :param array lo: lower end of the range to search
+    :param array hi: higher end of the range to search
+    :return: array with the index i between lo and hi such that pmf(i) <= d < pmf(i+1)
+    """
+    lo = lo.copy()
+    hi = hi.copy()
+    found = np.full(len(lo), -1, dtype=np.int64)
+    active = lo < hi
+    while active.any():
+        idx = np.flatnonzero(active)
+        mid = lo[idx] + (hi[idx] - lo[idx]) // 2
+        midval = pmf(mid, idx)
+        lower = midval < d[idx]
+        higher = midval > d[idx]
+        equal = ~(lower | higher)
+        lo[idx[lower]] = mid[lower] + 1
+        hi[idx[higher]] = mid[higher] - 1
+        found[idx[equal]] = mid[equal]
+        active[idx[equal]] = False
+        active &= lo < hi
+
+    pending = np.flatnonzero(found < 0)
+    if len(pending) > 0:
+        ends = lo[pending]
+        found[pending] = np.where(pmf(ends, pending) <= d[pending], ends, ends - 1)
+
+    return found
+
+
+def fisher_exact(a, b, c, d):
+    """
+    Two-sided Fisher's exact test over many 2x2 contingency tables [[a, b], [c, d]] at once.
+    Follows the same algorithm as scipy.stats.fisher_exact so the results are identical.
+
+    :param array a: counts of the first cell of every table
+    :param array b: counts of the second cell of every table
+    :param array c: counts of the third cell of every table
+    :param array d: counts of the fourth cell of every table
+    :return: tuple with the arrays of odds ratios and p-values
+    """
+    a, b, c, d = [np.asarray(x, dtype=np.int64) for x in (a, b, c, d)]
+    if np.any(a < 0) or np.any(b < 0) or np.any(c < 0) or np.any(d < 0):
+        raise ValueError("All values in `table` must be nonnegative.")
+
+    odds_ratio = np.full(len(a), np.inf)
+    p_value = np.ones(len(a))
+    degenerate = (a + b == 0) | (c + d == 0) | (a + c == 0) | (b + d == 0)
+    odds_ratio[degenerate] = np.nan
+    with np.errstate(divide='ignore', invalid='ignore'):
+        finite = ~degenerate & (c > 0) & (b > 0)
+        odds_ratio[finite] = a[finite] * d[finite] / (c[finite] * b[finite])
+
+    n1 = a + b
+    n2 = c + d
+    n = a + c
+    total = n1 + n2
+
+    def pmf(x, idx):
+        return hypergeom.pmf(x, total[idx], n1[idx], n[idx])
+
+    todo = np.flatnonzero(~degenerate)
+    mode = ((n[todo] + 1) * (n1[todo] + 1) // (total[todo] + 2)).astype(np.int64)
+    pexact = pmf(a[todo], todo)
+    pmode = pmf(mode, todo)
+    epsilon = 1e-14
+    gamma = 1 + epsilon
+    with np.errstate(divide='ignore', invalid='ignore'):
+        at_mode = np.abs(pexact - pmode) / np.maximum(pexact, pmode) <= epsilon
+
+    lower = ~at_mode & (a[todo] < mode)
+    if lower.any():
+        idx = todo[lower]
+        plower = hypergeom.cdf(a[idx], total[idx], n1[idx], n[idx])
+        one_tail = pmf(n[idx], idx) > pexact[lower] * gamma
+        pvalues = plower.copy()
+        search = np.flatnonzero(~one_tail)
+        if len(search) > 0:
+            sidx = idx[search]
+            guess = _binary_search(lambda x, i: -pmf(x, sidx[i]), -pexact[lower][search] * gamma,
+                                   mode[lower][search], n[sidx])
+            pvalues[search] = plower[search] + hypergeom.sf(guess, total[sidx], n1[sidx], n[sidx])
+        p_value[idx] = pvalues
+
+    upper = ~at_mode & ~lower
+    if upper.any():
+        idx = todo[upper]
+        pupper = hypergeom.sf(a[idx] - 1, total[idx], n1[idx], n[idx])
+        one_tail = pmf(np.zeros(len(idx), dtype=np.int64), idx) > pexact[upper] * gamma
+        pvalues = pupper.copy()
+        search = np.flatnonzero(~one_tail)
+        if len(search) > 0:
+            sidx = idx[search]
+            guess = _binary_search(lambda x, i: pmf(x, sidx[i]), pexact[upper][search] * gamma,
+                                   np.zeros(len(sidx), dtype=np.int64), mode[upper][search])
+            pvalues[search] = pupper[search] + hypergeom.cdf(guess, total[sidx], n1[sidx], n[sidx])
+        p_value[idx] = pvalues
+
+    p_value = np.minimum(p_value, 1.0)
+
+    return odds_ratio, p_value
+
+
+def calculate_enrichment(nodes, term_index, min_size=10, max_size=500):
+    """
+    Tests all the GO terms annotated in a network at once using the precomputed term index
+
+    :param list nodes: network nodes (STRING protein identifiers)
+    :param dict term_index: index generated with build_term_index for the species in the network
+    :param int min_size: terms need more than min_size network members to be tested
+    :param int max_size: terms need less than max_size network members to be tested
+    :return: dataframe with columns go_term, A, B, C, D, p_value, odds_ratio, nodes, fdr_bh. Terms whose contingency
+                table has a negative count (networks with more nodes than annotated proteins) are not tested
+    """
+    cols = ['go_term', 'A', 'B', 'C', 'D', 'p_value', 'odds_ratio', 'nodes']
+    total_nodes = len(nodes)
+    total_prots = len(term_index['proteins'])
+    node_codes = term_index['protein_lookup'].get_indexer(pd.unique(np.asarray(nodes, dtype=object)))
+    in_network = np.zeros(total_prots, dtype=np.int64)
+    in_network[node_codes[node_codes >= 0]] = 1
+
+    net_members = term_index['incidence'] @ in_network
+    # terms tested in the order they are first annotated to a network member
+    node_rows = in_network[term_index['protein_codes']].astype(bool)
+    candidates = pd.unique(term_index['term_codes'][node_rows])
+    selected = candidates[(net_members[candidates] > min_size) & (net_members[candidates] < max_size)]
+    if len(selected) == 0:
+        return pd.DataFrame([], columns=cols)
+
+    A = net_members[selected]
+    B = total_nodes - A
+    C = term_index['term_size'][selected] - A
+    D = total_prots - term_index['term_size'][selected] - total_nodes - A
+    # the test is not defined for tables with negative counts (fisher_exact raises a ValueError)
+    testable = (B >= 0) & (C >= 0) & (D >= 0)
+    if not testable.all():
+        selected, A, B, C, D = selected[testable], A[testable], B[testable], C[testable], D[testable]
+        if len(selected) == 0:
+            return pd.DataFrame([], columns=cols)
+    odds_ratio, p_value = fisher_exact(A, B, C, D)
+
+    order = term_index['row_order']
+    offsets = term_index['row_offsets']
+    members = []
+    for term in selected:
+        rows = order[offsets[term]:offsets[term + 1]]
+        rows = rows[node_rows[rows]]
+        members.append(','.join(term_index['proteins'][term_index['protein_codes'][rows]]))
+
+    enrichment = pd.DataFrame({'go_term': term_index['terms'][selected], 'A': A, 'B': B, 'C': C, 'D': D,
+                               'p_value': p_value, 'odds_ratio': odds_ratio, 'nodes': members}, columns=cols)
+    enrichment['fdr_bh'] = multipletests(enrichment['p_value'].tolist(), alpha=0.01, method='fdr_bh')[1]
+    enrichment = enrichment.sort_values(by='fdr_bh', ascending=True)
+
+    return enrichment
@@ -0,0 +1,139 @@
+import os
+import json
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import bundles
+import enrichment
+import go_store
+import utils
+import instrumentation
+
+COLUMNS = ['go_term', 'A', 'B', 'C', 'D', 'p_value', 'odds_ratio', 'nodes', 'fdr_bh']
+SCHEMA = pa.schema([('go_term', pa.string()), ('A', pa.int64()), ('B', pa.int64()), ('C', pa.int64()), ('D', pa.int64()),
+                    ('p_value', pa.float64()), ('odds_ratio', pa.float64()), ('nodes', pa.string()), ('fdr_bh', pa.float64())])
+
+
+def get_enrichment_path(enrichment_dir, taxid):
+    """
+    Path to the partition of a parasite in the enrichment dataset
+    :param str enrichment_dir: path to the enrichment dataset
+    :param int taxid: taxonomic identifier of the parasite
+    :return: path to the partition file
+    """
+    return os.path.join(enrichment_dir, 'taxid1={}'.format(taxid), 'part-0.parquet')
+
+
+def get_score_key(score):
+    """
+    Key of a score threshold in the enrichment index (two decimals, as the slider of the web app)
+    :param float score: score threshold
+    :return: key or None if the score is not exactly a step of the slider
+    """
+    if round(score, 2) != score:
+        return None
+
+    return '{:.2f}'.format(score)
+
+
+def get_species(pred_df):
+    """
+    Species in a network (the GO annotations of these species are the background of its enrichment)
+    :param DataFrame pred_df: network edges (requires taxid1 and taxid2 columns)
+    :return: sorted tuple of taxonomic identifiers
+    """
+    species = pred_df['taxid1'].unique().tolist() + pred_df['taxid2'].unique().tolist()
+
+    return tuple(sorted(set(int(s) for s in species)))
+
+
+def get_term_index(go_dir, species, term_indexes):
+    """
+    GO term index of the species of a network, built once for each set of species
+    :param str go_dir: path to the GO annotation store
+    :param tuple species: taxonomic identifiers
+    :param dict term_indexes: term indexes already built. Key -> species, value -> term index
+    :return: term index (see enrichment.build_term_index)
+    """
+    if species not in term_indexes:
+        term_indexes[species] = enrichment.build_term_index(go_store.read_annotations(go_dir, species))
+
+    return term_indexes[species]
+
+
+@instrumentation.timed()
+def build_enrichment_store(bundle_dir, go_dir, output_dir, scores=bundles.SCORE_GRID):
+    """
+    Precomputes the enrichment of the network of each parasite (all tissues and cell types) at each
+    score threshold of the slider, so the web app only computes it for tissue and cell type selections.
+    Writes a dataset partitioned by taxid1 (i.e. data/enrichment/taxid1=5833/part-0.parquet) with one
+    row group per distinct network: thresholds that select the same predictions share their results.
+    The index (score -> row group, None if nothing is enriched) is stored in the file metadata.
+    The build runs under a file lock and the dataset is moved into place once complete, so readers never find it missing.
+
+    :param str bundle_dir: path to the per-parasite bundles dataset
+    :param str go_dir: path to the GO annotation store
+    :param str output_dir: path to the enrichment dataset
+    :param list scores: score thresholds precomputed
+    """
+    term_indexes = {}
+    with utils.file_lock(output_dir):
+        tmp_dir = utils.get_tmp_path(output_dir)
+        os.makedirs(tmp_dir)
+        for taxid in bundles.get_bundle_taxids(bundle_dir):
+            df = bundles.read_parasite_bundle(bundle_dir, taxid)
+            filepath = get_enrichment_path(tmp_dir, taxid)
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            index = {}
+            # offset of the last prediction in the network -> row group of its results
+            row_groups = {}
+            n_groups = 0
+            with pq.ParquetWriter(filepath, SCHEMA, compression='zstd') as writer:
+                for score in scores:
+                    offset = bundles.get_score_offset(df['weight'].values, score)
+                    if offset not in row_groups:
+                        network = df.iloc[:offset]
+                        result = utils.calculate_enrichment(network, term_index=get_term_index(go_dir, get_species(network), term_indexes))
+                        row_groups[offset] = None
+                        if not result.empty:
+                            writer.write_table(pa.Table.from_pandas(result[COLUMNS], schema=SCHEMA, preserve_index=False),
+                                               row_group_size=len(result))
+                            row_groups[offset] = n_groups
+                            n_groups += 1
+                    index[get_score_key(float(score))] = row_groups[offset]
+                writer.add_key_value_metadata({'enrichment_index': json.dumps(index)})
+            instrumentation.add_rows(len(index))
+        utils.replace_dir(tmp_dir, output_dir)
+
+
+def read_enrichment_index(filepath):
+    """
+    Index of the precomputed enrichment of a parasite
+    :param str filepath: path to the partition of the parasite
+    :return: dictionary. Key -> score key, value -> row group (None if nothing is enriched)
+    """
+    metadata = pq.read_metadata(filepath).metadata or {}
+
+    return json.loads(metadata.get(b'enrichment_index', b'{}'))
+
+
+def read_enrichment(enrichment_dir, taxid, score):
+    """
+    Precomputed enrichment of the network of a parasite (all tissues and cell types) at a score threshold
+    :param str enrichment_dir: path to the enrichment dataset
+    :param int taxid: taxonomic identifier of the parasite
+    :param float score: minimum weight of the predictions in the network
+    :return: dataframe with columns go_term, A, B, C, D, p_value, odds_ratio, nodes, fdr_bh (sorted by fdr_bh)
+                or None if it was not precomputed
+    """
+    filepath = get_enrichment_path(enrichment_dir, taxid)
+    key = get_score_key(score)
+    if key is None or not os.path.isfile(filepath):
+        return None
+    index = read_enrichment_index(filepath)
+    if key not in index:
+        return None
+    if index[key] is None:
+        return pd.DataFrame([], columns=COLUMNS)
+
+    return pq.ParquetFile(filepath).read_row_group(index[key]).to_pandas()
@@ -1,138 +1,211 @@
 import os
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
 import utils
+import downloader
+import instrumentation
 
 
-def apply_tissue_filter(config_file, valid_proteins, cutoff):
-    hosts = utils.read_config(filepath=config_file, field='hosts')
-    tissue_mapping = utils.read_config(filepath=config_file, field='tissues')
-    for taxid in hosts:
-        proteins = valid_proteins[taxid]
-        if 'tissues_url' in hosts[taxid]:
-            url = hosts[taxid]['tissues_url']
-            filename = utils.download_file(url=url, data_dir='data')
-            tissues, proteins = get_tissues(config_file, filename, proteins, cutoff, tissue_mapping)
-    
-        valid_proteins[taxid] = proteins
+def get_valid_tissues(parasites):
+    """
+    Tissues relevant in the lifecycle of the studied parasites
+    :param dict parasites: parasites section of the configuration file
+    :return: set of BTO identifiers
+    """
+    valid_tissues = set()
+    for parasite in parasites:
+        valid_tissues.update(parasites[parasite]['tissues'])
 
-    return tissues
+    return valid_tissues
+
+
+def get_valid_compartments(parasites):
+    """
+    Cellular compartments relevant in the lifecycle of the studied parasites (plasma membrane by default)
+    :param dict parasites: parasites section of the configuration file
+    :return: set of GO identifiers
+    """
+    valid_compartments = set()
+    for parasite in parasites:
+        if "compartments" in parasites[parasite]:
+            valid_compartments.add(parasites[parasite]['compartments'])
+        else:
+            valid_compartments.add('GO:0005886')
+
+    return valid_compartments
+
+
+@instrumentation.timed()
+def read_jensenlab_file(filepath, score_col, valid_terms, cutoff, taxid=9606, cache_dir=os.path.join('data', 'filters'), chunksize=2000000):
+    """
+    Reads a file from tissues.jensenlab.org or compartments.jensenlab.org keeping only the annotations
+    to valid terms with a score above the cutoff. Only the protein, term and score columns are parsed (typed, in chunks)
+    and the filters are applied to each chunk. The result is cached as parquet, keyed by the file (see downloader.file_key),
+    the cutoff and the valid terms.
 
-def get_tissues(config_file, tissues_file, valid_proteins, cutoff, mapping):
+    :param str filepath: path to the jensenlab file
+    :param int score_col: position of the confidence score column
+    :param set valid_terms: valid tissue or compartment identifiers
+    :param float cutoff: minimum confidence score accepted
+    :param int taxid: taxonomic identifier of the species (used to build the STRING identifiers)
+    :param str cache_dir: path to the directory where the filtered annotations are cached
+    :param int chunksize: number of lines read at once
+    :return: dataframe with columns protein, term (in file order)
+    """
+    key = hashlib.sha1(json.dumps([downloader.file_key(filepath), cutoff, sorted(valid_terms), score_col, taxid]).encode('utf-8')).hexdigest()[:16]
+    cache_file = os.path.join(cache_dir, '{}.{}.parquet'.format(os.path.basename(filepath).split('.')[0], key))
+    if os.path.isfile(cache_file):
+        return pd.read_parquet(cache_file)
+
+    annotations = []
+    # the first line is skipped as in the original files
+    reader = pd.read_csv(filepath, sep='\t', header=None, skiprows=1, usecols=[0, 2, score_col],
+                         dtype={0: str, 2: str, score_col: float}, chunksize=chunksize, quoting=3)
+    for chunk in reader:
+        chunk = chunk[(chunk[score_col] >= cutoff) & (chunk[2].isin(valid_terms))]
+        annotations.append(pd.DataFrame({'protein': str(taxid) + '.' + chunk[0], 'term': chunk[2]}))
+    annotations = pd.concat(annotations, ignore_index=True) if annotations else pd.DataFrame(columns=['protein', 'term'])
+
+    os.makedirs(cache_dir, exist_ok=True)
+    utils.save_to_parquet(annotations, cache_file)
+
+    return annotations
+
+
+@instrumentation.timed()
+def get_tissues(tissues_file, valid_proteins, cutoff, mapping, valid_tissues, taxid=9606):
     """
     Get protein tissue expression for relevant tissues in the lifecycle of the
     studied parasites
     
-    :param str config_file: path to the configuration file
     :param str tissues_file: path to file with tissue expression (tissues.jensenlab.org)
-    :param list valid_proteins: all proteins studied
+    :param dict valid_proteins: dictionary with annotations in valid proteins
     :param float cutoff: minimum confidence score accepted (tissues.jensenlab.org)
+    :param dict mapping: tissues section of the configuration file (BTO identifier -> tissue name)
+    :param set valid_tissues: BTO identifiers of the relevant tissues
+    :param int taxid: taxonomic identifier of the host
     
-    :return tissues: dictionary with protein tissue expression
+    :return tissues: dictionary with protein tissue expression and dictionary with only proteins in relevant tissues
     """
-    tissues = {}
-    filters = {}
-    valid_tissues = set()
-    parasites = utils.read_config(filepath=config_file, field='parasites')
-    for parasite in parasites:
-        t = parasites[parasite]['tissues']
-        valid_tissues.update(t)
-    
-    first = True
-    with open(tissues_file, 'r') as f:
-        for line in f:
-            if first:
-                first = False
-                continue
-            
-            data = line.rstrip().split('\t')
-            protein  = "9606."+data[0]
-            tissue = data[2]
-            score = float(data[6])
-            
-            if protein in valid_proteins and score >= cutoff and tissue in valid_tissues:
-                if protein not in tissues:
-                    tissues[protein] = []
-                
-                tissues[protein].append(mapping[tissue])
-                filters[protein] = valid_proteins[protein]
+    data = read_jensenlab_file(tissues_file, score_col=6, valid_terms=valid_tissues, cutoff=cutoff, taxid=taxid)
+    data = data[data['protein'].isin(valid_proteins.keys())]
+    data = data.assign(term=data['term'].map(mapping))
+    tissues = data.groupby('protein', sort=False)['term'].agg(list).to_dict()
+    filters = {protein: valid_proteins[protein] for protein in tissues}
     
     return tissues, filters
 
 
-def apply_compartment_filter(config_file, valid_proteins, cutoff):
-    hosts = utils.read_config(filepath=config_file, field='hosts')
-    for taxid in hosts:
-        proteins = valid_proteins[taxid]
-        #print("C before", len(proteins))
-        if 'compartments_url' in hosts[taxid]:
-            url = hosts[taxid]['compartments_url']
-            filename = utils.download_file(url=url, data_dir='data')
-            compartments, proteins = get_compartments(config_file, filename, proteins, cutoff)
-    
-        valid_proteins[taxid] = proteins
-        #print("C after", len(valid_proteins[taxid]))
-    
-    return compartments
-
-
-def get_compartments(config_file, compartments_file, valid_proteins, cutoff):
+@instrumentation.timed()
+def get_compartments(compartments_file, valid_proteins, cutoff, valid_compartments, taxid=9606):
     """
     Get protein cellular compartment expression relevant in the lifecycle of the
     studied parasites
     
-    :param str config_file: path to the configuration file
     :param str compartments_file: path to file with cellular compartment expression (compartments.jensenlab.org)
     :param dict valid_proteins: dictionary with annotations in valid proteins
-    :param float cutoff: minimum confidence score accepted (tissues.jensenlab.org)
+    :param float cutoff: minimum confidence score accepted (compartments.jensenlab.org)
+    :param set valid_compartments: GO identifiers of the relevant compartments
+    :param int taxid: taxonomic identifier of the host
     
-    :return filtered_dict: dictionary with only proteins in relevant compartments
+    :return filtered_dict: dictionary with protein compartments and dictionary with only proteins in relevant compartments
     """
-    compartments = {}
-    filters = {}
-    valid_compartments = set()
-    parasites = utils.read_config(filepath=config_file, field='parasites')
-    for parasite in parasites:
-        if "compartments" in parasites[parasite]:
-            t = parasites[parasite]['compartments']
-        else:
-            t = 'GO:0005886'
-        valid_compartments.add(t)
-    
-    first = True
-    with open(compartments_file, 'r') as f:
-        for line in f:
-            if first:
-                first = False
-                continue
-            
-            data = line.rstrip().split('\t')
-            protein  = "9606."+data[0]
-            compartment = data[2]
-            score = float(data[4])
-            if protein in valid_proteins and score >= cutoff and compartment in valid_compartments:
-                if protein not in compartments:
-                    compartments[protein] = []
-                
-                compartments[protein].append(compartment)
-                filters[protein] = valid_proteins[protein]
+    data = read_jensenlab_file(compartments_file, score_col=4, valid_terms=valid_compartments, cutoff=cutoff, taxid=taxid)
+    data = data[data['protein'].isin(valid_proteins.keys())]
+    compartments = data.groupby('protein', sort=False)['term'].agg(list).to_dict()
+    filters = {protein: valid_proteins[protein] for protein in compartments}
   
     return compartments, filters
 
-def get_secretome_predictions(config_file, secretome_dir, valid_proteins):
+
+@instrumentation.timed()
+def apply_context_filters(config_file, valid_proteins, cutoff, workers=2):
+    """
+    Keeps only the host proteins expressed in the tissues and cellular compartments relevant for the
+    parasites. The tissue and compartment files of each host are processed concurrently.
+
+    :param str config_file: path to the configuration file
+    :param dict valid_proteins: dictionary with valid proteins for each species. Key -> tax id, value -> dictionary: key -> protein id, value -> protein name
+    :param float cutoff: minimum confidence score accepted (jensenlab)
+    :param int workers: number of files processed at the same time
+    :return: tuple with the tissue and compartment annotations of the valid proteins
+    """
+    config = utils.read_config(config_file)
+    hosts = config['hosts']
+    valid_tissues = get_valid_tissues(config['parasites'])
+    valid_compartments = get_valid_compartments(config['parasites'])
+    tissues = {}
+    compartments = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for taxid in hosts:
+            proteins = valid_proteins[taxid]
+            if 'tissues_url' in hosts[taxid]:
+                filename = utils.download_file(url=hosts[taxid]['tissues_url'], data_dir='data')
+                futures[(taxid, 'tissues')] = executor.submit(get_tissues, filename, proteins, cutoff,
+                                                              config['tissues'], valid_tissues, taxid)
+            if 'compartments_url' in hosts[taxid]:
+                filename = utils.download_file(url=hosts[taxid]['compartments_url'], data_dir='data')
+                futures[(taxid, 'compartments')] = executor.submit(get_compartments, filename, proteins, cutoff,
+                                                                   valid_compartments, taxid)
+
+        for taxid in hosts:
+            proteins = valid_proteins[taxid]
+            if (taxid, 'tissues') in futures:
+                host_tissues, filtered = futures[(taxid, 'tissues')].result()
+                tissues.update(host_tissues)
+                proteins = filtered
+            if (taxid, 'compartments') in futures:
+                host_compartments, filtered = futures[(taxid, 'compartments')].result()
+                proteins = {protein: proteins[protein] for protein in filtered if protein in proteins}
+                compartments.update({protein: host_compartments[protein] for protein in proteins})
+            valid_proteins[taxid] = proteins
+
+    return tissues, compartments
+
+
+def get_secreted_proteins(filepath, proteins):
+    """
+    Keeps only the secreted or membrane proteins of a parasite
+    :param str filepath: path to the secretome predictions (FASTA file) of the parasite
+    :param dict proteins: proteins of the parasite. Key -> protein id, value -> protein name
+    :return: dictionary with only secreted or membrane parasite proteins
+    """
+    sequences = utils.read_fasta_ids(filepath)
+
+    return {protein: name for protein, name in proteins.items() if protein in sequences}
+
+
+@instrumentation.timed()
+def get_secretome_predictions(config_file, secretome_dir, valid_proteins, workers=4):
     """
-    Filter out proteins that are not secreted or membrane from the list of parasite proteins
+    Filter out proteins that are not secreted or membrane from the list of parasite proteins.
+    Only the FASTA headers of the predictions are indexed and the parasites are processed in parallel.
     
     :param str config_file: path to the configuration file
     :param str secretome_dir: path to the directory where the prediction files are
     :param dict valid_proteins: dictionary with annotations in valid proteins
+    :param int workers: number of parasites processed at the same time
         
     :return filtered_dict: dictionary with only secreted or membrane parasite proteins
     """
     parasites = utils.read_config(filepath=config_file, field='parasites')
-    for parasite in parasites:
-        filepath = os.path.join(secretome_dir, str(parasite)+'.fasta')
-        sequences = utils.read_fasta(filepath)
-        filter_out_ids = utils.filter_sequences(sequences, valid_proteins[parasite])
-        for k in filter_out_ids:
-            valid_proteins[parasite].pop(k, None)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        filtered = executor.map(get_secreted_proteins, [get_secretome_file(secretome_dir, parasite) for parasite in parasites],
+                                [valid_proteins[parasite] for parasite in parasites])
+        for parasite, proteins in zip(parasites, filtered):
+            valid_proteins[parasite] = proteins
     
     return valid_proteins
+
+
+def get_secretome_file(secretome_dir, taxid):
+    """
+    Path to the secretome predictions of a parasite
+    :param str secretome_dir: path to the directory where the prediction files are
+    :param int taxid: taxonomic identifier of the parasite
+    :return: path to the FASTA file
+    """
+    return os.path.join(secretome_dir, str(taxid)+'.fasta')
@@ -1,15 +1,18 @@
 import os
 import pandas as pd
 import utils
+import go_hierarchy
+import go_store
+import instrumentation
 
 
+@instrumentation.timed()
 def get_gene_ontology(config_file, output_dir):
     """
-    Retrieve gene ontology biological processes for all valid proteins
+    Retrieve gene ontology biological processes for all valid proteins and store them in the GO annotation store
+    (output_dir/go_annotations, partitioned by taxid, see go_store.build_store)
     :param str config_file: path to config file
-    :param dict valid_proteins: dictionary of valid proteins for each specie. Key -> tax id, value -> dictionary: key -> protein id, value -> protein name
-    
-    :return: dictionary with all biological processes annotated for all proteins for all species. Key -> tax id, value -> dictionary: key -> protein id, value -> go term
+    :param str output_dir: path to the directory where the ontology and the annotation store are saved
     """
     
     gos = []
@@ -21,16 +24,14 @@ def get_gene_ontology(config_file, output_dir):
         string_file = urls['string_go_url']
         if hosts is not None and parasites is not None:
             taxids = list(hosts.keys()) + list(parasites.keys())
-            for taxid in taxids:
-                data = parse_gene_ontology(string_file, taxid)
-                gos.append(data)
-    
-    gos = pd.concat(gos)
+            gos = utils.map_taxids(parse_gene_ontology, taxids, workers=utils.get_workers(config_file), string_file=string_file)
 
-    utils.save_to_parquet(gos, os.path.join(output_dir, 'gos.parquet'))
+    # one partition per species with integer protein and term ids (no concatenation of the raw strings)
+    go_store.build_store(gos, os.path.join(output_dir, 'go_annotations'))
 
 
 
+@instrumentation.timed()
 def parse_gene_ontology(string_file, taxid):
     """
     Retrieve gos for a given specie
@@ -51,34 +52,103 @@ def parse_gene_ontology(string_file, taxid):
     
     return data
 
+def get_tag_value(line):
+    """
+    Value of an OBO tag line without the trailing modifier ({...}) or comment (! ...)
+    :param str line: tag line (i.e. is_a: GO:0048308 ! organelle inheritance)
+    :return: tuple with the tag and its value
+    """
+    tag, _, value = line.partition(':')
+    value = value.strip()
+    comment = value.find(' !')
+    if comment != -1:
+        value = value[:comment].rstrip()
+    if value.endswith('}') and ' {' in value:
+        value = value[:value.rfind(' {')].rstrip()
+
+    return tag, value
+
+
+@instrumentation.timed()
+def read_obo(filepath, relations=('is_a', 'part_of')):
+    """
+    Streaming parser of OBO files: reads the [Term] stanzas line by line (obsolete terms are ignored)
+    and keeps only the identifier, the name and the relations of each term in columnar lists
+
+    :param str filepath: path to the ontology file (i.e. go.obo)
+    :param tuple relations: relations kept (is_a and the types in relationship tags, i.e. part_of)
+    :return: tuple with the terms (columns id, name) and the relations (columns child, parent, relation) in file order
+    """
+    ids = []
+    names = []
+    children = []
+    parents = []
+    types = []
+    term = None
+
+    def add(term):
+        if term is not None and not term['obsolete'] and term['id'] is not None:
+            ids.append(term['id'])
+            names.append(term['name'])
+            for parent, relation in term['relations']:
+                children.append(term['id'])
+                parents.append(parent)
+                types.append(relation)
+
+    with open(filepath, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('['):
+                add(term)
+                term = {'id': None, 'name': None, 'obsolete': False, 'relations': []} if line.startswith('[Term]') else None
+            elif term is None or line == '' or line.startswith('!'):
+                continue
+            else:
+                tag, value = get_tag_value(line)
+                if tag == 'id':
+                    term['id'] = value
+                elif tag == 'name':
+                    term['name'] = value
+                elif tag == 'is_obsolete':
+                    term['obsolete'] = value == 'true'
+                elif tag == 'is_a' and 'is_a' in relations:
+                    term['relations'].append((value, 'is_a'))
+                elif tag == 'relationship':
+                    relation, _, parent = value.partition(' ')
+                    if relation in relations:
+                        term['relations'].append((parent.split(' ')[0], relation))
+    add(term)
+
+    terms = pd.DataFrame({'id': ids, 'name': names})
+    rels = pd.DataFrame({'child': children, 'parent': parents, 'relation': types})
+
+    return terms, rels
+
+
+@instrumentation.timed()
 def parse_ontology(config_file, output_directory):
+    """
+    Generates the GO hierarchy file (go_ontology.parquet): one row per is_a relation with the
+    capitalized names of the parent and child terms (parents without a name keep their GO identifier),
+    and its index (go_ontology_index.npz, see go_hierarchy.build_go_index)
+
+    :param str config_file: path to config file
+    :param str output_directory: path to the directory where the file is stored
+    """
     urls = utils.read_config(filepath=config_file, field='urls')
 
-    terms = {}
-    rels = []
+    rels = pd.DataFrame(columns=['parent', 'child'])
     if 'go_ontology_url' in urls:
         filename = utils.download_file(url=urls['go_ontology_url'], data_dir='data')
-        graph = utils.convertOBOtoNet(filename)
-        for term, attr in graph.nodes(data=True):
-            if "name" in attr:
-                terms[term] = attr["name"].capitalize()
-            if "is_a" in attr:
-                for isa in attr["is_a"]:
-                    if isa in terms:
-                        isa = terms[isa]
-                    rels.append([isa, terms[term]])
-    
-    rels = pd.DataFrame(rels, columns=['parent', 'child'])
-    mapped_terms = []
-    for i, row in rels.iterrows():
-        term = row['parent']
-        if term in terms:
-            term = terms[term]
-        mapped_terms.append(term)
-    
-    rels['parent'] = mapped_terms
+        terms, rels = read_obo(filename)
+        terms = terms[terms['name'].notna()]
+        names = pd.Series(terms['name'].str.capitalize().values, index=terms['id'].values)
+        rels = rels[(rels['relation'] == 'is_a') & (rels['child'].isin(names.index))]
+        rels = pd.DataFrame({'parent': rels['parent'].map(names).fillna(rels['parent']).values,
+                             'child': rels['child'].map(names).values})
     
     utils.save_to_parquet(rels, os.path.join(output_directory, 'go_ontology.parquet'))
+    go_hierarchy.save_go_index(go_hierarchy.build_go_index(rels), os.path.join(output_directory, 'go_ontology_index.npz'))
 
 if __name__ == "__main__":
     config_file = 'config.yml'
@@ -0,0 +1,144 @@
+import os
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+
+def build_go_index(ontology_df, max_iterations=64):
+    """
+    Builds an index of the GO hierarchy with integer term ids:
+        names: term name of each id
+        parents: CSR adjacency (term id -> parent ids)
+        ancestors: CSR transitive closure (term id -> all its ancestor ids)
+        depth: length of the longest path from a root to each term
+
+    :param DataFrame ontology_df: GO hierarchy (columns parent and child, see go.parse_ontology)
+    :param int max_iterations: maximum number of iterations to compute the closure and depths
+    :return: dictionary with the index arrays
+    """
+    codes, names = pd.factorize(pd.concat([ontology_df['child'], ontology_df['parent']], ignore_index=True), sort=True)
+    n_terms = len(names)
+    n_rels = len(ontology_df)
+    parents = sp.csr_matrix((np.ones(n_rels, dtype=np.int32), (codes[:n_rels], codes[n_rels:])), shape=(n_terms, n_terms))
+    parents.data[:] = 1
+    parents.eliminate_zeros()
+
+    # closure by repeated squaring: after k iterations it contains the ancestors up to 2^k levels above
+    ancestors = parents.copy()
+    for _ in range(max_iterations):
+        closure = ancestors + ancestors @ ancestors
+        closure.data[:] = 1
+        if closure.nnz == ancestors.nnz:
+            break
+        ancestors = closure
+
+    depth = np.zeros(n_terms, dtype=np.int32)
+    has_parents = np.diff(parents.indptr) > 0
+    starts = parents.indptr[:-1][has_parents]
+    for _ in range(max_iterations):
+        new_depth = depth.copy()
+        new_depth[has_parents] = np.maximum.reduceat(depth[parents.indices], starts) + 1 if len(starts) > 0 else 0
+        if np.array_equal(new_depth, depth):
+            break
+        depth = new_depth
+
+    return {'names': np.asarray(names, dtype=object), 'parents_indptr': parents.indptr, 'parents_indices': parents.indices,
+            'ancestors_indptr': ancestors.indptr, 'ancestors_indices': ancestors.indices, 'depth': depth}
+
+
+def save_go_index(index, index_file):
+    """
+    Stores the GO hierarchy index (numpy archive)
+    :param dict index: index arrays (see build_go_index)
+    :param str index_file: path to the index file (.npz)
+    """
+    os.makedirs(os.path.dirname(index_file) or '.', exist_ok=True)
+    tmp_path = index_file + '.{}.tmp.npz'.format(os.getpid())
+    arrays = dict(index)
+    arrays['names'] = np.asarray(index['names'], dtype=str)
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, index_file)
+
+
+def get_go_index(ontology_file, index_file=None):
+    """
+    GO hierarchy index of an ontology file, read from its index file or built (and stored) if the
+    index is missing or older than the ontology file
+    :param str ontology_file: path to the GO hierarchy file (go_ontology.parquet)
+    :param str index_file: path to the index file (default: next to the ontology file, go_ontology_index.npz)
+    :return: dictionary with the index arrays
+    """
+    if index_file is None:
+        index_file = os.path.splitext(ontology_file)[0] + '_index.npz'
+    if os.path.isfile(index_file) and os.path.getmtime(index_file) >= os.path.getmtime(ontology_file):
+        with np.load(index_file) as data:
+            index = {name: data[name] for name in data.files}
+        index['names'] = index['names'].astype(object)
+        return index
+
+    index = build_go_index(pd.read_parquet(ontology_file))
+    save_go_index(index, index_file)
+
+    return index
+
+
+def get_term_ids(index, terms):
+    """
+    Integer ids of a list of term names
+    :param dict index: GO hierarchy index
+    :param list terms: term names
+    :return: array of ids (-1 for the terms not in the hierarchy)
+    """
+    names = index['names']
+    terms = np.asarray(terms, dtype=object)
+    positions = np.searchsorted(names, terms)
+    positions[positions >= len(names)] = 0
+    found = names[positions] == terms if len(names) > 0 else np.zeros(len(terms), dtype=bool)
+
+    return np.where(found, positions, -1)
+
+
+def get_nearest_ancestors(index, terms):
+    """
+    Nearest ancestor of each term among the terms given (i.e. the enriched terms). The candidates are the
+    ancestors of the term in the list that are not ancestors of another candidate (the most specific ones);
+    when there are several (the hierarchy is a DAG) the deepest one is chosen (ties by term id).
+
+    :param dict index: GO hierarchy index
+    :param list terms: term names
+    :return: list with the nearest ancestor of each term in the list (None if it has no ancestor in the list)
+    """
+    terms = list(terms)
+    ids = get_term_ids(index, terms)
+    valid = np.where(ids >= 0)[0]
+    n_terms = len(index['names'])
+    ancestors = sp.csr_matrix((np.ones(len(index['ancestors_indices']), dtype=np.int32), index['ancestors_indices'],
+                               index['ancestors_indptr']), shape=(n_terms, n_terms))
+    # ancestors of each term restricted to the terms given (positions in the list)
+    selection = sp.csr_matrix((np.ones(len(valid), dtype=np.int32), (ids[valid], valid)), shape=(n_terms, len(ids)))
+    candidates = (ancestors[ids[valid]] @ selection).tocsr()
+    candidates.data[:] = 1
+    expanded = sp.csr_matrix((len(ids), len(ids)), dtype=np.int32)
+    if len(valid) > 0:
+        rows = sp.csr_matrix((np.ones(len(valid), dtype=np.int32), (valid, np.arange(len(valid)))), shape=(len(ids), len(valid)))
+        expanded = (rows @ candidates).tolil()
+        # a term is not its own ancestor (only possible with cycles in the hierarchy)
+        expanded.setdiag(0)
+        expanded = expanded.tocsr()
+        expanded.eliminate_zeros()
+    # candidates that are ancestors of other candidates are not the nearest
+    redundant = (expanded @ expanded).tocsr()
+    redundant.data[:] = 1
+    nearest = (expanded - expanded.multiply(redundant)).tocsr()
+    nearest.eliminate_zeros()
+
+    depth = np.full(len(ids), -1, dtype=np.int32)
+    depth[valid] = index['depth'][ids[valid]]
+    parents = [None] * len(ids)
+    for i in range(len(ids)):
+        options = nearest.indices[nearest.indptr[i]:nearest.indptr[i + 1]]
+        if len(options) > 0:
+            best = options[np.lexsort((ids[options], -depth[options]))[0]]
+            parents[i] = terms[best]
+
+    return parents
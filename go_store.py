@@ -0,0 +1,137 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import utils
+
+STORE_VERSION = 1
+COLUMNS = ['#string_protein_id', 'description', 'taxid']
+
+
+def get_store_files(store_dir):
+    """
+    Files of a GO annotation store
+    :param str store_dir: path to the GO annotation store
+    :return: dictionary with the path of the annotations and proteins datasets (partitioned by taxid), the terms table and the metadata
+    """
+    return {'annotations': os.path.join(store_dir, 'annotations'), 'proteins': os.path.join(store_dir, 'proteins'),
+            'terms': os.path.join(store_dir, 'terms.parquet'), 'metadata': os.path.join(store_dir, 'metadata.json')}
+
+
+def get_partition_path(dataset_dir, taxid):
+    """
+    Path to the partition of a species in a dataset of the store
+    :param str dataset_dir: path to the annotations or proteins dataset
+    :param int taxid: taxonomic identifier of the species
+    :return: path to the partition file
+    """
+    return os.path.join(dataset_dir, 'taxid={}'.format(taxid), 'part-0.parquet')
+
+
+def build_store(go_dfs, store_dir):
+    """
+    Writes the GO annotations of each species (as generated by go.parse_gene_ontology) as a store partitioned by taxid:
+        annotations/taxid=X/part-0.parquet: protein id and term id of each annotation (int32)
+        proteins/taxid=X/part-0.parquet: protein id and STRING identifier of the annotated proteins of the species
+        terms.parquet: term id and description, shared by all the species (sorted)
+        metadata.json: taxids and version of the store
+    Protein ids are unique across species, so the annotations of several species can be read together.
+    The store is written to a temporary directory and moved into place once complete.
+
+    :param list go_dfs: GO annotations of each species (columns #string_protein_id, description and taxid)
+    :param str store_dir: path to the GO annotation store
+    """
+    go_dfs = [df for df in go_dfs if len(df) > 0]
+    terms = pd.Index(sorted(set().union(*[df['description'].unique() for df in go_dfs])), dtype=object)
+    tmp_dir = utils.get_tmp_path(store_dir)
+    os.makedirs(tmp_dir)
+    files = get_store_files(tmp_dir)
+    taxids = []
+    n_proteins = 0
+    for df in go_dfs:
+        taxid = int(df['taxid'].iloc[0])
+        protein_codes, proteins = pd.factorize(df['#string_protein_id'])
+        annotations = pd.DataFrame({'protein_id': (protein_codes + n_proteins).astype(np.int32),
+                                    'term_id': terms.get_indexer(df['description']).astype(np.int32)})
+        proteins = pd.DataFrame({'protein_id': np.arange(n_proteins, n_proteins + len(proteins), dtype=np.int32),
+                                 'protein': np.asarray(proteins, dtype=object)})
+        n_proteins += len(proteins)
+        for dataset, table in [('annotations', annotations), ('proteins', proteins)]:
+            filepath = get_partition_path(files[dataset], taxid)
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            table.to_parquet(filepath, index=False, compression='zstd')
+        taxids.append(taxid)
+    pd.DataFrame({'term_id': np.arange(len(terms), dtype=np.int32), 'term': np.asarray(terms, dtype=object)}).to_parquet(files['terms'], index=False, compression='zstd')
+    with open(files['metadata'], 'w') as out:
+        out.write(json.dumps({'version': STORE_VERSION, 'taxids': taxids}))
+    utils.replace_dir(tmp_dir, store_dir)
+
+
+def get_store_taxids(store_dir):
+    """
+    Species available in a GO annotation store
+    :param str store_dir: path to the GO annotation store
+    :return: list of taxonomic identifiers
+    """
+    with open(get_store_files(store_dir)['metadata'], 'r') as f:
+        metadata = json.load(f)
+
+    return metadata['taxids']
+
+
+def read_partitions(dataset_dir, taxids, columns=None):
+    """
+    Reads the partitions of some species from a dataset of the store. The partitions are selected by their
+    taxid (filter pushdown: the files of other species are not opened) and returned in the order given.
+    :param str dataset_dir: path to the annotations or proteins dataset
+    :param list taxids: taxonomic identifiers of the species
+    :param list columns: columns to read (default: all)
+    :return: dictionary. Key -> taxid, value -> Arrow table
+    """
+    dataset = ds.dataset(dataset_dir, format='parquet', partitioning='hive')
+    tables = {}
+    for fragment in dataset.get_fragments(filter=ds.field('taxid').isin(taxids)):
+        taxid = int(ds.get_partition_keys(fragment.partition_expression)['taxid'])
+        tables[taxid] = fragment.to_table(columns=columns)
+
+    return {taxid: tables[taxid] for taxid in taxids if taxid in tables}
+
+
+def read_annotations(store_dir, taxids):
+    """
+    Reads the GO annotations of some species from the store. Only the partitions of those species are read
+    and the protein and term columns are categoricals over the proteins of the species and the shared terms
+    table, so they take little memory.
+
+    :param str store_dir: path to the GO annotation store
+    :param list taxids: taxonomic identifiers of the species
+    :return: dataframe with columns #string_protein_id, description and taxid (as go.parse_gene_ontology)
+    """
+    files = get_store_files(store_dir)
+    # species in the order they were stored (as they were parsed, so the terms are found in the same order)
+    requested = set(int(t) for t in taxids)
+    taxids = [taxid for taxid in get_store_taxids(store_dir) if taxid in requested]
+    annotations = read_partitions(files['annotations'], taxids, columns=['protein_id', 'term_id'])
+    proteins = read_partitions(files['proteins'], list(annotations.keys()), columns=['protein_id', 'protein'])
+    terms = pd.read_parquet(files['terms'])['term']
+
+    # protein ids of a species are consecutive, so the position of a protein among the proteins read
+    # is its id minus the first id of its species plus the number of proteins of the previous species
+    protein_codes = []
+    protein_names = []
+    offset = 0
+    for taxid, table in annotations.items():
+        ids = proteins[taxid]['protein_id'].to_numpy()
+        protein_codes.append(table['protein_id'].to_numpy() - (ids[0] if len(ids) > 0 else 0) + offset)
+        protein_names.append(proteins[taxid]['protein'].to_numpy(zero_copy_only=False))
+        offset += len(ids)
+    rows = [table.num_rows for table in annotations.values()]
+    term_codes = [table['term_id'].to_numpy() for table in annotations.values()]
+    df = pd.DataFrame({'#string_protein_id': pd.Categorical.from_codes(np.concatenate(protein_codes + [np.array([], dtype=np.int32)]),
+                                                                       categories=np.concatenate(protein_names + [np.array([], dtype=object)])),
+                       'description': pd.Categorical.from_codes(np.concatenate(term_codes + [np.array([], dtype=np.int32)]), categories=terms.values),
+                       'taxid': np.repeat(np.array(list(annotations.keys()), dtype=np.int32), rows)}, columns=COLUMNS)
+
+    return df
@@ -1,106 +1,381 @@
+import os
+import json
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import utils
+import instrumentation
 
 
-def get_eggnog_groups(filepath, proteins):
+def get_index_dir(filepath):
     """
-    Obtains all the EggNOG groups which contains a list of given proteins
+    Directory where the inverted index of an EggNOG members file is stored
     :param str filepath: path to the EggNOG groups file
-    :param list proteins: list of Ensembl protein identifiers
-    :return: dictionary with all the valid EggNOG groups. Key -> group, value -> list proteins in the group
+    :return: path to the index directory (i.e. data/2759_members_index)
     """
-    sum_prots = 0
-    valid_groups = {}
+    return os.path.join(os.path.dirname(filepath), os.path.basename(filepath).split('.')[0] + '_index')
+
+
+@instrumentation.timed()
+def build_eggnog_index(filepath, index_dir, chunksize=100000):
+    """
+    Parses the EggNOG members file once into a compact inverted index stored as numpy arrays:
+    sorted protein ids with their group ids (protein -> groups) and the members of each group (group -> proteins),
+    both in CSR format (offsets + values)
+
+    :param str filepath: path to the EggNOG groups file
+    :param str index_dir: path to the directory where the index is stored
+    :param int chunksize: number of groups encoded at once
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    group_names = []
+    member_chunks = []
+    member_groups = []
+    members = []
+    groups_ids = []
     groups = utils.read_gzipped_file(filepath)
     first = True
     for line in groups:
         if first:
             first = False
             continue
-        data = line.decode("utf-8").rstrip().split('\t')
-        group = data[1]
-        gproteins = data[4].split(',')
-        int_proteins = list(set(proteins).intersection(gproteins))
-        if  len(int_proteins) > 0:
-            valid_groups[group] = int_proteins
-            sum_prots += len(int_proteins)
-    
+        data = line.rstrip().split(b'\t')
+        gproteins = data[4].split(b',')
+        groups_ids.append(np.full(len(gproteins), len(group_names), dtype=np.int32))
+        group_names.append(data[1])
+        members.extend(gproteins)
+        if len(groups_ids) >= chunksize:
+            member_chunks.append(np.array(members, dtype=bytes))
+            member_groups.append(np.concatenate(groups_ids))
+            members = []
+            groups_ids = []
+    if len(groups_ids) > 0:
+        member_chunks.append(np.array(members, dtype=bytes))
+        member_groups.append(np.concatenate(groups_ids))
+    groups.close()
+
+    members = np.concatenate(member_chunks) if member_chunks else np.array([], dtype='S1')
+    member_groups = np.concatenate(member_groups) if member_groups else np.array([], dtype=np.int32)
+    member_chunks = None
+    # group -> members (members are already in group order)
+    proteins, member_ids = np.unique(members, return_inverse=True)
+    members = None
+    group_offsets = np.searchsorted(member_groups, np.arange(len(group_names) + 1)).astype(np.int64)
+    # protein -> groups
+    order = np.argsort(member_ids, kind='stable')
+    protein_offsets = np.searchsorted(member_ids[order], np.arange(len(proteins) + 1)).astype(np.int64)
+
+    np.save(os.path.join(index_dir, 'groups.npy'), np.array(group_names, dtype=bytes))
+    np.save(os.path.join(index_dir, 'proteins.npy'), proteins)
+    np.save(os.path.join(index_dir, 'protein_offsets.npy'), protein_offsets)
+    np.save(os.path.join(index_dir, 'protein_groups.npy'), member_groups[order])
+    np.save(os.path.join(index_dir, 'group_offsets.npy'), group_offsets)
+    np.save(os.path.join(index_dir, 'group_members.npy'), member_ids.astype(np.int32))
+    stat = os.stat(filepath)
+    with open(os.path.join(index_dir, 'index.json'), 'w') as out:
+        out.write(json.dumps({'source': os.path.basename(filepath), 'size': stat.st_size, 'mtime': stat.st_mtime}))
+
+
+def load_eggnog_index(filepath, index_dir=None):
+    """
+    Loads (memory-mapped) the inverted index of an EggNOG members file, building it first
+    if it does not exist or the members file changed since it was built
+
+    :param str filepath: path to the EggNOG groups file
+    :param str index_dir: path to the index directory (default: next to the members file)
+    :return: dictionary with the index arrays
+    """
+    if index_dir is None:
+        index_dir = get_index_dir(filepath)
+    meta_file = os.path.join(index_dir, 'index.json')
+    stat = os.stat(filepath)
+    meta = None
+    if os.path.isfile(meta_file):
+        with open(meta_file, 'r') as f:
+            meta = json.load(f)
+    if meta is None or meta['size'] != stat.st_size or meta['mtime'] != stat.st_mtime:
+        build_eggnog_index(filepath, index_dir)
+
+    index = {}
+    for name in ['groups', 'proteins', 'protein_offsets', 'protein_groups', 'group_offsets', 'group_members']:
+        index[name] = np.load(os.path.join(index_dir, name + '.npy'), mmap_mode='r')
+
+    return index
+
+
+@instrumentation.timed()
+def get_eggnog_groups(filepath, proteins, index_dir=None):
+    """
+    Obtains all the EggNOG groups which contains a list of given proteins
+    The lookup uses the inverted index of the members file, so it only costs time proportional to
+    the number of proteins queried and the members file is only parsed the first time.
+
+    :param str filepath: path to the EggNOG groups file
+    :param list proteins: list of Ensembl protein identifiers
+    :param str index_dir: path to the index directory (default: next to the members file)
+    :return: dictionary with all the valid EggNOG groups. Key -> group, value -> list proteins in the group
+    """
+    valid_groups = {}
+    index = load_eggnog_index(filepath, index_dir=index_dir)
+    width = index['proteins'].dtype.itemsize
+    # each protein is looked up once (first occurrence order, so the members of a group keep the order given)
+    query = [p.encode() for p in dict.fromkeys(proteins)]
+    query = np.array([p for p in query if len(p) <= width], dtype=index['proteins'].dtype)
+    if len(query) == 0 or len(index['proteins']) == 0:
+        return valid_groups
+
+    positions = np.searchsorted(index['proteins'], query)
+    positions[positions >= len(index['proteins'])] = 0
+    found = index['proteins'][positions] == query
+    query = query[found]
+    positions = positions[found]
+    starts = index['protein_offsets'][positions]
+    counts = index['protein_offsets'][positions + 1] - starts
+    # one entry per (protein, group) membership of the queried proteins
+    hits = np.repeat(np.arange(len(query)), counts)
+    within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    hit_groups = index['protein_groups'][np.repeat(starts, counts) + within]
+    order = np.lexsort((hits, hit_groups))
+    for group, protein in zip(hit_groups[order], query[hits[order]]):
+        name = index['groups'][group].decode()
+        if name not in valid_groups:
+            valid_groups[name] = []
+        valid_groups[name].append(protein.decode())
+
     return valid_groups
 
 
-def get_links(filepath, valid_groups, proteins, ouput_filepath, config_file):
+LINK_COLUMNS = ["taxid1", "taxid1_label", "source_color", "source_shape", "source", "source_name", \
+                "taxid2", "taxid2_label", "target_color", "target_shape", "target", "target_name", \
+                "experimental_evidence_score", "databases_evidence_score", "weight", \
+                "group1", "group2", "edge_type"]
+
+
+def split_groups(valid_groups, hosts, parasites):
+    """
+    Encodes proteins and groups as integer ids and splits the members of each group
+    into host and parasite proteins, so only host x parasite pairs need to be generated
+
+    :param dict valid_groups: dictionary with all the valid groups. Key -> group, value -> list of proteins
+    :param dict hosts: hosts section of the configuration file
+    :param dict parasites: parasites section of the configuration file
+    :return: tuple with the group names, the protein identifiers and two lists (one per group id)
+                with the host and parasite member ids
+    """
+    group_names = list(valid_groups.keys())
+    protein_ids = {}
+    host_members = []
+    parasite_members = []
+    for group in group_names:
+        host_ids = []
+        parasite_ids = []
+        for protein in valid_groups[group]:
+            taxid = int(protein.split('.')[0])
+            if taxid in hosts:
+                host_ids.append(protein_ids.setdefault(protein, len(protein_ids)))
+            elif taxid in parasites:
+                parasite_ids.append(protein_ids.setdefault(protein, len(protein_ids)))
+        host_members.append(np.array(host_ids, dtype=np.int32))
+        parasite_members.append(np.array(parasite_ids, dtype=np.int32))
+
+    return group_names, list(protein_ids.keys()), host_members, parasite_members
+
+
+GROUP_LINKS_SCHEMA = pa.schema([('group1', pa.string()), ('group2', pa.string()), ('experimental', pa.int32()), ('database', pa.int32())])
+
+
+@instrumentation.timed()
+def filter_group_links(filepath, output_file, cutoff=700, chunksize=1000000):
+    """
+    Reads the STRING links between EggNOG groups once, keeping only the links with enough experimental
+    or database evidence, and writes them as parquet (group1, group2, experimental, database), so the
+    links of every parasite are transferred without parsing the full STRING file again
+
+    :param str filepath: path to STRING file with the groups links
+    :param str output_file: path to the filtered links file
+    :param int cutoff: minimum experimental or database score (0-1000)
+    :param int chunksize: number of lines read at once
+    """
+    reader = pd.read_csv(filepath, sep=' ', header=0, usecols=[0, 1, 6, 7],
+                         names=['group1', 'group2', 'experimental', 'database'],
+                         dtype={'group1': str, 'group2': str, 'experimental': np.int32, 'database': np.int32},
+                         chunksize=chunksize)
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+    tmp_file = utils.get_tmp_path(output_file)
+    with pq.ParquetWriter(tmp_file, GROUP_LINKS_SCHEMA, compression='zstd') as writer:
+        for chunk in reader:
+            chunk = chunk[(chunk['experimental'] >= cutoff) | (chunk['database'] >= cutoff)]
+            writer.write_table(pa.Table.from_pandas(chunk, schema=GROUP_LINKS_SCHEMA, preserve_index=False))
+            instrumentation.add_rows(len(chunk))
+    os.replace(tmp_file, output_file)
+
+
+def read_group_links(filepath, group_names, cutoff=700, chunksize=1000000):
+    """
+    Reads the STRING links between EggNOG groups in chunks, keeping only the links
+    between valid groups with enough experimental or database evidence
+
+    :param str filepath: path to STRING file with the groups links or to the links filtered by filter_group_links (.parquet)
+    :param list group_names: valid group names (their position is used as group id)
+    :param int cutoff: minimum experimental or database score (0-1000)
+    :param int chunksize: number of lines read at once
+    :return: generator of dataframes with columns group1, group2 (group ids), experimental and database
+    """
+    group_index = pd.Index(group_names)
+    if filepath.endswith('.parquet'):
+        reader = (batch.to_pandas() for batch in pq.ParquetFile(filepath).iter_batches(batch_size=chunksize))
+    else:
+        reader = pd.read_csv(filepath, sep=' ', header=0, usecols=[0, 1, 6, 7],
+                             names=['group1', 'group2', 'experimental', 'database'],
+                             dtype={'group1': str, 'group2': str, 'experimental': np.int32, 'database': np.int32},
+                             chunksize=chunksize)
+    for chunk in reader:
+        chunk = chunk[(chunk['experimental'] >= cutoff) | (chunk['database'] >= cutoff)]
+        group1 = group_index.get_indexer(chunk['group1'])
+        group2 = group_index.get_indexer(chunk['group2'])
+        valid = (group1 >= 0) & (group2 >= 0)
+        yield pd.DataFrame({'group1': group1[valid], 'group2': group2[valid],
+                            'experimental': chunk['experimental'].values[valid],
+                            'database': chunk['database'].values[valid]})
+
+
+def get_members_csr(members):
+    """
+    Concatenates the member ids of each group (as returned by split_groups) in CSR format
+    :param list members: array of member ids of each group
+    :return: tuple with the offsets (one per group + 1) and the concatenated member ids
+    """
+    counts = np.array([len(m) for m in members], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    values = np.concatenate(members + [np.array([], dtype=np.int32)]).astype(np.int32)
+
+    return offsets, values
+
+
+def expand_links(group1, group2, host_csr, parasite_csr):
+    """
+    Generates the parasite x host protein pairs transferred by some group links (vectorised).
+    For each link, the pairs where group1 holds the host proteins come before the pairs where group2 does,
+    and within them the pairs are ordered by parasite and then host member.
+
+    :param ndarray group1: group id of the first group of each link
+    :param ndarray group2: group id of the second group of each link
+    :param tuple host_csr: offsets and host member ids of each group (see get_members_csr)
+    :param tuple parasite_csr: offsets and parasite member ids of each group (see get_members_csr)
+    :return: tuple of arrays (one entry per pair) with the link position, parasite protein, host protein, parasite group and host group
+    """
+    host_offsets, host_values = host_csr
+    parasite_offsets, parasite_values = parasite_csr
+    expanded = []
+    for direction, (host_group, parasite_group) in enumerate(((group1, group2), (group2, group1))):
+        n_hosts = host_offsets[host_group + 1] - host_offsets[host_group]
+        n_parasites = parasite_offsets[parasite_group + 1] - parasite_offsets[parasite_group]
+        counts = n_hosts * n_parasites
+        link = np.repeat(np.arange(len(group1), dtype=np.int64), counts)
+        within = np.arange(counts.sum(), dtype=np.int64) - np.repeat(np.cumsum(counts) - counts, counts)
+        n_hosts = n_hosts[link]
+        parasite = parasite_values[parasite_offsets[parasite_group[link]] + within // np.maximum(n_hosts, 1)]
+        host = host_values[host_offsets[host_group[link]] + within % np.maximum(n_hosts, 1)]
+        expanded.append((link * 2 + direction, parasite, host, parasite_group[link], host_group[link]))
+    order = np.argsort(np.concatenate([e[0] for e in expanded]), kind='stable')
+
+    return tuple(np.concatenate([e[i] for e in expanded])[order] for i in range(5))
+
+
+def get_score_columns(score_keys):
+    """
+    Evidence scores (as strings) of the links from their encoded experimental and database scores
+    :param ndarray score_keys: experimental * 1001 + database score (0-1000) of each link
+    :return: dictionary with the experimental, database and average score of each link
+    """
+    keys, codes = np.unique(score_keys, return_inverse=True)
+    columns = {'experimental_evidence_score': [], 'databases_evidence_score': [], 'weight': []}
+    for key in keys.tolist():
+        experimental_evidence = round(int(key // 1001)/1000, 3)
+        databases_evidence = round(int(key % 1001)/1000, 3)
+        average_score = round((experimental_evidence + databases_evidence) / 2, 3)
+        columns['experimental_evidence_score'].append(str(experimental_evidence))
+        columns['databases_evidence_score'].append(str(databases_evidence))
+        columns['weight'].append(str(average_score))
+
+    return {col: np.array(values, dtype=object)[codes] for col, values in columns.items()}
+
+
+@instrumentation.timed()
+def get_links(filepath, valid_groups, proteins, ouput_filepath, config_file, batch_size=500000):
     """
     Obtain the transferred interactions at the EggNOG group level from STRING
-    Writes into a file 'predictions.tsv' with the list of predicted links based on homology.
+    Writes into a file 'predictions.parquet' with the list of predicted links based on homology.
+    The predictions are generated as integer ids (protein, group and score) in batches of about batch_size
+    pairs, which are converted to strings and written as they are produced: only the sorted int64 keys of
+    the pairs already written are kept, so each parasite-host pair is written once, with the scores of the
+    first link that transfers it.
+    Order of the rows: by group link (as in the STRING file); within a link, the pairs where the first
+    group holds the host proteins come first, ordered by parasite and then host member. (Before the
+    predictions were streamed, the rows of a link were ordered by the members of group1 and then group2.)
     Structure of the file: 
     ["taxid1", "taxid1_label", "source_color", "source_shape", "source", "source_name", \
                             "taxid2", "taxid2_label", "target_color", "target_shape", "target", "target_name", \
                             "experimental_evidence_score", "databases_evidence_score", "weight", \
                             "group1", "group2", "edge_type"]
 
-    :param str filepath: path to STRING file with the groups links
+    :param str filepath: path to STRING file with the groups links (or the links filtered by filter_group_links)
     :param dict valid_groups: dictionary with all the valid groups
     :param dict proteins: mapping from ENSP to protein name
     :param str output_filepath: path to output file
     :param str config_file: path to the configuration file
+    :param int batch_size: number of predicted pairs generated and written at once
     """
-    links = []
-    seen = set()
-    cog_links = utils.read_gzipped_file(filepath)
     hosts = utils.read_config(filepath=config_file, field='hosts')
     parasites = utils.read_config(filepath=config_file, field='parasites')
-    first = True
-    cols = ["taxid1", "taxid1_label", "source_color", "source_shape", "source", "source_name", \
-                            "taxid2", "taxid2_label", "target_color", "target_shape", "target", "target_name", \
-                            "experimental_evidence_score", "databases_evidence_score", "weight", \
-                            "group1", "group2", "edge_type"]
-    i = 0
-    for line in cog_links:
-        if first:
-            first = False
-            continue
-        i += 1
-        data = line.decode("utf-8").rstrip().split(' ')
-        group1 = data[0]
-        group2 = data[1]
-        experimental_evidence = round(int(data[6])/1000, 3)
-        databases_evidence = round(int(data[7])/1000, 3)
-        
-        if group1 in valid_groups and group2 in valid_groups:
-            if experimental_evidence >= 0.7 or databases_evidence >= 0.7:
-                average_score = (experimental_evidence + databases_evidence) / 2
-                average_score = round(average_score, 3)
-                for protein1 in valid_groups[group1]:
-                    taxid1 = protein1.split('.')[0]
-                    for protein2 in valid_groups[group2]:
-                        taxid2 = protein2.split('.')[0]
-                        if int(taxid1) in hosts or int(taxid2) in hosts:
-                            if taxid1 != taxid2:
-                                if (protein1, protein2) not in seen:
-                                    if int(taxid1) in hosts:
-                                        target_taxid = taxid1
-                                        target_group = group1
-                                        target_protein = protein1
-                                        source_taxid = taxid2
-                                        source_group = group2
-                                        source_protein = protein2
-                                    else:
-                                        target_taxid = taxid2
-                                        target_group = group2
-                                        target_protein = protein2
-                                        source_taxid = taxid1
-                                        source_group = group1
-                                        source_protein = protein1
-                                    links.append([source_taxid, parasites[int(source_taxid)]['label'], 
-                                                parasites[int(source_taxid)]['color'], 'diamond', source_protein, 
-                                                proteins[source_protein],
-                                                target_taxid, hosts[int(target_taxid)]['label'], 
-                                                hosts[int(target_taxid)]['color'], 'dot', target_protein, 
-                                                proteins[target_protein],
-                                                str(experimental_evidence), str(databases_evidence), str(average_score), 
-                                                source_group, target_group, "inter-species"])
-                                    seen.add((protein1, protein2))
-                                    seen.add((protein2, protein1))
-    links_df = pd.DataFrame(links, columns=cols)
-    
-    utils.save_to_parquet(links_df, ouput_filepath)
\ No newline at end of file
+    group_names, protein_names, host_members, parasite_members = split_groups(valid_groups, hosts, parasites)
+    species = dict(hosts)
+    species.update(parasites)
+    taxids = [int(p.split('.')[0]) for p in protein_names]
+    protein_columns = {'taxid': np.array([str(t) for t in taxids], dtype=object),
+                       'label': np.array([species[t]['label'] for t in taxids], dtype=object),
+                       'color': np.array([species[t]['color'] for t in taxids], dtype=object),
+                       'protein': np.array(protein_names, dtype=object),
+                       'name': np.array([proteins[p] for p in protein_names], dtype=object)}
+    group_array = np.array(group_names, dtype=object)
+    schema = pa.schema([(col, pa.string()) for col in LINK_COLUMNS])
+    host_csr = get_members_csr(host_members)
+    parasite_csr = get_members_csr(parasite_members)
+    n_hosts = np.diff(host_csr[0])
+    n_parasites = np.diff(parasite_csr[0])
+    n_proteins = max(len(protein_names), 1)
+    # keys (parasite * number of proteins + host) of the pairs already written, sorted
+    seen = np.array([], dtype=np.int64)
+    with pq.ParquetWriter(ouput_filepath, schema, compression='gzip') as writer:
+        for links in read_group_links(filepath, group_names):
+            group1 = links['group1'].values
+            group2 = links['group2'].values
+            score_keys = links['experimental'].values.astype(np.int32) * 1001 + links['database'].values
+            # split the links so that each slice generates about batch_size pairs
+            counts = np.cumsum(n_hosts[group1] * n_parasites[group2] + n_hosts[group2] * n_parasites[group1])
+            bounds = np.unique(np.concatenate([[0], np.searchsorted(counts, np.arange(batch_size, counts[-1] if len(counts) > 0 else 0, batch_size)), [len(links)]]))
+            for start, end in zip(bounds[:-1], bounds[1:]):
+                link, source, target, source_group, target_group = expand_links(group1[start:end], group2[start:end], host_csr, parasite_csr)
+                keys = source.astype(np.int64) * n_proteins + target
+                # first occurrence of each pair in the batch (order kept) that was not written by a previous batch
+                rows = np.flatnonzero(~pd.Series(keys).duplicated(keep='first').values)
+                positions = np.searchsorted(seen, keys[rows])
+                rows = rows[seen[np.minimum(positions, len(seen) - 1)] != keys[rows]] if len(seen) > 0 else rows
+                if len(rows) == 0:
+                    continue
+                new_keys = np.sort(keys[rows])
+                seen = np.insert(seen, np.searchsorted(seen, new_keys), new_keys)
+                source = source[rows]
+                target = target[rows]
+                batch = {"taxid1": protein_columns['taxid'][source], "taxid1_label": protein_columns['label'][source],
+                        "source_color": protein_columns['color'][source], "source_shape": np.full(len(rows), 'diamond', dtype=object),
+                        "source": protein_columns['protein'][source], "source_name": protein_columns['name'][source],
+                        "taxid2": protein_columns['taxid'][target], "taxid2_label": protein_columns['label'][target],
+                        "target_color": protein_columns['color'][target], "target_shape": np.full(len(rows), 'dot', dtype=object),
+                        "target": protein_columns['protein'][target], "target_name": protein_columns['name'][target],
+                        "group1": group_array[source_group[rows]], "group2": group_array[target_group[rows]],
+                        "edge_type": np.full(len(rows), "inter-species", dtype=object)}
+                batch.update(get_score_columns(score_keys[start:end][link[rows] // 2]))
+                writer.write_batch(pa.RecordBatch.from_pydict({col: pa.array(batch[col], type=pa.string()) for col in LINK_COLUMNS}, schema=schema))
+                instrumentation.add_rows(len(rows))
@@ -1,13 +1,50 @@
 import os
+import json
+import hashlib
 import pandas as pd
 import utils
+import downloader
+import instrumentation
 
 
-def read_cell_types(config_file):
+HPA_COLUMNS = ['Gene', 'Gene name', 'Tissue', 'Cluster', 'Cell type', 'Read count', 'pTPM']
+TISSUES_MAPPING = {'heart muscle':'heart', 'small intestine':'intestine', 'rectum':'intestine', 'bronchus':'lung', 'colon':'intestine'}
+
+
+def get_valid_tissues(config_file):
+    """
+    Tissues relevant in OrthoHPI 2.0 as named in HPA (after mapping)
+    :param str config_file: path to the configuration file
+    :return: set of tissue names
+    """
+    tissues = utils.read_config(filepath=config_file, field='tissues')
+
+    return set(t.lower() for t in tissues.values())
+
+
+def reduce_max_ptpm(data):
+    """
+    Keeps the row with the highest pTPM for each gene, tissue and cell type (first one in case of ties)
+    :param DataFrame data: HPA single cell type data
+    :return: deduplicated dataframe
+    """
+    data = data.reset_index(drop=True)
+    rows = data.groupby(['Gene', 'Tissue', 'Cell type'], observed=True, sort=False)['pTPM'].idxmax()
+
+    return data.loc[rows.values]
+
+
+@instrumentation.timed()
+def read_cell_types(config_file, genes=None, cache_dir=os.path.join('data', 'hpa'), chunksize=1000000):
     '''
     Reads the HPA file containing cell type protein expression profiles
-    per tissue.
+    per tissue. The zipped file is streamed in chunks with only the needed columns, the rows of irrelevant
+    tissues (and genes, if given) or without expression are dropped in each chunk and only the highest pTPM
+    of each gene, tissue and cell type is kept. The result is cached keyed by the archive (see downloader.file_key).
     :param str config_file: path to the configuration file
+    :param list genes: Ensembl gene identifiers to keep (default: all)
+    :param str cache_dir: path to the directory where the parsed data is cached
+    :param int chunksize: number of lines read at once
     :return: pandas dataframe with the protein expression profiles for each tissue and cell type
     '''
     urls = utils.read_config(filepath=config_file, field='urls')
@@ -15,10 +52,34 @@ def read_cell_types(config_file):
     if 'hpa_single_cell_tissue_url' in urls:
         filename = utils.download_file(url=urls['hpa_single_cell_tissue_url'], data_dir='data')
 
+    valid_tissues = get_valid_tissues(config_file)
+    genes = None if genes is None else set(genes)
+    genes_key = None if genes is None else hashlib.sha1('|'.join(sorted(genes)).encode('utf-8')).hexdigest()
+    key = hashlib.sha1(json.dumps([downloader.file_key(filename), sorted(valid_tissues), genes_key]).encode('utf-8')).hexdigest()[:16]
+    cache_file = os.path.join(cache_dir, 'rna_single_cell_type_tissue.{}.parquet'.format(key))
+    if os.path.isfile(cache_file):
+        return pd.read_parquet(cache_file)
+
+    data = []
     hpa_file = utils.read_zipped_file(filepath=filename)
-    data = pd.read_csv(hpa_file, sep='\t', header=0)
-    data = data.sort_values(by='pTPM', ascending=False).drop_duplicates(['Gene', 'Tissue', 'Cell type'], keep='first')
-    data = data[data['pTPM'] > 0.0]
+    reader = pd.read_csv(hpa_file, sep='\t', header=0, usecols=lambda col: col in HPA_COLUMNS, chunksize=chunksize,
+                         dtype={'Gene': str, 'Gene name': str, 'Tissue': 'category', 'Cluster': 'category', 'Cell type': 'category'})
+    for chunk in reader:
+        keep = (chunk['pTPM'] > 0.0) & (chunk['Tissue'].astype(str).replace(TISSUES_MAPPING).isin(valid_tissues))
+        if genes is not None:
+            keep &= chunk['Gene'].isin(genes)
+        chunk = chunk.loc[keep].copy()
+        for col in ['Tissue', 'Cluster', 'Cell type']:
+            if col in chunk.columns:
+                chunk[col] = chunk[col].astype(str)
+        data.append(reduce_max_ptpm(chunk))
+    hpa_file.close()
+    data = pd.concat(data, ignore_index=True) if data else pd.DataFrame(columns=HPA_COLUMNS)
+    data = reduce_max_ptpm(data)
+    data = data.sort_values(by='pTPM', ascending=False, kind='stable').reset_index(drop=True)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    utils.save_to_parquet(data, cache_file)
     
     return data
 
@@ -30,13 +91,11 @@ def map_hpa_data(config_file, hpa_data):
     :param dataframe hpa_data: pandas dataframe with the single cell type data from HPA
     :return: mapped dataframe
     '''
-    aliases = utils.parse_string_aliases(config_file, sources=['Ensembl_gene'])
-    tissues_mapping = {'heart muscle':'heart', 'small intestine':'intestine', 'rectum':'intestine', 'bronchus':'lung', 'colon':'intestine'}
-    hpa_data = hpa_data.replace(tissues_mapping)
+    aliases = utils.get_alias_mapping(utils.read_string_aliases(config_file, sources=['Ensembl_gene']))
+    hpa_data = hpa_data.replace(TISSUES_MAPPING)
     hpa_data['Gene'] = hpa_data['Gene'].map(aliases)
     
-    tissues = utils.read_config(filepath=config_file, field='tissues')
-    hpa_data = hpa_data[hpa_data['Tissue'].isin([t.lower() for t in tissues.values()])]
+    hpa_data = hpa_data[hpa_data['Tissue'].isin(get_valid_tissues(config_file))]
     
     return hpa_data
 
@@ -47,8 +106,11 @@ def filter_valid_proteins(hpa_data, valid_proteins):
     return hpa_data
 
 
+@instrumentation.timed()
 def parse_hpa(config_file, valid_proteins):
-    data = read_cell_types(config_file=config_file)
+    aliases = utils.get_alias_mapping(utils.read_string_aliases(config_file, sources=['Ensembl_gene']))
+    genes = aliases.index[aliases.isin(set(valid_proteins))]
+    data = read_cell_types(config_file=config_file, genes=genes)
     data = map_hpa_data(config_file=config_file, hpa_data=data)
     data = filter_valid_proteins(data, valid_proteins=valid_proteins)
     
@@ -0,0 +1,286 @@
+import os
+import sys
+import json
+import time
+import resource
+import threading
+import functools
+import contextlib
+import cProfile
+from collections import deque
+
+# the settings are read from the environment so the worker processes of the pipeline inherit them
+LOG_ENV = 'ORTHOHPI_LOG'
+PROFILE_ENV = 'ORTHOHPI_PROFILE'
+PROFILER_ENV = 'ORTHOHPI_PROFILER'
+MAX_RECORDS = 10000
+
+# spans of the current thread (one rerun of a page or one run of the pipeline)
+_local = threading.local()
+_log_lock = threading.Lock()
+
+
+def configure(log=None, profile_dir=None, profiler=None):
+    """
+    Enables the structured logs and the profiling of the runs (settings also exported to the environment)
+    :param str log: path to the log file (JSON lines) or 'stderr'
+    :param str profile_dir: path to the directory where the profiles are dumped
+    :param str profiler: 'cprofile' (default) or 'pyinstrument'
+    """
+    for env, value in [(LOG_ENV, log), (PROFILE_ENV, profile_dir), (PROFILER_ENV, profiler)]:
+        if value is not None:
+            os.environ[env] = value
+
+
+def get_process_memory():
+    """
+    Memory used by the current process
+    :return: dictionary with the resident set size and its peak (bytes)
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    rss = None
+    if os.path.isfile('/proc/self/statm'):
+        with open('/proc/self/statm', 'r') as f:
+            rss = int(f.read().split()[1]) * resource.getpagesize()
+
+    return {'rss': rss, 'peak_rss': peak}
+
+
+def get_bytes_read():
+    """
+    Bytes read by the current process so far (all threads, including reads served by the page cache)
+    :return: number of bytes or None if the information is not available (only in Linux)
+    """
+    try:
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+
+    return None
+
+
+def get_size(result):
+    """
+    Number of rows in the result of a function (dataframes, dictionaries, lists, sets and arrays;
+    first element of tuples)
+    :param result: object returned by the function
+    :return: number of rows or None
+    """
+    if isinstance(result, tuple):
+        return get_size(result[0]) if len(result) > 0 else None
+    if isinstance(result, (str, bytes)) or not hasattr(result, '__len__'):
+        return None
+
+    return len(result)
+
+
+def get_records():
+    """
+    Spans finished in the current thread since the last reset (rerun)
+    :return: deque of span records
+    """
+    if not hasattr(_local, 'records'):
+        _local.records = deque(maxlen=MAX_RECORDS)
+        _local.stack = []
+        _local.origin = time.perf_counter()
+
+    return _local.records
+
+
+def emit(record):
+    """
+    Writes a record as a JSON line in the structured log (if enabled)
+    :param dict record: span or event record
+    """
+    log = os.environ.get(LOG_ENV)
+    if not log:
+        return
+    line = json.dumps(dict(record, time=round(time.time(), 3), pid=os.getpid()), default=str)
+    with _log_lock:
+        if log == 'stderr':
+            sys.stderr.write(line + '\n')
+            sys.stderr.flush()
+        else:
+            with open(log, 'a') as out:
+                out.write(line + '\n')
+
+
+@contextlib.contextmanager
+def span(name, **fields):
+    """
+    Times a named block of code. The record has the start (seconds since the rerun started), the elapsed seconds,
+    the rows processed (set by the block or with add_rows), the bytes read, the process resident memory after
+    the block and its peak so far. Spans can be nested (the parent is recorded).
+
+    :param str name: name of the span (i.e. homology.get_links or ppi.render_network)
+    :param fields: extra fields stored in the record
+    :return: the span record (a dictionary)
+    """
+    records = get_records()
+    stack = _local.stack
+    start = time.perf_counter()
+    record = {'event': 'span', 'name': name, 'parent': stack[-1]['name'] if stack else None, 'depth': len(stack), 'rows': None,
+              'start': round(start - getattr(_local, 'origin', start), 6)}
+    record.update(fields)
+    stack.append(record)
+    bytes_read = get_bytes_read()
+    memory = get_process_memory()
+    status = 'ok'
+    try:
+        yield record
+    except BaseException:
+        status = 'error'
+        raise
+    finally:
+        record['seconds'] = round(time.perf_counter() - start, 6)
+        end_bytes_read = get_bytes_read()
+        record['bytes_read'] = end_bytes_read - bytes_read if bytes_read is not None and end_bytes_read is not None else None
+        end_memory = get_process_memory()
+        record['rss'] = end_memory['rss']
+        record['rss_delta'] = end_memory['rss'] - memory['rss'] if memory['rss'] is not None else None
+        record['peak_rss'] = end_memory['peak_rss']
+        record['status'] = status
+        if stack and stack[-1] is record:
+            stack.pop()
+        records.append(record)
+        emit(record)
+
+
+def add_rows(rows):
+    """
+    Adds rows to the count of the innermost open span of the current thread
+    :param int rows: number of rows processed
+    """
+    stack = getattr(_local, 'stack', [])
+    if stack:
+        stack[-1]['rows'] = (stack[-1]['rows'] or 0) + int(rows)
+
+
+def timed(name=None):
+    """
+    Decorator that runs a function inside a span (named module.function by default). The rows are the
+    size of the result unless the function counts them with add_rows.
+
+    :param str name: name of the span
+    :return: decorator
+    """
+    def decorator(function):
+        span_name = name or '{}.{}'.format(function.__module__, function.__name__)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(span_name) as record:
+                result = function(*args, **kwargs)
+                if record['rows'] is None:
+                    record['rows'] = get_size(result)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def start_profiler():
+    """
+    Starts a profiler if profiling is enabled (PROFILE_ENV). pyinstrument is used if selected and installed,
+    cProfile otherwise
+    :return: tuple with the profiler kind and the profiler, or None
+    """
+    if not os.environ.get(PROFILE_ENV):
+        return None
+    if os.environ.get(PROFILER_ENV) == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+            profiler = Profiler()
+            profiler.start()
+            return 'pyinstrument', profiler
+        except ImportError:
+            emit({'event': 'profiler', 'name': 'pyinstrument', 'error': 'not installed', 'fallback': 'cprofile'})
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # only one profiler can be active at a time (i.e. another session of the web app is being profiled)
+        return None
+
+    return 'cprofile', profiler
+
+
+def stop_profiler(profiler, name):
+    """
+    Stops a profiler and dumps its results into the profiles directory (.prof for cProfile, .html for pyinstrument)
+    :param tuple profiler: profiler returned by start_profiler
+    :param str name: name of the profiled run (used in the file name)
+    :return: path to the profile file or None
+    """
+    if profiler is None:
+        return None
+    kind, profiler = profiler
+    profile_dir = os.environ.get(PROFILE_ENV)
+    os.makedirs(profile_dir, exist_ok=True)
+    filepath = os.path.join(profile_dir, '{}-{}-{}.{}'.format(name, os.getpid(), int(time.time() * 1000),
+                                                              'html' if kind == 'pyinstrument' else 'prof'))
+    if kind == 'pyinstrument':
+        profiler.stop()
+        with open(filepath, 'w') as out:
+            out.write(profiler.output_html())
+    else:
+        profiler.disable()
+        profiler.dump_stats(filepath)
+    emit({'event': 'profile', 'name': name, 'file': filepath})
+
+    return filepath
+
+
+@contextlib.contextmanager
+def profile(name):
+    """
+    Runs a block of code inside a span and, if profiling is enabled, under a profiler whose results are dumped
+    :param str name: name of the run
+    :return: the span record
+    """
+    profiler = start_profiler()
+    try:
+        with span(name) as record:
+            yield record
+    finally:
+        stop_profiler(profiler, name)
+
+
+def start_rerun(page):
+    """
+    Starts recording a new rerun of a page of the web app (discards the spans of the previous one
+    and starts the profiler if profiling is enabled)
+    :param str page: name of the page
+    """
+    previous = getattr(_local, 'rerun', None)
+    if previous is not None and previous['profiler'] is not None:
+        # the previous rerun was interrupted (i.e. by a widget change) before it finished
+        kind, profiler = previous['profiler']
+        if kind == 'pyinstrument':
+            profiler.stop()
+        else:
+            profiler.disable()
+    _local.records = deque(maxlen=MAX_RECORDS)
+    _local.stack = []
+    _local.origin = time.perf_counter()
+    _local.rerun = {'page': page, 'start': _local.origin, 'profiler': start_profiler()}
+
+
+def end_rerun():
+    """
+    Finishes the rerun of a page: logs its total time and dumps its profile (if enabled)
+    :return: dictionary with the page, the total seconds, the profile file and the spans of the rerun
+    """
+    rerun = getattr(_local, 'rerun', None)
+    if rerun is None:
+        return {'page': None, 'seconds': None, 'profile': None, 'spans': list(get_records())}
+    _local.rerun = None
+    seconds = round(time.perf_counter() - rerun['start'], 6)
+    profile_file = stop_profiler(rerun['profiler'], rerun['page'])
+    emit(dict({'event': 'rerun', 'name': rerun['page'], 'seconds': seconds}, **get_process_memory()))
+
+    return {'page': rerun['page'], 'seconds': seconds, 'profile': profile_file, 'spans': list(get_records())}
@@ -1,9 +1,18 @@
 import os
+import sys
 import homology
 import utils
 import filters
 import hpa
 import go
+import bundles
+import centrality
+import enrichment_store
+import downloader
+import pipeline
+import instrumentation
+import prediction_store
+import summaries
 import pandas as pd
    
 
@@ -21,8 +30,8 @@ def get_proteins(config_file):
         string_file = urls['string_protein_url']
         if hosts is not None and parasites is not None:
             taxids = list(hosts.keys()) + list(parasites.keys())
-            for taxid in taxids:
-                proteins[taxid] = parse_proteins(string_file, taxid)
+            results = utils.map_taxids(parse_proteins, taxids, workers=utils.get_workers(config_file), string_file=string_file)
+            proteins = dict(zip(taxids, results))
     
     return proteins
 
@@ -53,61 +62,169 @@ def parse_proteins(string_file, taxid):
     return proteins
 
 
-def get_tissue_cell_type_annotation(tissues, output_file):
-    tissues_df = pd.concat({k: pd.Series(v) for k, v in tissues.items()}).reset_index()
-    tissues_df = tissues_df.iloc[:, [0, 2]]
-    tissues_df.columns = ['Gene', 'Tissue']
-    tissues_df = tissues_df[tissues_df['Gene'].isin(proteins.keys())]
-    hpa_data = hpa.parse_hpa(config_file, valid_proteins=proteins.keys())
+def get_tissue_cell_type_annotation(config_file, tissues, proteins, output_file):
+    tissues_df = pd.DataFrame([(protein, tissue) for protein in tissues for tissue in tissues[protein]], columns=['Gene', 'Tissue'])
+    tissues_df = tissues_df[tissues_df['Gene'].isin(proteins)]
+    hpa_data = hpa.parse_hpa(config_file, valid_proteins=proteins)
     tissues_df = pd.merge(tissues_df, hpa_data, on=['Gene', 'Tissue'], how='left')
     
     utils.save_to_parquet(tissues_df, output_file)
 
 
-def setup(config_file, output_file_path):
+def get_download_urls(config_file):
     """
-    Downloads all necessary files according to the urls specified in the configuration file
-    except the protein files and host PPIs that are downloaded for each species. The go terms
-    will also be downloaded and formatted.
-    
+    Lists all the files needed by the pipeline according to the urls specified in the configuration file.
+    The urls with TAXID are expanded for each host and parasite, and the host tissue and compartment files are included.
+
     :param str config_file: path to the configuration file
+    :return: list of urls
     """
+    download_urls = []
     urls = utils.read_config(filepath=config_file, field='urls')
+    hosts = utils.read_config(filepath=config_file, field='hosts')
+    parasites = utils.read_config(filepath=config_file, field='parasites')
+    taxids = list(hosts.keys()) + list(parasites.keys())
     for url_name in urls:
         url = urls[url_name]
-        if url_name != "string_protein_url" and url_name != "string_ppi_url" and url_name != "string_go_url":
-            filename = utils.download_file(url=url, data_dir=output_file_path)
-    
-    go.get_gene_ontology(config_file, output_dir=output_file_path)
+        if url_name == "string_ppi_url":
+            continue
+        if 'TAXID' in url:
+            download_urls.extend([url.replace('TAXID', str(taxid)) for taxid in taxids])
+        else:
+            download_urls.append(url)
+    for taxid in hosts:
+        for url_name in ['tissues_url', 'compartments_url']:
+            if url_name in hosts[taxid]:
+                download_urls.append(hosts[taxid][url_name])
 
+    return download_urls
 
-if __name__ == "__main__":
-    data_dir = 'data'
-    config_file = 'config.yml'
+
+def setup(config_file, output_file_path):
+    """
+    Downloads all necessary files according to the urls specified in the configuration file,
+    including the protein, alias and GO files of each species, concurrently. Files already
+    downloaded are not downloaded again.
     
-    setup(config_file=config_file, output_file_path=data_dir)
+    :param str config_file: path to the configuration file
+    """
+    pipeline_config = utils.read_config(filepath=config_file, field='pipeline') or {}
+    downloader.download_all(get_download_urls(config_file), data_dir=output_file_path,
+                            workers=pipeline_config.get('download_workers', 4))
+
+
+def get_data_file(url, data_dir, taxid=None):
+    """
+    Local path of a downloaded file
+    :param str url: URL address of the file (with TAXID if it is species specific)
+    :param str data_dir: path to the data directory
+    :param int taxid: taxonomic identifier of the species
+    :return: path to the file
+    """
+    if taxid is not None:
+        url = url.replace('TAXID', str(taxid))
+
+    return os.path.join(data_dir, url.split('/')[-1])
+
+
+def save_proteins(proteins, output_file):
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    utils.save_to_parquet(pd.DataFrame({'protein': list(proteins.keys()), 'name': list(proteins.values())}), output_file)
 
+
+def read_proteins(input_file):
+    df = utils.read_parquet_file(input_file=input_file)
+
+    return dict(zip(df['protein'], df['name']))
+
+
+def run_host_filters(config_file, stage_dir, cutoff):
+    """
+    Stage: host proteins expressed in the tissues and compartments relevant for the parasites
+    :param str config_file: path to the configuration file
+    :param str stage_dir: path to the directory where the intermediate files are stored
+    :param float cutoff: minimum confidence score accepted (jensenlab)
+    """
     hosts = utils.read_config(filepath=config_file, field='hosts')
-    parasites = utils.read_config(filepath=config_file, field='parasites')
-    
-    #Get host and parasite proteins
-    proteins = get_proteins(config_file)
-
-    #Apply filters -- secretome, tissue, cellular compartment context
-    proteins = filters.get_secretome_predictions(config_file=config_file, secretome_dir='data/secretome_pred_input_data/input_data', valid_proteins=proteins)
-    tissues = filters.apply_tissue_filter(config_file, proteins, cutoff=2.5)
-    compartments = filters.apply_compartment_filter(config_file, proteins, cutoff=2.5)
-    proteins = utils.merge_dict_of_dicts(dict_of_dicts=proteins)
-    
-    #Annotate tissue and cell type expression
-    get_tissue_cell_type_annotation(tissues, output_file=os.path.join(data_dir, 'tissues_cell_types.parquet'))
-    
-    #Get eggnog groups and transfer PPIs
+    string_file = utils.read_config(filepath=config_file, field='urls')['string_protein_url']
+    proteins = dict(zip(hosts, utils.map_taxids(parse_proteins, hosts, workers=utils.get_workers(config_file), string_file=string_file)))
+    tissues, compartments = filters.apply_context_filters(config_file, proteins, cutoff=cutoff)
+    for taxid in hosts:
+        save_proteins(proteins[taxid], os.path.join(stage_dir, 'proteins', 'taxid={}.parquet'.format(taxid)))
+    tissues_df = pd.DataFrame([(protein, tissue) for protein in tissues for tissue in tissues[protein]], columns=['protein', 'tissue'])
+    utils.save_to_parquet(tissues_df, os.path.join(stage_dir, 'host_tissues.parquet'))
+
+
+def read_host_filters(config_file, stage_dir):
+    """
+    Results of the host filters stage
+    :param str config_file: path to the configuration file
+    :param str stage_dir: path to the directory where the intermediate files are stored
+    :return: tuple with the valid host proteins (key -> protein id, value -> protein name) and their tissues
+    """
+    hosts = utils.read_config(filepath=config_file, field='hosts')
+    proteins = {}
+    for taxid in hosts:
+        proteins.update(read_proteins(os.path.join(stage_dir, 'proteins', 'taxid={}.parquet'.format(taxid))))
+    tissues_df = utils.read_parquet_file(input_file=os.path.join(stage_dir, 'host_tissues.parquet'))
+    tissues = tissues_df.groupby('protein', sort=False)['tissue'].agg(list).to_dict()
+
+    return proteins, tissues
+
+
+def run_tissue_annotation(config_file, data_dir, stage_dir):
+    """
+    Stage: tissue and cell type expression (HPA) of the valid host proteins
+    :param str config_file: path to the configuration file
+    :param str data_dir: path to the data directory
+    :param str stage_dir: path to the directory where the intermediate files are stored
+    """
+    proteins, tissues = read_host_filters(config_file, stage_dir)
+    get_tissue_cell_type_annotation(config_file, tissues, proteins=list(proteins.keys()),
+                                    output_file=os.path.join(data_dir, 'tissues_cell_types.parquet'))
+
+
+def run_parasite_links(config_file, taxid, data_dir, stage_dir, secretome_dir):
+    """
+    Stage: interactions transferred between the hosts and one parasite (secreted or membrane proteins)
+    :param str config_file: path to the configuration file
+    :param int taxid: taxonomic identifier of the parasite
+    :param str data_dir: path to the data directory
+    :param str stage_dir: path to the directory where the intermediate files are stored
+    :param str secretome_dir: path to the directory where the secretome predictions are
+    """
+    string_file = utils.read_config(filepath=config_file, field='urls')['string_protein_url']
+    proteins, _ = read_host_filters(config_file, stage_dir)
+    proteins.update(filters.get_secreted_proteins(filters.get_secretome_file(secretome_dir, taxid),
+                                                  parse_proteins(string_file, taxid)))
     valid_groups = homology.get_eggnog_groups(filepath=os.path.join(data_dir, '2759_members.tsv.gz'), proteins=proteins.keys())
-    homology.get_links(filepath=os.path.join(data_dir, 'COG.links.detailed.v11.5.txt.gz'), valid_groups=valid_groups, proteins=proteins,
-              ouput_filepath=os.path.join(data_dir, 'predictions.parquet'), config_file=config_file)
+    output_file = get_links_file(stage_dir, taxid)
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    homology.get_links(filepath=get_group_links_file(stage_dir), valid_groups=valid_groups, proteins=proteins,
+                       ouput_filepath=output_file, config_file=config_file)
+
+
+def get_links_file(stage_dir, taxid):
+    return os.path.join(stage_dir, 'links', 'taxid1={}.parquet'.format(taxid))
+
+
+def get_group_links_file(stage_dir):
+    return os.path.join(stage_dir, 'group_links.parquet')
+
+
+def run_predictions(config_file, data_dir, stage_dir):
+    """
+    Stage: merges the interactions of all parasites (in the order of the configuration file), annotates their UniProt identifiers
+    and writes them also as a compact prediction store
+    :param str config_file: path to the configuration file
+    :param str data_dir: path to the data directory
+    :param str stage_dir: path to the directory where the intermediate files are stored
+    """
+    hosts = utils.read_config(filepath=config_file, field='hosts')
+    parasites = utils.read_config(filepath=config_file, field='parasites')
+    predictions = pd.concat([pd.read_parquet(get_links_file(stage_dir, taxid)) for taxid in parasites], ignore_index=True)
+    utils.save_to_parquet(df=predictions, output_file=os.path.join(data_dir, 'predictions.parquet'))
 
-    predictions = pd.read_parquet(os.path.join(data_dir, 'predictions.parquet'))
     predictions = utils.annotate_alias_id(predictions_df=predictions, 
                             taxids=list(parasites.keys()), config_file=config_file, 
                             sources=['BLAST_UniProt_AC'], new_col="source_uniprot", 
@@ -119,3 +236,131 @@ if __name__ == "__main__":
                             new_col="target_uniprot", mapping_col="target")
     
     utils.save_to_parquet(df=predictions, output_file=os.path.join(data_dir, 'annotated_predictions.parquet'))
+    prediction_store.build_store(predictions, store_dir=os.path.join(data_dir, 'prediction_store'))
+
+
+def run_home_summaries(data_dir):
+    """
+    Stage: aggregates shown in the Home page of the web app
+    :param str data_dir: path to the data directory
+    """
+    bundle_dir = os.path.join(data_dir, 'parasite_bundles')
+    predictions = prediction_store.read_predictions(os.path.join(data_dir, 'prediction_store'), columns=['taxid1', 'taxid1_label', 'target', 'weight'])
+    pred_tissues = pd.concat([bundles.read_parasite_bundle(bundle_dir, taxid) for taxid in bundles.get_bundle_taxids(bundle_dir)])
+    summaries.build_home_summaries(predictions, pred_tissues, summary_dir=os.path.join(data_dir, 'home_summaries'))
+
+
+def get_stages(config_file, data_dir, stage_dir, secretome_dir, cutoff=2.5):
+    """
+    Stages of the pipeline with the configuration and files that invalidate each of them.
+    The interactions are transferred for each parasite in its own stage, so adding or changing
+    a parasite only recomputes its interactions and the stages that merge them.
+
+    :param str config_file: path to the configuration file
+    :param str data_dir: path to the data directory
+    :param str stage_dir: path to the directory where the intermediate files are stored
+    :param str secretome_dir: path to the directory where the secretome predictions are
+    :param float cutoff: minimum confidence score accepted in the tissue and compartment filters (jensenlab)
+    :return: list of stage definitions (see pipeline.run_stages)
+    """
+    config = utils.read_config(config_file)
+    urls = config['urls']
+    hosts = config['hosts']
+    parasites = config['parasites']
+    taxids = list(hosts.keys()) + list(parasites.keys())
+    host_files = [get_data_file(hosts[taxid][url_name], data_dir) for taxid in hosts
+                  for url_name in ['tissues_url', 'compartments_url'] if url_name in hosts[taxid]]
+    alias_files = [get_data_file(urls['string_alias_url'], data_dir, taxid) for taxid in taxids]
+    stages = [{'name': 'gene_ontology',
+               'run': lambda: go.get_gene_ontology(config_file, output_dir=data_dir),
+               'params': {'urls': [urls.get('go_ontology_url'), urls.get('string_go_url')], 'taxids': taxids},
+               'inputs': [get_data_file(urls['go_ontology_url'], data_dir)] + [get_data_file(urls['string_go_url'], data_dir, taxid) for taxid in taxids],
+               'code': ['go.py', 'go_hierarchy.py', 'go_store.py', 'utils.py'],
+               'outputs': [os.path.join(data_dir, 'go_ontology.parquet'), os.path.join(data_dir, 'go_ontology_index.npz'),
+                           os.path.join(data_dir, 'go_annotations')]},
+              {'name': 'host_filters',
+               'run': lambda: run_host_filters(config_file, stage_dir, cutoff),
+               'params': {'hosts': hosts, 'tissues': config['tissues'], 'cutoff': cutoff,
+                          'valid_tissues': sorted(filters.get_valid_tissues(parasites)),
+                          'valid_compartments': sorted(filters.get_valid_compartments(parasites))},
+               'inputs': [get_data_file(urls['string_protein_url'], data_dir, taxid) for taxid in hosts] + host_files,
+               'code': ['main.py', 'filters.py', 'utils.py'],
+               'outputs': [os.path.join(stage_dir, 'host_tissues.parquet')] + [os.path.join(stage_dir, 'proteins', 'taxid={}.parquet'.format(taxid)) for taxid in hosts]},
+              {'name': 'tissue_annotation',
+               'run': lambda: run_tissue_annotation(config_file, data_dir, stage_dir),
+               'depends': ['host_filters'],
+               'params': {'tissues': config['tissues'], 'url': urls.get('hpa_single_cell_tissue_url')},
+               'inputs': [get_data_file(urls['hpa_single_cell_tissue_url'], data_dir)] + [get_data_file(urls['string_alias_url'], data_dir, taxid) for taxid in hosts],
+               'code': ['main.py', 'hpa.py', 'utils.py'],
+               'outputs': [os.path.join(data_dir, 'tissues_cell_types.parquet')]}]
+
+    # the group links are parsed once and shared by the stages of all the parasites
+    stages.append({'name': 'group_links',
+                   'run': lambda: homology.filter_group_links(os.path.join(data_dir, 'COG.links.detailed.v11.5.txt.gz'),
+                                                              output_file=get_group_links_file(stage_dir)),
+                   'inputs': [os.path.join(data_dir, 'COG.links.detailed.v11.5.txt.gz')],
+                   'code': ['homology.py'],
+                   'outputs': [get_group_links_file(stage_dir)]})
+    for taxid in parasites:
+        stages.append({'name': 'links:{}'.format(taxid),
+                       'run': lambda taxid=taxid: run_parasite_links(config_file, taxid, data_dir, stage_dir, secretome_dir),
+                       'depends': ['host_filters', 'group_links'],
+                       'params': {'parasite': parasites[taxid], 'hosts': hosts},
+                       'inputs': [get_data_file(urls['string_protein_url'], data_dir, taxid), filters.get_secretome_file(secretome_dir, taxid),
+                                  os.path.join(data_dir, '2759_members.tsv.gz')],
+                       'code': ['main.py', 'homology.py', 'filters.py', 'utils.py'],
+                       'outputs': [get_links_file(stage_dir, taxid)]})
+
+    stages.extend([{'name': 'predictions',
+                    'run': lambda: run_predictions(config_file, data_dir, stage_dir),
+                    'depends': ['links:{}'.format(taxid) for taxid in parasites],
+                    'params': {'taxids': taxids},
+                    'inputs': alias_files,
+                    'code': ['main.py', 'utils.py', 'prediction_store.py'],
+                    'outputs': [os.path.join(data_dir, 'predictions.parquet'), os.path.join(data_dir, 'annotated_predictions.parquet'),
+                                os.path.join(data_dir, 'prediction_store')]},
+                   {'name': 'parasite_bundles',
+                    'run': lambda: bundles.build_parasite_bundles(config_file, store_dir=os.path.join(data_dir, 'prediction_store'),
+                                                                  tissues_file=os.path.join(data_dir, 'tissues_cell_types.parquet'),
+                                                                  output_dir=os.path.join(data_dir, 'parasite_bundles')),
+                    'depends': ['predictions', 'tissue_annotation'],
+                    'params': {'parasites': {taxid: parasites[taxid]['tissues'] for taxid in parasites}, 'tissues': config['tissues']},
+                    'code': ['bundles.py', 'prediction_store.py', 'utils.py'],
+                    'outputs': [os.path.join(data_dir, 'parasite_bundles')]},
+                   {'name': 'home_summaries',
+                    'run': lambda: run_home_summaries(data_dir),
+                    'depends': ['predictions', 'parasite_bundles'],
+                    'code': ['main.py', 'summaries.py', 'prediction_store.py'],
+                    'outputs': [summaries.get_summary_path(os.path.join(data_dir, 'home_summaries'), name) for name in summaries.SUMMARY_FILES]},
+                   {'name': 'centralities',
+                    'run': lambda: centrality.precompute_centralities(config_file, bundle_dir=os.path.join(data_dir, 'parasite_bundles'),
+                                                                      output_file=os.path.join(data_dir, 'centralities.parquet')),
+                    'depends': ['parasite_bundles'],
+                    'params': {'web': config.get('web')},
+                    'code': ['centrality.py', 'bundles.py'],
+                    'outputs': [os.path.join(data_dir, 'centralities.parquet')]},
+                   {'name': 'enrichment',
+                    'run': lambda: enrichment_store.build_enrichment_store(bundle_dir=os.path.join(data_dir, 'parasite_bundles'),
+                                                                           go_dir=os.path.join(data_dir, 'go_annotations'),
+                                                                           output_dir=os.path.join(data_dir, 'enrichment')),
+                    'depends': ['parasite_bundles', 'gene_ontology'],
+                    'code': ['enrichment_store.py', 'enrichment.py', 'go_store.py', 'bundles.py', 'utils.py'],
+                    'outputs': [os.path.join(data_dir, 'enrichment')]}])
+
+    return stages
+
+
+if __name__ == "__main__":
+    data_dir = 'data'
+    config_file = 'config.yml'
+    stage_dir = os.path.join(data_dir, 'pipeline')
+    
+    # ORTHOHPI_LOG=stderr (or a file) logs the timings as JSON lines and ORTHOHPI_PROFILE=<directory> dumps a profile of the run
+    with instrumentation.profile('pipeline'):
+        with instrumentation.span('setup'):
+            setup(config_file=config_file, output_file_path=data_dir)
+
+        #Run the stages whose configuration, input files or code changed since the last run
+        pipeline.run_stages(get_stages(config_file, data_dir=data_dir, stage_dir=stage_dir,
+                                        secretome_dir='data/secretome_pred_input_data/input_data'),
+                            state_dir=stage_dir, force=sys.argv[1:])
@@ -1,5 +1,14 @@
+import os
 import utils
 import web_utils
+import datastore
+import bundles
+import centrality as centrality_service
+import enrichment as enrichment_engine
+import enrichment_store
+import go_hierarchy
+import go_store
+import instrumentation
 import streamlit as st
 import streamlit.components.v1 as components
 from st_aggrid import GridOptionsBuilder, AgGrid
@@ -9,6 +18,7 @@ from css import style
 from pyvis.network import Network
 import plotly.express as px
 
+instrumentation.start_rerun('ppi')
 style.load_css()
 page = web_utils.show_pages_menu(index=1)
 if page == "Home":
@@ -20,22 +30,18 @@ elif page == "About":
 
 #Initialize variables
 df_select = None
-net = None
+df_score = None
+network_graph = None
 selected_rows = []
 selected_terms = []
 enrichment_table = None
 enrichment = None
-path = 'data/tmp'
 
 # Read dataset
-config = utils.read_config('config.yml')
-predictions = utils.read_parquet_file(input_file='data/predictions.parquet')
-predictions['weight'] = predictions['weight'].astype(float)
-tissues = utils.read_parquet_file(input_file='data/tissues_cell_types.parquet')
-pred_tissues = pd.merge(predictions, tissues.rename({'Gene': 'target'}, axis=1), on='target', how='left')
-tissues = None
-predictions = None
-ontology = utils.read_parquet_file(input_file='data/go_ontology.parquet')
+with instrumentation.span('ppi.load_datasets'):
+    config = datastore.get_config('config.yml')
+    parasite_options = web_utils.get_parasite_options(config)
+    go_index = datastore.get_object('data/go_ontology.parquet', go_hierarchy.get_go_index, kind='go_index')
 
 
 def generate_tissue_filters(df):
@@ -48,62 +54,71 @@ def generate_cell_type_filters(df):
     
     return options
 
-@st.cache_data
-def get_enrichment(pred_df):
-    species = pred_df['taxid1'].unique().tolist() + pred_df['taxid2'].unique().tolist()
-    species = [int(s) for s in species]
-    go_df = utils.read_parquet_file(input_file='data/gos.parquet')
-    go_df = go_df[go_df['taxid'].isin(species)]
-    enrichment = utils.calculate_enrichment(pred_df, go_df)
+@st.cache_resource
+def get_go_term_index(species):
+    go_df = web_utils.load_go_annotations(species)
+
+    return enrichment_engine.build_term_index(go_df)
+
+@st.cache_data(max_entries=256)
+def get_live_enrichment(_pred_df, key):
+    # cached by the filters that generated the network (key) instead of hashing the whole dataframe
+    enrichment = utils.calculate_enrichment(_pred_df, term_index=get_go_term_index(enrichment_store.get_species(_pred_df)))
+
+    return enrichment
+
+@st.cache_data(max_entries=1024)
+def read_precomputed_enrichment(taxid, score, mtime):
+    return enrichment_store.read_enrichment('data/enrichment', taxid, score)
+
+def get_enrichment(pred_df, taxid, score, key, filtered):
+    # the pipeline precomputes the enrichment of the whole network at each step of the slider,
+    # only tissue and cell type selections (or outdated results) are computed live
+    enrichment = None
+    filepath = enrichment_store.get_enrichment_path('data/enrichment', taxid)
+    go_file = go_store.get_store_files(web_utils.GO_STORE_DIR)['metadata']
+    if not filtered and os.path.isfile(filepath) and os.path.isfile(go_file):
+        mtime = datastore.get_mtime(filepath)
+        if mtime >= datastore.get_mtime(bundles.get_bundle_path(web_utils.BUNDLE_DIR, taxid)) and mtime >= datastore.get_mtime(go_file):
+            enrichment = read_precomputed_enrichment(taxid, score, mtime)
+    if enrichment is None:
+        enrichment = get_live_enrichment(pred_df, key)
 
     return enrichment
 
 
-def get_enrichment_summary(enrichment_df, ontology_df):
-    df = ontology_df[(ontology_df['parent'].isin(enrichment_df['go_term'])) & (ontology_df['child'].isin(enrichment_df['go_term']))]
-    df = pd.merge(df.rename({'child':'go_term'}, axis=1), enrichment_df[['go_term', 'odds_ratio', 'fdr_bh']], on='go_term')
-    fig = px.treemap(df, path=['parent', 'go_term'], values='odds_ratio', height=900, hover_data=['fdr_bh', 'odds_ratio'])
+def get_enrichment_summary(enrichment_df, go_index):
+    df = enrichment_df[['go_term', 'odds_ratio', 'fdr_bh']].copy()
+    # each enriched term is shown under its nearest enriched ancestor (at the top level if it has none)
+    df['parent'] = go_hierarchy.get_nearest_ancestors(go_index, df['go_term'])
+    df['parent'] = df['parent'].fillna('')
+    fig = px.treemap(df, names='go_term', parents='parent', values='odds_ratio', height=900, hover_data=['fdr_bh', 'odds_ratio'])
 
     return fig
 
-def generate_graph(df, score):
-    G = nx.from_pandas_edgelist(df, 'source', 'target', 'weight')
-    colors = dict(df[['source', 'source_color']].drop_duplicates().values)
-    colors.update(dict(df[['target', 'target_color']].drop_duplicates().values))
-    nx.set_node_attributes(G, colors, 'color')
-    labels = dict(df[['source', 'source_name']].drop_duplicates().values)
-    labels.update(dict(df[['target', 'target_name']].drop_duplicates().values))
-    nx.set_node_attributes(G, labels, 'label')
-    shapes = dict(df[['source', 'source_shape']].drop_duplicates().values)
-    shapes.update(dict(df[['target', 'target_shape']].drop_duplicates().values))
-    nx.set_node_attributes(G, shapes, 'shape')
-    centrality = nx.betweenness_centrality(G, weight='weight')
-    max_centrality = max(list(centrality.values()))
-    sizes = {}
-    for k,v in centrality.items():
-        value = v*60/max_centrality
-        if value < 20:
-            value = 20
-        sizes[k] =  value
-    nx.set_node_attributes(G, sizes, 'size')
-    
+def get_precomputed_centrality(taxid, offset):
+    # the pipeline precomputes the centralities of the whole network at each step of the slider
+    # (as shown, the predictions above the score), only outdated results are computed live
+    filepath = 'data/centralities.parquet'
+    if not os.path.isfile(filepath) or datastore.get_mtime(filepath) < datastore.get_mtime(bundles.get_bundle_path(web_utils.BUNDLE_DIR, taxid)):
+        return None
 
-    rm_edges = [(n1, n2) for n1,n2,w in G.edges.data('weight') if w < score]
-    # remove filtered edges from graph G
-    G.remove_edges_from(rm_edges)
-    G.remove_nodes_from(list(nx.isolates(G)))
-
-    widths = {}
-    for n1,n2,w in df[['source', 'target', 'weight']].values:
-        value = v*0.5/0.9
-        if value < 0.05:
-            value = 0.05
-        widths[(n1, n2)] = value
-    nx.set_edge_attributes(G, widths, 'value')
-    nx.set_edge_attributes(G, '#999999', 'color')
-    
+    return centrality_service.read_precomputed(datastore.get_frame(filepath), taxid, offset)
+
+def render_network(G, height, repulsion=True):
+    def generate():
+        # Initiate PyVis network object
+        net = Network(height=height, width="100%", bgcolor='white', font_color='#555555')
+        # Take Networkx graph and translate it to a PyVis graph format
+        net.from_nx(G)
+        if repulsion:
+            # Generate network with specific layout settings
+            net.repulsion(node_distance=420, central_gravity=0.33,
+                            spring_length=110, spring_strength=0.10,
+                            damping=0.95)
+        return net.generate_html()
 
-    return G
+    return utils.get_graph_output(G, f'html-{height}-{repulsion}', generate)
 
 
 st.markdown("<h1 style='text-align: center; color: #023858;'>OrthoHPI 2.0</h1>", unsafe_allow_html=True)
@@ -111,7 +126,7 @@ st.markdown("<h3 style='text-align: center; color: #2b8cbe;'>Orthology Predictio
 
 
 # Define selection options
-parasite_list = ['<select>'] + pred_tissues['taxid1_label'].sort_values().unique().tolist()
+parasite_list = ['<select>'] + list(parasite_options.keys())
 
 st.markdown("<h3 style='text-align: center; color: black;'>Graph of predicted Host-Parasite PPIs</h3>", unsafe_allow_html=True)
 
@@ -131,61 +146,53 @@ with col2:
     if selected_parasite == "<select>":
         st.text('Choose 1 parasite to visualize the predicted PPI network')
     else:        
-        df_select = pred_tissues.loc[pred_tissues['taxid1_label'] == selected_parasite]
-        pred_tissues = None
-        df_select = web_utils.filter_tissues(config, df_select)
-        score = st.slider('Confidence score', 0.4, 0.9, 0.7)
-
-        tissues_options = generate_tissue_filters(df_select)
-        if len(tissues_options) > 0:
-            selected_tissues = st.multiselect('Select tissues to filter the predicted PPI', tissues_options)
-            if len(selected_tissues) > 0:
-                df_select = df_select[df_select['Tissue'].isin(selected_tissues)]
-                cell_type_options = generate_cell_type_filters(df_select)
-                if len(cell_type_options) > 0:
-                    selected_cell_types = st.multiselect('Select cell type to filter the predicted PPI', cell_type_options)
-                    if len(selected_cell_types) > 0 :
-                        df_select = df_select[df_select['Cell type'].isin(selected_cell_types)]
-
+        with instrumentation.span('ppi.load_and_filter') as record:
+            df_select = web_utils.load_parasite_bundle(parasite_options[selected_parasite])
+            score = st.slider('Confidence score', 0.4, 0.9, 0.7)
+            selected_tissues = []
+            selected_cell_types = []
+
+            tissues_options = generate_tissue_filters(df_select)
+            if len(tissues_options) > 0:
+                selected_tissues = st.multiselect('Select tissues to filter the predicted PPI', tissues_options)
+                if len(selected_tissues) > 0:
+                    df_select = df_select[df_select['Tissue'].isin(selected_tissues)]
+                    cell_type_options = generate_cell_type_filters(df_select)
+                    if len(cell_type_options) > 0:
+                        selected_cell_types = st.multiselect('Select cell type to filter the predicted PPI', cell_type_options)
+                        if len(selected_cell_types) > 0 :
+                            df_select = df_select[df_select['Cell type'].isin(selected_cell_types)]
+            # predictions above the score are the first rows (bundles are sorted by weight): a slice found with the
+            # offset index of the bundle, or a binary search if the rows were filtered by tissue
+            score_index = web_utils.load_score_index(parasite_options[selected_parasite]) if len(selected_tissues) == 0 else None
+            df_score = bundles.slice_by_score(df_select, score, score_index)
+            record['rows'] = len(df_score)
+
+        taxid = parasite_options[selected_parasite]
+        centrality_key = (taxid, score, tuple(sorted(selected_tissues)), tuple(sorted(selected_cell_types)),
+                          datastore.get_mtime(bundles.get_bundle_path(web_utils.BUNDLE_DIR, taxid)))
+        precomputed = None
+        if len(selected_tissues) == 0:
+            precomputed = get_precomputed_centrality(taxid, len(df_score))
 
         # Create networkx graph object from pandas dataframe
-        G = generate_graph(df_select, score)
+        G = centrality_service.generate_graph(df_score, centrality_key, settings=config.get('web'), precomputed=precomputed)
             
         st.text(f"Nodes: {len(G.nodes())}  Edges: {len(G.edges())}")
-
-        # Initiate PyVis network object
-        net = Network(height='1000px', width="100%", bgcolor='white', font_color='#555555')
-        # Take Networkx graph and translate it to a PyVis graph format
-        net.from_nx(G)
-        # Save other formats
-        utils.export_graph(G, filename=f'{selected_parasite}.graphml',
-                        format='graphml', output_dir=f'{path}')
-        utils.export_graph(G, filename=f'{selected_parasite}.json',
-                        format='cytoscape', output_dir=f'{path}')
+        network_graph = G
         G = None
-
-        # Generate network with specific layout settings
-        net.repulsion(node_distance=420, central_gravity=0.33,
-                        spring_length=110, spring_strength=0.10,
-                        damping=0.95)
-        
-        #net.show_buttons(filter_=['nodes'])
         
         
 with col3:
     st.write('')
 
 
-with st.container():
-    if net is not None:
-        html_data = ""
-        # Save and read graph as HTML file (on Streamlit Sharing)
-        net.save_graph(f'{path}/{selected_parasite}.html')
-        with open(f'{path}/{selected_parasite}.html','r',encoding='utf-8') as HtmlFile:
-            html_data = HtmlFile.read()
+with st.container(), instrumentation.span('ppi.render_network'):
+    if network_graph is not None:
+        # Render the graph as HTML in memory (cached by graph content)
+        html_data = render_network(network_graph, height='1000px')
         # Load HTML into HTML component for display on Streamlit
         components.html(html_data, height=1050)
-        net = None
         with st.container():
             c1, c2, c3 = st.columns(3)
 
@@ -197,26 +204,26 @@ with st.container():
                     mime='text/html',
                 )
             with c2:
+                # Exports are only generated when the download is requested
                 st.download_button(
                     label="Download Network as GraphML",
-                    data=open(f'{path}/{selected_parasite}.graphml','r',encoding='utf-8'),
+                    data=lambda graph=network_graph: utils.export_graph(graph, format='graphml'),
                     file_name=f'{selected_parasite}_network.graphml',
                     mime='text/plain',
                 )
             with c3:
                 st.download_button(
                     label="Download Network as Cytoscape",
-                    data=open(f'{path}/{selected_parasite}.json','r',encoding='utf-8'),
+                    data=lambda graph=network_graph: utils.export_graph(graph, format='cytoscape'),
                     file_name=f'{selected_parasite}_network.json',
                     mime='text/plain',
                 )
 
 
-with st.container():
+with st.container(), instrumentation.span('ppi.table'):
     if df_select is not None:
         st.header("Table of Host-Parasite PPIs")
-        table = df_select[df_select['weight'] >= score]
-        table = table.sort_values(by='weight', ascending=False)
+        table = df_score
         gb = GridOptionsBuilder.from_dataframe(table)
         gb.configure_pagination(paginationAutoPageSize=True) #Add pagination
         gb.configure_side_bar() #Add a sidebar
@@ -237,10 +244,12 @@ with st.container():
             mime='text/csv',
         )
 
-with st.container():
+with st.container(), instrumentation.span('ppi.enrichment'):
     if df_select is not None:
         st.header("Network Functional Enrichment -- GO Biological Processes")
-        enrichment = get_enrichment(df_select[df_select['weight'] >= score])
+        with instrumentation.span('ppi.calculate_enrichment') as record:
+            enrichment = get_enrichment(df_score, taxid, score, centrality_key, filtered=len(selected_tissues) > 0)
+            record['rows'] = len(enrichment)
         if not enrichment.empty:
             fdr = st.radio("FDR BH correction",(0.01, 0.05, 0.1), horizontal=True)
             st.text(f"Terms enriched: {len(enrichment[enrichment['fdr_bh'] <= fdr]['go_term'].values.tolist())}")
@@ -272,7 +281,7 @@ with st.container():
             st.subheader("No GO terms where found enriched")
 
 go1, go2 = st.columns(2)
-with st.container():
+with st.container(), instrumentation.span('ppi.enrichment_plots'):
     if enrichment_table is not None:
         enrichment_viz = enrichment_table
         if selected_rows is not None and len(selected_rows) > 0:
@@ -292,19 +301,12 @@ with st.container():
                     highlighted_nodes = enrichment[enrichment['go_term'].isin(selected_terms)]['nodes'].values
                     highlighted_nodes = utils.merge_list_of_lists([i.split(',') for i in highlighted_nodes])
                     highlight_color = {i: '#e7298a' for i in highlighted_nodes}
-                    G = generate_graph(df_select, score)
+                    G = centrality_service.generate_graph(df_score, centrality_key, settings=config.get('web'), precomputed=precomputed)
                     nx.set_node_attributes(G, "#ddd", 'color')
                     nx.set_node_attributes(G, highlight_color, 'color')
-                    # Initiate PyVis network object
-                    net = Network(height="450px", width="100%", bgcolor='white', font_color='#555555')
-                    # Take Networkx graph and translate it to a PyVis graph format
-                    net.from_nx(G)
+                    html_data = render_network(G, height="450px", repulsion=False)
                     G = None
-                    net.save_graph(f'{path}/{selected_parasite}2.html')
-                    net = None
                     st.subheader("Highlighted Nodes for Selected Biological Processes")
-                    with open(f'{path}/{selected_parasite}2.html','r',encoding='utf-8') as HtmlFile:
-                        html_data = HtmlFile.read()
                     components.html(html_data, height=500)
                     st.download_button(
                         label="Download Network as Html",
@@ -313,7 +315,8 @@ with st.container():
                         mime='text/html',
                     )
         
-        fig = get_enrichment_summary(enrichment_table, ontology)
+        with instrumentation.span('ppi.go_summary'):
+            fig = get_enrichment_summary(enrichment_table, go_index)
         st.subheader("Visual Summary of Enriched Hierarchy of Biological Processes")
         st.plotly_chart(fig, use_container_width=True)
 
@@ -322,4 +325,6 @@ st.markdown("---")
 
 # Footer
 with st.container():
-    web_utils.footer()
\ No newline at end of file
+    web_utils.footer()
+
+web_utils.show_diagnostics()
@@ -1,12 +1,14 @@
-import utils
 import web_utils
+import datastore
+import bundles
+import instrumentation
 from css import style
-import pandas as pd
 import streamlit as st
 from stmol import showmol
 import structure_visualizer as strv
 from st_aggrid import GridOptionsBuilder, AgGrid
 
+instrumentation.start_rerun('structures')
 style.load_css()
 page = web_utils.show_pages_menu(index=2)
 if page == "Home":
@@ -18,7 +20,10 @@ elif page == "About":
 
 
 def get_structures(query_proteins):
-    structures = strv.get_alphafold_structure(query_proteins=query_proteins)
+    settings = config.get('web') or {}
+    structures = strv.get_alphafold_structure(query_proteins=query_proteins,
+                                              version=settings.get('alphafold_model_version', strv.MODEL_VERSION),
+                                              max_bytes=settings.get('alphafold_cache_mb', 200) * 1024 * 1024)
     
     return structures
 
@@ -27,14 +32,9 @@ def show_structure(pdb_file):
     showmol(xyzview, height = 500,width=700)
 
 
-config = utils.read_config('config.yml')
-predictions = utils.read_parquet_file(input_file='data/annotated_predictions.parquet')
-predictions['weight'] = predictions['weight'].astype(float)
-tissues = utils.read_parquet_file(input_file='data/tissues_cell_types.parquet')
-pred_tissues = pd.merge(predictions, tissues.rename({'Gene': 'target'}, axis=1), on='target', how='left')
-tissues = None
-predictions = None
-parasite_list = ['<select>'] + pred_tissues['taxid1_label'].sort_values().unique().tolist()
+config = datastore.get_config('config.yml')
+parasite_options = web_utils.get_parasite_options(config)
+parasite_list = ['<select>'] + list(parasite_options.keys())
 
 
 st.markdown("<h1 style='text-align: center; color: #023858;'>OrthoHPI 2.0</h1>", unsafe_allow_html=True)
@@ -65,33 +65,37 @@ with col3:
         
 if selected_cols is not None:    
     with st.container():
-        df_select = pred_tissues.loc[pred_tissues['taxid1_label'] == selected_parasite]
-        df_select = web_utils.filter_tissues(config, df_select)
-        df_select = df_select[df_select['weight'] >= score]
-        df_select = df_select[selected_cols].drop_duplicates(['source_name', 'target_name'])
-
-
-        gb = GridOptionsBuilder.from_dataframe(df_select)
-        gb.configure_pagination(paginationAutoPageSize=True) #Add pagination
-        gb.configure_side_bar() #Add a sidebar
-        gb.configure_selection('single', use_checkbox=True, 
-                groupSelectsChildren="Group checkbox select children") #Enable multi-row selection
-        gridOptions = gb.build()
-        grid_response = AgGrid(
-                            df_select,
-                            gridOptions=gridOptions,
-                            data_return_mode='AS_INPUT',
-                            update_mode='MODEL_CHANGED',
-                            fit_columns_on_grid_load=False,
-                            enable_enterprise_modules=True,
-                            height=350,
-                            reload_data=False
-                        )
-        selected_rows = grid_response['selected_rows']
+        with instrumentation.span('structures.load_and_filter') as record:
+            df_select = web_utils.load_parasite_bundle(parasite_options[selected_parasite])
+            df_select = bundles.slice_by_score(df_select, score, web_utils.load_score_index(parasite_options[selected_parasite]))
+            df_select = df_select[selected_cols].drop_duplicates(['source_name', 'target_name'])
+            record['rows'] = len(df_select)
+
+
+        with instrumentation.span('structures.table'):
+            gb = GridOptionsBuilder.from_dataframe(df_select)
+            gb.configure_pagination(paginationAutoPageSize=True) #Add pagination
+            gb.configure_side_bar() #Add a sidebar
+            gb.configure_selection('single', use_checkbox=True, 
+                    groupSelectsChildren="Group checkbox select children") #Enable multi-row selection
+            gridOptions = gb.build()
+            grid_response = AgGrid(
+                                df_select,
+                                gridOptions=gridOptions,
+                                data_return_mode='AS_INPUT',
+                                update_mode='MODEL_CHANGED',
+                                fit_columns_on_grid_load=False,
+                                enable_enterprise_modules=True,
+                                height=350,
+                                reload_data=False
+                            )
+            selected_rows = grid_response['selected_rows']
         if selected_rows is not None and len(selected_rows) > 0:
             query_proteins = dict(selected_rows[['source_name', 'source_uniprot']].values)
             query_proteins.update(dict(selected_rows[['target_name', 'target_uniprot']].values))
-            structures = get_structures(query_proteins)
+            with instrumentation.span('structures.alphafold') as record:
+                structures = get_structures(query_proteins)
+                record['rows'] = len(structures)
             cols = st.columns(2)
             i = 0
             for protein in structures:
@@ -118,4 +122,6 @@ st.markdown("---")
 
 # Footer
 with st.container():
-    web_utils.footer()
\ No newline at end of file
+    web_utils.footer()
+
+web_utils.show_diagnostics()
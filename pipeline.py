@@ -0,0 +1,157 @@
+import os
+import json
+import time
+import hashlib
+import downloader
+import instrumentation
+
+STATE_FILE = 'state.json'
+
+
+def read_state(state_dir):
+    """
+    Reads the fingerprints of the stages executed in previous runs
+    :param str state_dir: path to the directory where the pipeline state is stored
+    :return: dictionary. Key -> stage name, value -> fingerprint, outputs and time when it was executed
+    """
+    state_path = os.path.join(state_dir, STATE_FILE)
+    state = {}
+    if os.path.isfile(state_path):
+        with open(state_path, 'r') as f:
+            state = json.load(f)
+
+    return state
+
+
+def write_state(state_dir, state):
+    """
+    Stores the fingerprints of the executed stages (atomic write)
+    :param str state_dir: path to the directory where the pipeline state is stored
+    :param dict state: fingerprints of the stages
+    """
+    os.makedirs(state_dir, exist_ok=True)
+    tmp_path = os.path.join(state_dir, STATE_FILE + '.tmp')
+    with open(tmp_path, 'w') as out:
+        out.write(json.dumps(state, indent=2, sort_keys=True))
+    os.replace(tmp_path, os.path.join(state_dir, STATE_FILE))
+
+
+def code_version(modules):
+    """
+    Version of the code run by a stage: hash of the source files it uses
+    :param list modules: paths to the source files (i.e. homology.py)
+    :return: hexadecimal digest
+    """
+    sha = hashlib.sha256()
+    for module in sorted(modules):
+        sha.update(module.encode('utf-8'))
+        with open(module, 'rb') as f:
+            sha.update(f.read())
+
+    return sha.hexdigest()
+
+
+def file_checksum(filepath):
+    """
+    Checksum of an input file (None if the file does not exist yet)
+    :param str filepath: path to the file
+    :return: hexadecimal digest or None
+    """
+    if not os.path.isfile(filepath):
+        return None
+
+    return downloader.checksum(filepath)
+
+
+def get_fingerprint(stage, fingerprints):
+    """
+    Fingerprint of a stage: hash of its parameters (the configuration it uses), the checksums of its
+    input files, the version of its code and the fingerprints of the stages it depends on
+
+    :param dict stage: stage definition
+    :param dict fingerprints: fingerprints of the stages already evaluated
+    :return: hexadecimal digest
+    """
+    content = {'params': stage.get('params'),
+               'inputs': {filepath: file_checksum(filepath) for filepath in stage.get('inputs', [])},
+               'code': code_version(stage.get('code', [])),
+               'depends': {name: fingerprints[name] for name in stage.get('depends', [])}}
+    content = json.dumps(content, sort_keys=True, default=str)
+
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def sort_stages(stages):
+    """
+    Orders the stages so each one runs after the stages it depends on (keeps the given order otherwise)
+    :param list stages: stage definitions
+    :return: list of stages in execution order
+    """
+    names = {stage['name']: stage for stage in stages}
+    ordered = []
+    visiting = set()
+    done = set()
+
+    def visit(stage):
+        if stage['name'] in done:
+            return
+        if stage['name'] in visiting:
+            raise ValueError("Cyclic dependency in stage {}".format(stage['name']))
+        visiting.add(stage['name'])
+        for name in stage.get('depends', []):
+            if name not in names:
+                raise ValueError("Stage {} depends on unknown stage {}".format(stage['name'], name))
+            visit(names[name])
+        visiting.discard(stage['name'])
+        done.add(stage['name'])
+        ordered.append(stage)
+
+    for stage in stages:
+        visit(stage)
+
+    return ordered
+
+
+def run_stages(stages, state_dir, force=None):
+    """
+    Runs a pipeline defined as a DAG of stages. Each stage is a dictionary with:
+        name: unique name of the stage
+        run: function executed by the stage (no arguments)
+        depends: names of the stages it depends on
+        params: configuration used by the stage (only the relevant part)
+        inputs: input files (their checksums are part of the fingerprint)
+        code: source files of the code run by the stage
+        outputs: files generated by the stage
+    A stage is only executed if its fingerprint changed since the last run or any of its outputs is missing.
+    A stage whose dependencies were executed is executed too, as their fingerprints are part of its own.
+
+    :param list stages: stage definitions
+    :param str state_dir: path to the directory where the pipeline state is stored
+    :param list force: names of the stages to execute even if they are up to date
+    :return: dictionary with the stages executed. Key -> stage name, value -> seconds
+    """
+    force = set(force or [])
+    state = read_state(state_dir)
+    fingerprints = {}
+    executed = {}
+    for stage in sort_stages(stages):
+        name = stage['name']
+        fingerprint = get_fingerprint(stage, fingerprints)
+        fingerprints[name] = fingerprint
+        previous = state.get(name, {})
+        outputs = stage.get('outputs', [])
+        if name not in force and previous.get('fingerprint') == fingerprint and all(os.path.exists(o) for o in outputs):
+            print("Stage {} is up to date".format(name))
+            continue
+
+        print("Running stage {}".format(name))
+        with instrumentation.span('stage:{}'.format(name)) as record:
+            stage['run']()
+        executed[name] = record['seconds']
+        print("Stage {} done in {:.1f} s (peak memory {:.0f} MB)".format(name, record['seconds'], record['peak_rss'] / 1024 ** 2))
+        # the fingerprint is taken again after running, as stages may generate their own inputs (i.e. downloads)
+        fingerprints[name] = get_fingerprint(stage, fingerprints)
+        state[name] = {'fingerprint': fingerprints[name], 'outputs': outputs, 'time': time.time()}
+        write_state(state_dir, state)
+
+    return executed
@@ -0,0 +1,155 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import homology
+import utils
+
+STORE_VERSION = 1
+SCORE_COLUMNS = ['experimental_evidence_score', 'databases_evidence_score', 'weight']
+# wide columns obtained from the proteins (p) and species (s) dimensions of the source and target of each link
+DIMENSION_COLUMNS = {'taxid1': ('source', 's', 'taxid'), 'taxid1_label': ('source', 's', 'label'),
+                     'source_color': ('source', 's', 'color'), 'source_shape': ('source', 's', 'shape'),
+                     'source': ('source', 'p', 'protein'), 'source_name': ('source', 'p', 'name'),
+                     'source_uniprot': ('source', 'p', 'uniprot'),
+                     'taxid2': ('target', 's', 'taxid'), 'taxid2_label': ('target', 's', 'label'),
+                     'target_color': ('target', 's', 'color'), 'target_shape': ('target', 's', 'shape'),
+                     'target': ('target', 'p', 'protein'), 'target_name': ('target', 'p', 'name'),
+                     'target_uniprot': ('target', 'p', 'uniprot')}
+
+
+def get_store_files(store_dir):
+    """
+    Files of a prediction store
+    :param str store_dir: path to the prediction store
+    :return: dictionary with the path of the links (fact table), proteins, species and groups tables and the metadata
+    """
+    return {name: os.path.join(store_dir, name + ('.json' if name == 'metadata' else '.parquet'))
+            for name in ['links', 'proteins', 'species', 'groups', 'metadata']}
+
+
+def build_store(predictions_df, store_dir):
+    """
+    Writes the predictions (wide format generated by homology.get_links, optionally annotated with
+    source_uniprot and target_uniprot) as a compact store:
+        links.parquet: one row per prediction with integer protein, species and group ids and float32 scores
+        proteins.parquet: protein id, STRING identifier, name, UniProt accession and taxid
+        species.parquet: taxid, label, color and node shape
+        groups.parquet: group id and EggNOG group name
+        metadata.json: edge types and version of the store
+    The store is written to a temporary directory and moved into place once complete.
+
+    :param DataFrame predictions_df: predictions in wide format
+    :param str store_dir: path to the prediction store
+    """
+    df = predictions_df
+    n = len(df)
+    protein_codes, protein_names = pd.factorize(pd.concat([df['source'], df['target']], ignore_index=True).astype(str))
+    first = pd.Series(np.arange(2 * n)).groupby(protein_codes).first().values if n > 0 else np.array([], dtype=np.int64)
+    sides = {'name': pd.concat([df['source_name'], df['target_name']], ignore_index=True),
+             'taxid': pd.concat([df['taxid1'], df['taxid2']], ignore_index=True).astype(int)}
+    if 'source_uniprot' in df.columns and 'target_uniprot' in df.columns:
+        sides['uniprot'] = pd.concat([df['source_uniprot'], df['target_uniprot']], ignore_index=True)
+    proteins = pd.DataFrame({'protein_id': np.arange(len(protein_names), dtype=np.int32), 'protein': np.asarray(protein_names, dtype=object)})
+    for col, values in sides.items():
+        proteins[col] = values.iloc[first].values
+    proteins['taxid'] = proteins['taxid'].astype(np.int32)
+
+    species = pd.concat([pd.DataFrame({'taxid': df['taxid1'].astype(int), 'label': df['taxid1_label'],
+                                       'color': df['source_color'], 'shape': df['source_shape']}),
+                         pd.DataFrame({'taxid': df['taxid2'].astype(int), 'label': df['taxid2_label'],
+                                       'color': df['target_color'], 'shape': df['target_shape']})])
+    species = species.drop_duplicates(subset='taxid').astype({'taxid': np.int32}).reset_index(drop=True)
+
+    group_codes, group_names = pd.factorize(pd.concat([df['group1'], df['group2']], ignore_index=True))
+    groups = pd.DataFrame({'group_id': np.arange(len(group_names), dtype=np.int32), 'group': np.asarray(group_names, dtype=object)})
+    edge_codes, edge_types = pd.factorize(df['edge_type'])
+
+    links = pd.DataFrame({'taxid1': df['taxid1'].astype(np.int32).values, 'source': protein_codes[:n].astype(np.int32),
+                          'taxid2': df['taxid2'].astype(np.int32).values, 'target': protein_codes[n:].astype(np.int32)})
+    for col in SCORE_COLUMNS:
+        links[col] = df[col].astype(np.float32).values
+    links['group1'] = group_codes[:n].astype(np.int32)
+    links['group2'] = group_codes[n:].astype(np.int32)
+    links['edge_type'] = edge_codes.astype(np.int8)
+
+    tmp_dir = utils.get_tmp_path(store_dir)
+    os.makedirs(tmp_dir)
+    files = get_store_files(tmp_dir)
+    links.to_parquet(files['links'], index=False, compression='zstd')
+    proteins.to_parquet(files['proteins'], index=False, compression='zstd')
+    species.to_parquet(files['species'], index=False)
+    groups.to_parquet(files['groups'], index=False)
+    with open(files['metadata'], 'w') as out:
+        out.write(json.dumps({'version': STORE_VERSION, 'rows': n, 'edge_types': list(edge_types)}))
+    utils.replace_dir(tmp_dir, store_dir)
+
+
+def encode_attribute(values, codes):
+    """
+    Categorical column with the attribute of a dimension for each row of the fact table
+    (categories sorted, so sorting the column gives the same order as sorting the strings)
+    :param Series values: attribute of each dimension id (position = id)
+    :param ndarray codes: dimension id of each row
+    :return: categorical
+    """
+    attribute_codes, categories = pd.factorize(values, sort=True, use_na_sentinel=True)
+
+    return pd.Categorical.from_codes(attribute_codes[codes], categories=categories)
+
+
+def read_predictions(store_dir, columns=None, taxids=None):
+    """
+    Reads the predictions from the store in the wide format of predictions.parquet. Only the requested
+    columns are rebuilt and string columns are categoricals over the dimension tables, so they take
+    little memory. Scores are floats (rounded to 3 decimals, as computed) instead of strings and the
+    taxids are kept as strings, as in the wide format.
+
+    :param str store_dir: path to the prediction store
+    :param list columns: wide columns to read (default: all the columns available)
+    :param list taxids: taxonomic identifiers of the parasites to read (default: all)
+    :return: dataframe
+    """
+    files = get_store_files(store_dir)
+    with open(files['metadata'], 'r') as f:
+        metadata = json.load(f)
+    proteins = pd.read_parquet(files['proteins'])
+    if columns is None:
+        columns = list(homology.LINK_COLUMNS)
+        if 'uniprot' in proteins.columns:
+            columns += ['source_uniprot', 'target_uniprot']
+    fact_columns = set()
+    for col in columns:
+        fact_columns.add(DIMENSION_COLUMNS[col][0] if col in DIMENSION_COLUMNS else col)
+    filters = [('taxid1', 'in', [int(t) for t in taxids])] if taxids is not None else None
+    links = pq.read_table(files['links'], columns=sorted(fact_columns), filters=filters).to_pandas()
+
+    df = pd.DataFrame(index=pd.RangeIndex(len(links)))
+    species = None
+    groups = None
+    for col in columns:
+        if col in DIMENSION_COLUMNS:
+            side, dimension, attribute = DIMENSION_COLUMNS[col]
+            codes = links[side].values
+            if dimension == 's':
+                if species is None:
+                    species = pd.read_parquet(files['species']).set_index('taxid')
+                # protein id -> position of its species in the species table
+                codes = species.index.get_indexer(proteins['taxid'].values)[codes]
+                values = species.index.astype(str).to_series() if attribute == 'taxid' else species[attribute]
+            else:
+                values = proteins[attribute]
+            df[col] = encode_attribute(values.reset_index(drop=True), codes)
+        elif col in SCORE_COLUMNS:
+            df[col] = links[col].astype(np.float64).round(3)
+        elif col in ['group1', 'group2']:
+            if groups is None:
+                groups = pd.read_parquet(files['groups'])['group']
+            df[col] = encode_attribute(groups, links[col].values)
+        elif col == 'edge_type':
+            df[col] = pd.Categorical.from_codes(links[col].values, categories=metadata['edge_types'])
+        else:
+            raise KeyError("Column {} is not available in the prediction store".format(col))
+
+    return df
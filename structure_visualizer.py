@@ -1,29 +1,176 @@
 import os
+import json
+import time
+import threading
 import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
 from stmol import makeobj
 
+ALPHAFOLD_URL = 'https://alphafold.ebi.ac.uk/files/AF-{uniprot_id}-F1-model_{version}.pdb'
+ALPHAFOLD_WEB_URL = 'https://alphafold.ebi.ac.uk/entry/{uniprot_id}'
+MODEL_VERSION = 'v4'
+CACHE_DIR = 'data/tmp/alphafold'
+CACHE_MAX_BYTES = 200 * 1024 * 1024
+NOT_AVAILABLE_FILE = 'not_available.json'
+NOT_AVAILABLE_TTL = 7 * 24 * 3600
 
-def get_alphafold_structure(query_proteins={}):
-    structures = {}
-    url = 'https://alphafold.ebi.ac.uk/files/AF-query_protein-F1-model_v4.pdb'
-    web_url = 'https://alphafold.ebi.ac.uk/entry/query_protein'
-    for query_protein in query_proteins:
-        pdb_filename = None
-        uniprot_id = query_proteins[query_protein]
+_cache_lock = threading.Lock()
+
+
+def get_structure_path(uniprot_id, version=MODEL_VERSION, cache_dir=CACHE_DIR):
+    """
+    Path of a cached AlphaFold structure (keyed by UniProt accession and model version)
+    :param str uniprot_id: UniProt accession
+    :param str version: AlphaFold model version
+    :param str cache_dir: path to the structures cache
+    :return: path to the pdb file
+    """
+    return os.path.join(cache_dir, 'AF-{}-F1-model_{}.pdb'.format(uniprot_id, version))
+
+
+def read_not_available(cache_dir=CACHE_DIR):
+    """
+    Negative cache: structures that are not available in AlphaFold
+    :param str cache_dir: path to the structures cache
+    :return: dictionary. Key -> accession_version, value -> time when it was checked
+    """
+    filepath = os.path.join(cache_dir, NOT_AVAILABLE_FILE)
+    not_available = {}
+    if os.path.isfile(filepath):
         try:
-            if uniprot_id is not None:
-                request = urllib.request.Request(url.replace('query_protein', uniprot_id))
-                pdb_filename = os.path.join('data/tmp', query_protein+'_output_structure.pdb')
-                if not os.path.isfile(pdb_filename):
-                    with open(pdb_filename, 'w') as out:
-                        with urllib.request.urlopen(request) as response:
-                            res = response.read().decode('utf-8')
-                            out.write(res)
-                structures[query_protein] = (pdb_filename,
-                                        url.replace('query_protein', uniprot_id),
-                                        web_url.replace('query_protein', uniprot_id))
-        except Exception as e:
+            with open(filepath, 'r') as f:
+                not_available = json.load(f)
+        except ValueError:
+            pass
+
+    return not_available
+
+
+def is_not_available(uniprot_id, version=MODEL_VERSION, cache_dir=CACHE_DIR, ttl=NOT_AVAILABLE_TTL):
+    """
+    Whether the structure was recently found not available in AlphaFold
+    :param str uniprot_id: UniProt accession
+    :param str version: AlphaFold model version
+    :param str cache_dir: path to the structures cache
+    :param int ttl: seconds a missing structure is remembered
+    :return: bool
+    """
+    checked = read_not_available(cache_dir).get('{}_{}'.format(uniprot_id, version))
+
+    return checked is not None and time.time() - checked < ttl
+
+
+def set_not_available(uniprot_id, version=MODEL_VERSION, cache_dir=CACHE_DIR):
+    """
+    Adds a structure to the negative cache (atomic write)
+    :param str uniprot_id: UniProt accession
+    :param str version: AlphaFold model version
+    :param str cache_dir: path to the structures cache
+    """
+    with _cache_lock:
+        not_available = read_not_available(cache_dir)
+        not_available['{}_{}'.format(uniprot_id, version)] = time.time()
+        tmp_path = os.path.join(cache_dir, NOT_AVAILABLE_FILE + '.{}.tmp'.format(threading.get_ident()))
+        with open(tmp_path, 'w') as out:
+            out.write(json.dumps(not_available))
+        os.replace(tmp_path, os.path.join(cache_dir, NOT_AVAILABLE_FILE))
+
+
+def evict_structures(cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+    """
+    Removes the least recently used structures until the cache is below its maximum size
+    :param str cache_dir: path to the structures cache
+    :param int max_bytes: maximum size of the cache in bytes
+    """
+    with _cache_lock:
+        files = []
+        for name in os.listdir(cache_dir):
+            if name.endswith('.pdb'):
+                stat = os.stat(os.path.join(cache_dir, name))
+                files.append((stat.st_mtime, stat.st_size, name))
+        total = sum(f[1] for f in files)
+        for mtime, size, name in sorted(files):
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(os.path.join(cache_dir, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def fetch_structure(uniprot_id, version=MODEL_VERSION, url=ALPHAFOLD_URL, cache_dir=CACHE_DIR,
+                    max_bytes=CACHE_MAX_BYTES, timeout=30):
+    """
+    Gets the AlphaFold structure of a protein from the cache or downloads it. Downloads are written
+    to a temporary file and renamed once complete, so failed downloads never end up in the cache.
+
+    :param str uniprot_id: UniProt accession
+    :param str version: AlphaFold model version
+    :param str url: template of the AlphaFold file url (uniprot_id and version fields)
+    :param str cache_dir: path to the structures cache
+    :param int max_bytes: maximum size of the cache in bytes
+    :param int timeout: seconds to wait for the AlphaFold server
+    :return: path to the pdb file or None if the structure is not available
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    pdb_filename = get_structure_path(uniprot_id, version=version, cache_dir=cache_dir)
+    if os.path.isfile(pdb_filename):
+        # mark as recently used
+        os.utime(pdb_filename)
+        return pdb_filename
+    if is_not_available(uniprot_id, version=version, cache_dir=cache_dir):
+        return None
+
+    request = urllib.request.Request(url.format(uniprot_id=uniprot_id, version=version))
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            content = response.read()
+    except urllib.error.HTTPError as e:
+        if e.code == 404:
+            set_not_available(uniprot_id, version=version, cache_dir=cache_dir)
+        else:
             print(e)
+        return None
+    except (urllib.error.URLError, OSError) as e:
+        print(e)
+        return None
+
+    tmp_path = pdb_filename + '.{}.tmp'.format(threading.get_ident())
+    with open(tmp_path, 'wb') as out:
+        out.write(content)
+    os.replace(tmp_path, pdb_filename)
+    evict_structures(cache_dir=cache_dir, max_bytes=max_bytes)
+
+    return pdb_filename
+
+
+def get_alphafold_structure(query_proteins={}, version=MODEL_VERSION, url=ALPHAFOLD_URL, web_url=ALPHAFOLD_WEB_URL,
+                            cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+    """
+    Gets the AlphaFold structures of the query proteins concurrently
+    :param dict query_proteins: proteins to get. Key -> protein name, value -> UniProt accession
+    :param str version: AlphaFold model version
+    :param str url: template of the AlphaFold file url (uniprot_id and version fields)
+    :param str web_url: template of the AlphaFold entry url (uniprot_id field)
+    :param str cache_dir: path to the structures cache
+    :param int max_bytes: maximum size of the cache in bytes
+    :return: dictionary. Key -> protein name, value -> (path to pdb file or None if not available, file url, entry url)
+    """
+    structures = {}
+    queries = {protein: uniprot_id for protein, uniprot_id in query_proteins.items() if isinstance(uniprot_id, str)}
+    if len(queries) == 0:
+        return structures
+
+    with ThreadPoolExecutor(max_workers=len(queries)) as executor:
+        futures = {protein: executor.submit(fetch_structure, uniprot_id, version, url, cache_dir, max_bytes)
+                   for protein, uniprot_id in queries.items()}
+    for protein, future in futures.items():
+        uniprot_id = queries[protein]
+        structures[protein] = (future.result(),
+                               url.format(uniprot_id=uniprot_id, version=version),
+                               web_url.format(uniprot_id=uniprot_id))
 
     return structures
 
@@ -33,5 +180,5 @@ def generate_mol_structure(pdb_file):
 
     xyzview = makeobj(content, molformat='pdb', style='cartoon', background='black')
     xyzview.setStyle({'cartoon':{'color':'spectrum'}})
-    
-    return xyzview
\ No newline at end of file
+
+    return xyzview
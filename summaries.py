@@ -0,0 +1,122 @@
+import os
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import utils
+
+
+def get_short_name(label):
+    """
+    Abbreviated species name (i.e. Plasmodium falciparum -> P. falciparum)
+    :param str label: species name
+    :return: abbreviated name
+    """
+    return label[0]+'. '+label.split(' ')[1]
+
+
+def get_shared_interactors(df, parasite_col='taxid1_label', target_col='target'):
+    """
+    Number of host interactors shared by each pair of parasites. A binary parasite x host protein
+    incidence matrix is multiplied by its transpose, so all the pairs are counted at once.
+
+    :param DataFrame df: predictions (at least the parasite and target columns)
+    :param str parasite_col: column identifying the parasite
+    :param str target_col: column with the host interactor
+    :return: tuple with the links (columns source, target and value: one row per pair of parasites, source < target)
+                and the nodes (columns index and name) of the circos plot
+    """
+    parasite_codes, parasites = pd.factorize(df[parasite_col], sort=True)
+    target_codes, targets = pd.factorize(df[target_col])
+    valid = (parasite_codes >= 0) & (target_codes >= 0)
+    incidence = sp.csr_matrix((np.ones(valid.sum(), dtype=np.int32), (parasite_codes[valid], target_codes[valid])),
+                              shape=(len(parasites), len(targets)))
+    # duplicated pairs are summed when building the matrix, count each interactor once
+    incidence.data[:] = 1
+    shared = (incidence @ incidence.T).toarray()
+    sources, targets = np.triu_indices(len(parasites), k=1)
+    links = pd.DataFrame({'source': sources, 'target': targets, 'value': shared[sources, targets]})
+    nodes = pd.DataFrame({'index': np.arange(len(parasites)), 'name': [get_short_name(str(p)) for p in parasites]})
+    if len(parasites) < 2:
+        nodes = nodes.iloc[0:0]
+
+    return links, nodes
+
+
+SUMMARY_FILES = ['tissue_cell_types', 'parasite_scores', 'shared_links', 'shared_nodes']
+
+
+def get_summary_path(summary_dir, name):
+    """
+    Path to a summary table of the Home page
+    :param str summary_dir: path to the summaries directory
+    :param str name: name of the summary (see SUMMARY_FILES)
+    :return: path to the parquet file
+    """
+    return os.path.join(summary_dir, name + '.parquet')
+
+
+def get_tissue_cell_type_counts(pred_tissues):
+    """
+    Number of interactions per parasite, tissue and cell type. Besides the counts (edges_tissue and edges_cell_type),
+    each row has the value of the cell type in the icicle plot (edges_cell_type_sum: one value per interaction in the
+    plot of the full table, so counts squared) and the pTPM shown in its hover ('(?)' when the interactions differ)
+
+    :param DataFrame pred_tissues: predictions joined with the tissue and cell type annotation
+    :return: dataframe with one row per parasite, tissue and cell type
+    """
+    aux = pd.DataFrame({'taxid1': pred_tissues['taxid1'].astype(str), 'taxid1_label': pred_tissues['taxid1_label'].astype(str),
+                        'Tissue': pred_tissues['Tissue'].astype(str),
+                        'Cell type': pred_tissues['Cell type'].astype(str).where(pred_tissues['Cell type'].notna(), "Not available"),
+                        'pTPM': pred_tissues['pTPM'].astype(str).where(pred_tissues['pTPM'].notna(), None)})
+    counts = aux.groupby(['taxid1', 'taxid1_label', 'Tissue', 'Cell type'], sort=True).agg(
+                        edges_cell_type=('taxid1', 'size'), pTPM_values=('pTPM', lambda x: x.nunique(dropna=False)),
+                        pTPM=('pTPM', 'first')).reset_index()
+    counts['pTPM'] = counts['pTPM'].where(counts['pTPM_values'] == 1, '(?)')
+    counts['edges_tissue'] = counts.groupby(['taxid1', 'Tissue'])['edges_cell_type'].transform('sum')
+    # px.icicle sums the values of the rows of a cell type: the plot used to be built from one row per interaction,
+    # each with the count of its cell type as value, so a cell type added up count * count. One row per cell type with
+    # the count squared keeps the same sizes (and the count-weighted colors of the parents)
+    counts['edges_cell_type_sum'] = counts['edges_cell_type'] ** 2
+
+    return counts[['taxid1', 'taxid1_label', 'Tissue', 'Cell type', 'edges_tissue', 'edges_cell_type', 'edges_cell_type_sum', 'pTPM']]
+
+
+def get_parasite_scores(predictions):
+    """
+    Number of interactions and distribution of the scores (box plot statistics) of each parasite
+    :param DataFrame predictions: predictions (taxid1, taxid1_label and weight columns)
+    :return: dataframe with one row per parasite: edges, q1, median, q3, lower and upper fences and the outlier scores
+    """
+    stats = []
+    for (taxid, label), weights in predictions.groupby(['taxid1', 'taxid1_label'], observed=True, sort=True)['weight']:
+        weights = weights.astype(float).dropna().values
+        q1, median, q3 = np.percentile(weights, [25, 50, 75])
+        iqr = q3 - q1
+        inside = weights[(weights >= q1 - 1.5 * iqr) & (weights <= q3 + 1.5 * iqr)]
+        stats.append({'taxid1': str(taxid), 'taxid1_label': str(label), 'edges': len(weights), 'q1': q1, 'median': median, 'q3': q3,
+                      'lowerfence': inside.min(), 'upperfence': inside.max(),
+                      'outliers': np.unique(weights[(weights < inside.min()) | (weights > inside.max())]).tolist()})
+
+    return pd.DataFrame(stats, columns=['taxid1', 'taxid1_label', 'edges', 'q1', 'median', 'q3', 'lowerfence', 'upperfence', 'outliers'])
+
+
+def build_home_summaries(predictions, pred_tissues, summary_dir):
+    """
+    Materializes the aggregates shown in the Home page (a few kilobytes), so the page does not need the predictions:
+        tissue_cell_types: interactions per parasite, tissue and cell type
+        parasite_scores: interactions and score distribution per parasite
+        shared_links and shared_nodes: host interactors shared by each pair of parasites (circos plot)
+
+    :param DataFrame predictions: predictions (taxid1, taxid1_label, target and weight columns)
+    :param DataFrame pred_tissues: predictions joined with the tissue and cell type annotation
+    :param str summary_dir: path to the summaries directory
+    """
+    links, nodes = get_shared_interactors(predictions)
+    summaries = {'tissue_cell_types': get_tissue_cell_type_counts(pred_tissues), 'parasite_scores': get_parasite_scores(predictions),
+                 'shared_links': links, 'shared_nodes': nodes}
+    # written to a temporary directory and moved into place once complete, so the summaries are always consistent
+    tmp_dir = utils.get_tmp_path(summary_dir)
+    os.makedirs(tmp_dir)
+    for name, df in summaries.items():
+        df.to_parquet(get_summary_path(tmp_dir, name), index=False)
+    utils.replace_dir(tmp_dir, summary_dir)
@@ -1,30 +1,916 @@
+import os
+import gzip
+import json
+import sys
+import zipfile
+import time
+import hashlib
+import threading
+import http.server
+import multiprocessing
+import numpy as np
+import networkx as nx
+import pandas as pd
+import plotly.express as px
+from scipy import stats
+from statsmodels.stats.multitest import multipletests
+import utils
 import homology
+import downloader
+import pipeline
+import instrumentation
+import prediction_store
+import enrichment
+import bundles
+import centrality
+import datastore
+import filters
+import hpa
+import go
+import summaries
+import enrichment_store
+import go_store
+import go_hierarchy
+import structure_visualizer as strv
 
 
-def test_config_file(config_file):
+def test_config_file(config_file='config.yml'):
     '''Test wether the configuration file exists or not'''
-    pass
+    assert(os.path.isfile(config_file))
 
-def test_config_file_yaml_format(config_file):
+def test_config_file_yaml_format(config_file='config.yml'):
     '''Test if the config file format is yaml'''
-    pass
+    assert(isinstance(utils.read_yaml(config_file), dict))
 
-def test_config_field(config, field):
+def test_config_field(config='config.yml', field='urls'):
     '''Test whether the configuration field exists or not'''
-    pass
+    assert(utils.read_config(filepath=config, field=field) is not None)
 
-def test_get_eggnog_homologs(url, proteins, taxids, group):
-    '''Test if the get eggnog orthologs function returns the right homologs
-        expected response from url: {'orthologs': [[['10090', 'Mus musculus', ['10090.ENSMUSP00000026572', '10090.ENSMUSP00000029445', '10090.ENSMUSP00000032399']],
-        [['44689', 'Dictyostelium discoideum', ['44689.DDB0214827']], ['5786', 'Dictyostelium purpureum', ['5786.XP_003294405.1']]]]]}
+def test_get_eggnog_homologs(tmp_path):
+    '''Test if the eggNOG groups of a protein contain the right homologs (offline, from a members file, repeated queries are found once)
+        KOG0395 contains 3 Mus musculus paralogs and their Dictyostelium discoideum and Dictyostelium purpureum orthologs
     '''
-    expected_paralogs = ['10090', 'Mus musculus', ['10090.ENSMUSP00000026572', '10090.ENSMUSP00000029445', '10090.ENSMUSP00000032399']]
-    expected_orthologs = [['44689', 'Dictyostelium discoideum', ['44689.DDB0214827']], ['5786', 'Dictyostelium purpureum', ['5786.XP_003294405.1']]]
-    url = "http://eggnogapi5.embl.de/pairwise_orthologs_by_member/json/PROTEINS/TAXIDS/GROUP"
-    proteins = ['10090.ENSMUSP00000032399']
-    taxids = ['5786', '44689']
-    group = 'KOG0395'
-    orthologs, paralogs = homology.get_eggnog_orthologs(url=url, proteins=proteins, taxids=taxids, group=group)
-    
-    assert(expected_paralogs == paralogs)
-    assert(expected_orthologs == orthologs)
+    members = ['2759\tKOG0395\t5\t3\t10090.ENSMUSP00000026572,10090.ENSMUSP00000029445,10090.ENSMUSP00000032399,'
+               '44689.DDB0214827,5786.XP_003294405.1\t10090,44689,5786',
+               '2759\tKOG0039\t2\t2\t10090.ENSMUSP00000032399,5833.PF3D7_0102200\t10090,5833',
+               '2759\tKOG0040\t1\t1\t10090.ENSMUSP00000026572\t10090']
+    filepath = str(tmp_path / '2759_members.tsv.gz')
+    with gzip.open(filepath, 'wt') as out:
+        out.write('#taxonomic_level\tgroup\tn_proteins\tn_species\tproteins\tspecies\n' + '\n'.join(members) + '\n')
+    proteins = ['10090.ENSMUSP00000032399', '10090.ENSMUSP00000026572', '10090.ENSMUSP00000029445',
+                '44689.DDB0214827', '5786.XP_003294405.1', '10090.ENSMUSP99999999999']
+    valid_groups = homology.get_eggnog_groups(filepath=filepath, proteins=proteins + proteins[:2], index_dir=str(tmp_path / 'index'))
+    group_names, protein_names, host_members, parasite_members = homology.split_groups(valid_groups, hosts={10090: {}},
+                                                                                      parasites={5786: {}, 44689: {}})
+    kog0395 = group_names.index('KOG0395')
+
+    assert(sorted(valid_groups) == ['KOG0039', 'KOG0040', 'KOG0395'])
+    assert(valid_groups['KOG0395'] == proteins[:5])
+    assert(valid_groups['KOG0039'] == ['10090.ENSMUSP00000032399'])
+    assert([protein_names[i] for i in host_members[kog0395]] == proteins[:3])
+    assert([protein_names[i] for i in parasite_members[kog0395]] == ['44689.DDB0214827', '5786.XP_003294405.1'])
+
+
+def test_get_links(tmp_path):
+    '''Test the transfer of group links to parasite-host protein pairs: evidence cutoff, one row per pair (scores of the first link) and row order,
+        from the STRING file and from the links filtered once for all the parasites
+    '''
+    valid_groups = {'G1': ['9606.h1', '9606.h2', '5833.p1'], 'G2': ['9606.h3', '5833.p2'], 'G3': ['5833.p1', '5833.p3']}
+    links = ['G1 G2 0 0 0 0 800 100 0', 'G2 G3 0 0 0 0 900 900 0', 'G1 G3 0 0 0 0 100 200 0', 'G1 G1 0 0 0 0 700 0 0']
+    filepath = str(tmp_path / 'COG.links.txt.gz')
+    with gzip.open(filepath, 'wt') as out:
+        out.write('group1 group2 neighborhood fusion cooccurence coexpression experimental database combined_score\n' + '\n'.join(links) + '\n')
+    config_file = str(tmp_path / 'config.yml')
+    with open(config_file, 'w') as out:
+        out.write('hosts:\n    9606:\n        label: Homo sapiens\n        color: "#525252"\n'
+                  'parasites:\n    5833:\n        label: Plasmodium falciparum\n        color: "#b2182b"\n')
+    proteins = {p: p.split('.')[1].upper() for members in valid_groups.values() for p in members}
+    output_filepath = str(tmp_path / 'predictions.parquet')
+    homology.get_links(filepath, valid_groups, proteins, output_filepath, config_file, batch_size=2)
+    df = pd.read_parquet(output_filepath)
+    # transferred from the links filtered once for all the parasites
+    homology.filter_group_links(filepath, str(tmp_path / 'group_links.parquet'), chunksize=2)
+    homology.get_links(str(tmp_path / 'group_links.parquet'), valid_groups, proteins, output_filepath, config_file, batch_size=2)
+    rows = list(df[['source', 'target', 'experimental_evidence_score', 'databases_evidence_score', 'weight', 'group1', 'group2']].itertuples(index=False, name=None))
+
+    assert(list(df.columns) == homology.LINK_COLUMNS)
+    assert(rows == [('5833.p2', '9606.h1', '0.8', '0.1', '0.45', 'G2', 'G1'), ('5833.p2', '9606.h2', '0.8', '0.1', '0.45', 'G2', 'G1'),
+                    ('5833.p1', '9606.h3', '0.8', '0.1', '0.45', 'G1', 'G2'), ('5833.p3', '9606.h3', '0.9', '0.9', '0.9', 'G3', 'G2'),
+                    ('5833.p1', '9606.h1', '0.7', '0.0', '0.35', 'G1', 'G1'), ('5833.p1', '9606.h2', '0.7', '0.0', '0.35', 'G1', 'G1')])
+    assert((df['taxid1_label'] == 'Plasmodium falciparum').all() and (df['target_name'] == df['target'].str.split('.').str[1].str.upper()).all())
+    assert(len(pd.read_parquet(str(tmp_path / 'group_links.parquet'))) == 3)
+    assert(pd.read_parquet(output_filepath).equals(df))
+
+
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+    '''Local stand-in for the data servers: serves in-memory files with ETag and HTTP range support'''
+    files = {}
+    requests = []
+
+    def do_GET(self):
+        content = self.files.get(self.path)
+        RangeRequestHandler.requests.append((self.path, self.headers.get('Range')))
+        if content is None:
+            self.send_error(404)
+            return
+        start = 0
+        if self.headers.get('Range') is not None:
+            start = int(self.headers['Range'].split('=')[1].split('-')[0])
+            if start >= len(content):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(len(content)))
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(content) - 1, len(content)))
+        else:
+            self.send_response(200)
+        self.send_header('ETag', '"{}"'.format(hashlib.md5(content).hexdigest()))
+        self.send_header('Content-Length', str(len(content) - start))
+        self.end_headers()
+        self.wfile.write(content[start:])
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stand_in_server(files):
+    RangeRequestHandler.files = files
+    RangeRequestHandler.requests = []
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RangeRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+
+def test_download_file_manifest(tmp_path):
+    '''Test that downloads are recorded in the manifest and not fetched twice'''
+    content = os.urandom(300000)
+    server, url = start_stand_in_server({'/9606.protein.info.txt.gz': content})
+    filepath = downloader.download(url + '/9606.protein.info.txt.gz', data_dir=str(tmp_path))
+    downloader.download(url + '/9606.protein.info.txt.gz', data_dir=str(tmp_path))
+    server.shutdown()
+    manifest = downloader.read_manifest(str(tmp_path))
+
+    assert(open(filepath, 'rb').read() == content)
+    assert(manifest['9606.protein.info.txt.gz']['sha256'] == hashlib.sha256(content).hexdigest())
+    assert(len(RangeRequestHandler.requests) == 1)
+    assert(not os.path.exists(filepath + '.part'))
+
+
+def test_download_resume(tmp_path):
+    '''Test that an interrupted download is resumed with a range request'''
+    content = os.urandom(300000)
+    server, url = start_stand_in_server({'/2759_members.tsv.gz': content})
+    with open(os.path.join(str(tmp_path), '2759_members.tsv.gz.part'), 'wb') as out:
+        out.write(content[:1000])
+    with open(os.path.join(str(tmp_path), '2759_members.tsv.gz.part.json'), 'w') as out:
+        out.write(json.dumps({'url': url + '/2759_members.tsv.gz', 'etag': None}))
+    filepath = downloader.download(url + '/2759_members.tsv.gz', data_dir=str(tmp_path))
+    server.shutdown()
+
+    assert(RangeRequestHandler.requests == [('/2759_members.tsv.gz', 'bytes=1000-')])
+    assert(open(filepath, 'rb').read() == content)
+    assert(downloader.checksum(filepath) == hashlib.sha256(content).hexdigest())
+
+
+def test_download_complete_part(tmp_path):
+    '''Test that a partial download that is already complete (HTTP 416 on resume) is kept instead of downloaded again'''
+    content = os.urandom(5000)
+    server, url = start_stand_in_server({'/go-basic.obo': content})
+    with open(os.path.join(str(tmp_path), 'go-basic.obo.part'), 'wb') as out:
+        out.write(content)
+    with open(os.path.join(str(tmp_path), 'go-basic.obo.part.json'), 'w') as out:
+        out.write(json.dumps({'url': url + '/go-basic.obo', 'etag': None}))
+    filepath = downloader.download(url + '/go-basic.obo', data_dir=str(tmp_path))
+    server.shutdown()
+
+    assert(RangeRequestHandler.requests == [('/go-basic.obo', 'bytes=5000-')])
+    assert(open(filepath, 'rb').read() == content)
+    assert(downloader.read_manifest(str(tmp_path))['go-basic.obo']['sha256'] == hashlib.sha256(content).hexdigest())
+
+
+def update_manifest_entries(data_dir, start):
+    for i in range(start, start + 20):
+        downloader.update_manifest(data_dir, 'file{}.txt'.format(i), {'size': i})
+
+
+def test_manifest_concurrent_processes(tmp_path):
+    '''Test that concurrent manifest updates from several processes keep every entry'''
+    processes = [multiprocessing.Process(target=update_manifest_entries, args=(str(tmp_path), start)) for start in range(0, 80, 20)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    assert(sorted(downloader.read_manifest(str(tmp_path))) == sorted('file{}.txt'.format(i) for i in range(80)))
+
+
+def test_download_all(tmp_path):
+    '''Test concurrent downloads and that failed downloads are reported and not left as complete files'''
+    files = {'/{}.protein.aliases.txt.gz'.format(taxid): os.urandom(5000) for taxid in [9606, 5759, 5741, 5664]}
+    server, url = start_stand_in_server(files)
+    downloaded = downloader.download_all([url + f for f in files], data_dir=str(tmp_path), workers=2)
+    try:
+        downloader.download_all([url + '/missing.txt.gz'], data_dir=str(tmp_path), workers=2)
+        failed = False
+    except IOError:
+        failed = True
+    server.shutdown()
+
+    assert(all(open(downloaded[url + f], 'rb').read() == files[f] for f in files))
+    assert(failed)
+    assert(not os.path.exists(os.path.join(str(tmp_path), 'missing.txt.gz')))
+
+
+def test_string_aliases(tmp_path, monkeypatch):
+    '''Test that the chunked alias parser keeps the sources requested and maps as the row by row parser (last alias wins), and is cached'''
+    rows = [('9606.ENSP01', 'P01112', 'UniProt_AC'), ('9606.ENSP01', 'HRAS', 'Ensembl_gene'), ('9606.ENSP02', 'Q9Y6K9', 'UniProt_AC'),
+            ('9606.ENSP02', 'Q9Y6K8', 'UniProt_AC'), ('9606.ENSP03', 'P01112', 'UniProt_AC'), ('9606.ENSP04', 'TP53', 'Ensembl_gene')]
+    content = gzip.compress(('#string_protein_id\talias\tsource\n' + ''.join('{}\t{}\t{}\n'.format(*row) for row in rows)).encode())
+    server, url = start_stand_in_server({'/9606.protein.aliases.txt.gz': content})
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('data')
+    with open('config.yml', 'w') as out:
+        out.write('urls:\n    string_alias_url: {}/TAXID.protein.aliases.txt.gz\n'.format(url))
+    aliases = utils.read_string_aliases('config.yml', ['UniProt_AC'], taxid='9606', chunksize=2)
+    cached = utils.read_string_aliases('config.yml', ['UniProt_AC'], taxid='9606', chunksize=2)
+    mapping = utils.parse_string_aliases('config.yml', ['UniProt_AC'], taxid='9606')
+    reverse = utils.parse_string_aliases('config.yml', ['UniProt_AC'], taxid='9606', reverse=True)
+    server.shutdown()
+    expected = {}
+    expected_reverse = {}
+    for protein, alias, source in rows:
+        if source == 'UniProt_AC':
+            expected[alias] = protein
+            expected_reverse[protein] = alias
+
+    assert(list(aliases['alias']) == ['P01112', 'Q9Y6K9', 'Q9Y6K8', 'P01112'])
+    assert(cached.equals(aliases))
+    assert(len(RangeRequestHandler.requests) == 1)
+    assert(mapping == expected and reverse == expected_reverse)
+
+
+def test_jensenlab_filters(tmp_path, monkeypatch):
+    '''Test that the chunked tissue and compartment filters keep the annotations the line by line parser kept (first line skipped,
+        score cutoff, valid terms and proteins), in file order
+    '''
+    tissues = [('ENSP01', 'HRAS', 'BTO:0000759', 'liver', 'TEXT', '', 4.1), ('ENSP01', 'HRAS', 'BTO:0000759', 'liver', 'TEXT', '', 3.0),
+               ('ENSP02', 'TP53', 'BTO:0000089', 'blood', 'TEXT', '', 2.5), ('ENSP02', 'TP53', 'BTO:0000142', 'brain', 'TEXT', '', 4.5),
+               ('ENSP03', 'KRAS', 'BTO:0000759', 'liver', 'TEXT', '', 2.4), ('ENSP02', 'TP53', 'BTO:0000759', 'liver', 'TEXT', '', 3.5),
+               ('ENSP09', 'EGFR', 'BTO:0000759', 'liver', 'TEXT', '', 5.0)]
+    compartments = [('ENSP01', 'HRAS', 'GO:0005886', 'Plasma membrane', 4.0), ('ENSP02', 'TP53', 'GO:0005634', 'Nucleus', 5.0),
+                    ('ENSP02', 'TP53', 'GO:0005886', 'Plasma membrane', 2.5), ('ENSP03', 'KRAS', 'GO:0005886', 'Plasma membrane', 1.0)]
+    monkeypatch.chdir(tmp_path)
+    for filename, rows in [('tissues.tsv', tissues), ('compartments.tsv', compartments)]:
+        with open(filename, 'w') as out:
+            out.write(''.join('\t'.join(str(v) for v in row) + '\n' for row in [rows[0]] + rows))
+    proteins = {'9606.ENSP01': 'HRAS', '9606.ENSP02': 'TP53', '9606.ENSP03': 'KRAS'}
+    mapping = {'BTO:0000759': 'liver', 'BTO:0000089': 'blood'}
+    host_tissues, tissue_proteins = filters.get_tissues('tissues.tsv', proteins, 2.5, mapping, {'BTO:0000759', 'BTO:0000089'})
+    cached = filters.get_tissues('tissues.tsv', proteins, 2.5, mapping, {'BTO:0000759', 'BTO:0000089'})
+    host_compartments, compartment_proteins = filters.get_compartments('compartments.tsv', proteins, 2.5, {'GO:0005886'})
+
+    assert(host_tissues == {'9606.ENSP01': ['liver', 'liver'], '9606.ENSP02': ['blood', 'liver']})
+    assert(list(tissue_proteins.items()) == [('9606.ENSP01', 'HRAS'), ('9606.ENSP02', 'TP53')])
+    assert(cached == (host_tissues, tissue_proteins) and len(os.listdir(os.path.join('data', 'filters'))) == 2)
+    assert(host_compartments == {'9606.ENSP01': ['GO:0005886'], '9606.ENSP02': ['GO:0005886']})
+    assert(list(compartment_proteins) == ['9606.ENSP01', '9606.ENSP02'])
+
+
+def test_hpa_cell_types(tmp_path, monkeypatch):
+    '''Test that the chunked HPA reader keeps the rows the whole-file reader kept (highest pTPM of each gene, tissue and cell type,
+        pTPM above 0) for the relevant tissues and genes
+    '''
+    rows = [('ENSG01', 'HRAS', 'liver', 'c-0', 'hepatocytes', 10, 3.5), ('ENSG01', 'HRAS', 'liver', 'c-1', 'hepatocytes', 30, 8.2),
+            ('ENSG02', 'TP53', 'heart muscle', 'c-0', 'cardiomyocytes', 5, 1.5), ('ENSG02', 'TP53', 'skin', 'c-0', 'keratinocytes', 50, 9.0),
+            ('ENSG03', 'KRAS', 'liver', 'c-2', 'kupffer cells', 0, 0.0), ('ENSG02', 'TP53', 'heart muscle', 'c-3', 'cardiomyocytes', 7, 2.5),
+            ('ENSG01', 'HRAS', 'liver', 'c-2', 'kupffer cells', 2, 0.4), ('ENSG04', 'EGFR', 'liver', 'c-0', 'hepatocytes', 12, 4.0),
+            ('ENSG01', 'HRAS', 'liver', 'c-3', 'hepatocytes', 20, 6.1)]
+    content = 'Gene\tGene name\tTissue\tCluster\tCell type\tRead count\tpTPM\n' + ''.join('\t'.join(str(v) for v in row) + '\n' for row in rows)
+    archive = str(tmp_path / 'archive.zip')
+    with zipfile.ZipFile(archive, 'w') as out:
+        out.writestr('rna_single_cell_type_tissue.tsv', content)
+    with open(archive, 'rb') as f:
+        server, url = start_stand_in_server({'/rna_single_cell_type_tissue.tsv.zip': f.read()})
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('data')
+    with open('config.yml', 'w') as out:
+        out.write('urls:\n    hpa_single_cell_tissue_url: {}/rna_single_cell_type_tissue.tsv.zip\n'
+                  'tissues:\n    BTO:0000759: Liver\n    BTO:0000562: Heart\n'.format(url))
+    data = hpa.read_cell_types('config.yml', chunksize=2)
+    selected = hpa.read_cell_types('config.yml', genes=['ENSG01', 'ENSG03'], chunksize=2)
+    server.shutdown()
+    # whole-file reader (before the chunked one) followed by the tissue filter
+    expected = pd.read_csv(utils.read_zipped_file(os.path.join('data', 'rna_single_cell_type_tissue.tsv.zip')), sep='\t', header=0)
+    expected = expected.sort_values(by='pTPM', ascending=False).drop_duplicates(['Gene', 'Tissue', 'Cell type'], keep='first')
+    expected = expected[(expected['pTPM'] > 0.0) & expected['Tissue'].replace(hpa.TISSUES_MAPPING).isin(['liver', 'heart'])]
+
+    assert(data.equals(expected.reset_index(drop=True)))
+    assert(selected.equals(expected[expected['Gene'].isin(['ENSG01', 'ENSG03'])].reset_index(drop=True)))
+
+
+def test_secretome_filter(tmp_path):
+    '''Test that the FASTA header index finds the identifiers Biopython parses and that only secreted proteins are kept'''
+    fasta_file = str(tmp_path / '5833.fasta')
+    with open(fasta_file, 'w') as out:
+        out.write('>5833.PF3D7_0102200 signal peptide\nMKLLV\nAAGG\n>5833.PF3D7_0207600\nMSTT\n>5833.PF3D7_1133400\tGPI\nMKK')
+    proteins = {'5833.PF3D7_0102200': 'RESA', '5833.PF3D7_0930300': 'MSP1', '5833.PF3D7_1133400': 'AMA1'}
+    config_file = str(tmp_path / 'config.yml')
+    with open(config_file, 'w') as out:
+        out.write('parasites:\n    5833:\n        label: Plasmodium falciparum\n')
+    valid_proteins = filters.get_secretome_predictions(config_file, str(tmp_path), {5833: proteins})
+
+    assert(utils.read_fasta_ids(fasta_file) == set(utils.read_fasta(fasta_file)))
+    assert(valid_proteins[5833] == {'5833.PF3D7_0102200': 'RESA', '5833.PF3D7_1133400': 'AMA1'})
+
+
+def test_jensenlab_cache_key(tmp_path, monkeypatch):
+    '''Test that the filters cache is keyed without hashing files that are not in the manifest, and invalidated when the file changes'''
+    monkeypatch.chdir(tmp_path)
+    with open('tissues.tsv', 'w') as out:
+        out.write('header\nENSP01\tHRAS\tBTO:0000759\tliver\tTEXT\t\t4.0\n')
+    monkeypatch.setattr(downloader, 'sha256sum', None)
+    first = filters.read_jensenlab_file('tissues.tsv', 6, {'BTO:0000759'}, 2.5)
+    with open('tissues.tsv', 'w') as out:
+        out.write('header\nENSP02\tTP53\tBTO:0000759\tliver\tTEXT\t\t4.0\n')
+    os.utime('tissues.tsv', ns=(time.time_ns() + 10 ** 9, time.time_ns() + 10 ** 9))
+    second = filters.read_jensenlab_file('tissues.tsv', 6, {'BTO:0000759'}, 2.5)
+
+    assert(list(first['protein']) == ['9606.ENSP01'] and list(second['protein']) == ['9606.ENSP02'])
+
+
+def test_alphafold_structures(tmp_path):
+    '''Test that both structures are fetched, cached by accession and model version, and that missing ones are remembered'''
+    files = {'/files/AF-P01112-F1-model_v4.pdb': b'ATOM      1  N   MET A   1\n',
+             '/files/AF-Q9Y6K9-F1-model_v4.pdb': b'ATOM      1  N   ALA A   1\n'}
+    server, url = start_stand_in_server(files)
+    template = url + '/files/AF-{uniprot_id}-F1-model_{version}.pdb'
+    query = {'HRAS': 'P01112', 'NEMO': 'Q9Y6K9', 'XP_001467009.1': 'A4HSX5', 'EAN79407': None}
+    structures = strv.get_alphafold_structure(query_proteins=query, url=template, cache_dir=str(tmp_path))
+    cached = strv.get_alphafold_structure(query_proteins=query, url=template, cache_dir=str(tmp_path))
+    server.shutdown()
+
+    assert(open(structures['HRAS'][0], 'rb').read() == files['/files/AF-P01112-F1-model_v4.pdb'])
+    assert(structures['NEMO'][0].endswith('AF-Q9Y6K9-F1-model_v4.pdb'))
+    assert(structures['XP_001467009.1'][0] is None)
+    assert('EAN79407' not in structures)
+    assert(cached == structures)
+    assert(len(RangeRequestHandler.requests) == 3)
+    assert(not any(name.endswith('.tmp') for name in os.listdir(str(tmp_path))))
+
+
+def test_alphafold_cache_eviction(tmp_path):
+    '''Test that the least recently used structures are evicted when the cache is full'''
+    files = {'/files/AF-P{}-F1-model_v4.pdb'.format(i): b'A' * 1000 for i in range(3)}
+    server, url = start_stand_in_server(files)
+    template = url + '/files/AF-{uniprot_id}-F1-model_{version}.pdb'
+    for i in range(3):
+        strv.fetch_structure('P{}'.format(i), url=template, cache_dir=str(tmp_path), max_bytes=2500)
+        time.sleep(0.01)
+    server.shutdown()
+
+    assert(sorted(name for name in os.listdir(str(tmp_path)) if name.endswith('.pdb')) ==
+           ['AF-P1-F1-model_v4.pdb', 'AF-P2-F1-model_v4.pdb'])
+
+
+def test_pipeline_reruns_only_invalidated_stages(tmp_path):
+    '''Test that only the stages whose parameters changed, and the stages depending on them, are run again'''
+    executed = []
+
+    def stage(name, depends, params):
+        output_file = str(tmp_path / name.replace(':', '_'))
+
+        def run():
+            executed.append(name)
+            with open(output_file, 'w') as out:
+                out.write(name)
+        return {'name': name, 'run': run, 'depends': depends, 'params': params, 'outputs': [output_file]}
+
+    def stages(parasites):
+        links = [stage('links:{}'.format(taxid), ['hosts'], {'color': color}) for taxid, color in parasites.items()]
+        return [stage('merge', [s['name'] for s in links], {})] + links + [stage('hosts', [], {'cutoff': 2.5})]
+
+    pipeline.run_stages(stages({5833: 'red', 5759: 'blue'}), state_dir=str(tmp_path))
+    assert(executed == ['hosts', 'links:5833', 'links:5759', 'merge'])
+    executed.clear()
+    pipeline.run_stages(stages({5833: 'red', 5759: 'blue'}), state_dir=str(tmp_path))
+    assert(executed == [])
+    pipeline.run_stages(stages({5833: 'red', 5759: 'green', 5741: 'black'}), state_dir=str(tmp_path))
+    assert(executed == ['links:5759', 'links:5741', 'merge'])
+
+
+def test_prediction_store_round_trip(tmp_path):
+    '''Test that the predictions read from the prediction store are the predictions written (scores as floats) and that rebuilding replaces it'''
+    rows = [['5833', 'Plasmodium falciparum', '#e31a1c', 'diamond', '5833.A', 'A', '9606', 'Homo sapiens', '#525252', 'dot',
+             '9606.ENSP1', 'CASK', '0.0', '0.77', '0.385', 'KOG0039', 'KOG0033', 'inter-species'],
+            ['5759', 'Entamoeba histolytica', '#b2df8a', 'diamond', '5759.B', 'B', '9606', 'Homo sapiens', '#525252', 'dot',
+             '9606.ENSP1', 'CASK', '0.912', '0.5', '0.706', 'KOG0040', 'KOG0033', 'inter-species']]
+    predictions = pd.DataFrame(rows, columns=homology.LINK_COLUMNS)
+    prediction_store.build_store(predictions.iloc[:1], str(tmp_path / 'store'))
+    # a store built again replaces the previous one
+    prediction_store.build_store(predictions, str(tmp_path / 'store'))
+    df = prediction_store.read_predictions(str(tmp_path / 'store'))
+    selected = prediction_store.read_predictions(str(tmp_path / 'store'), columns=['source', 'weight'], taxids=[5759])
+
+    assert(list(df.columns) == homology.LINK_COLUMNS)
+    for col in homology.LINK_COLUMNS:
+        expected = predictions[col].astype(float) if col in prediction_store.SCORE_COLUMNS else predictions[col]
+        assert(df[col].astype(expected.dtype).tolist() == expected.tolist())
+    assert(selected['source'].tolist() == ['5759.B'] and selected['weight'].tolist() == [0.706])
+    assert(os.listdir(str(tmp_path)) == ['store'])
+
+
+def test_instrumentation_spans(tmp_path, monkeypatch):
+    '''Test that nested spans and timed functions are recorded per rerun and logged as JSON lines'''
+    log_file = str(tmp_path / 'spans.jsonl')
+    monkeypatch.setenv(instrumentation.LOG_ENV, log_file)
+
+    @instrumentation.timed('test.rows')
+    def rows(n):
+        return list(range(n))
+
+    instrumentation.start_rerun('test')
+    with instrumentation.span('test.outer') as record:
+        rows(3)
+        instrumentation.add_rows(5)
+    rerun = instrumentation.end_rerun()
+    logged = [json.loads(line) for line in open(log_file)]
+
+    assert([s['name'] for s in rerun['spans']] == ['test.rows', 'test.outer'])
+    assert(rerun['spans'][0]['parent'] == 'test.outer' and rerun['spans'][0]['rows'] == 3)
+    assert(record['rows'] == 5 and record['seconds'] >= rerun['spans'][0]['seconds'])
+    assert(all(s['peak_rss'] > 0 for s in rerun['spans']))
+    assert([r['name'] for r in logged] == ['test.rows', 'test.outer', 'test'])
+    assert(logged[-1]['event'] == 'rerun')
+
+
+def test_profiler_fallback(tmp_path, monkeypatch, capsys):
+    '''Test that a profiler that is not installed falls back to cProfile and is reported in the structured log, not on stdout'''
+    log_file = str(tmp_path / 'spans.jsonl')
+    monkeypatch.setenv(instrumentation.LOG_ENV, log_file)
+    monkeypatch.setenv(instrumentation.PROFILE_ENV, str(tmp_path / 'profiles'))
+    monkeypatch.setenv(instrumentation.PROFILER_ENV, 'pyinstrument')
+    monkeypatch.setitem(sys.modules, 'pyinstrument', None)
+    profiler = instrumentation.start_profiler()
+    filepath = instrumentation.stop_profiler(profiler, 'test')
+    logged = [json.loads(line) for line in open(log_file)]
+
+    assert(profiler[0] == 'cprofile' and os.path.isfile(filepath))
+    assert(capsys.readouterr().out == '')
+    assert([r['event'] for r in logged] == ['profiler', 'profile'] and logged[0]['fallback'] == 'cprofile')
+
+
+def get_species_rows(taxid, n):
+    return list(range(n))
+
+
+def test_map_taxids_spans(tmp_path, monkeypatch):
+    '''Test that the work of each species is recorded in a span, also when it runs in worker processes'''
+    log_file = str(tmp_path / 'spans.jsonl')
+    monkeypatch.setenv(instrumentation.LOG_ENV, log_file)
+    instrumentation.start_rerun('test')
+    sequential = utils.map_taxids(get_species_rows, [9606, 5833], workers=1, n=3)
+    rerun = instrumentation.end_rerun()
+    parallel = utils.map_taxids(get_species_rows, [9606, 5833], workers=2, n=3)
+    logged = [json.loads(line) for line in open(log_file) if json.loads(line)['name'] == 'utils.map_taxids']
+
+    assert(sequential == parallel == [[0, 1, 2], [0, 1, 2]])
+    assert([(s['taxid'], s['function'], s['rows']) for s in rerun['spans']] == [(9606, 'get_species_rows', 3), (5833, 'get_species_rows', 3)])
+    assert(sorted(r['taxid'] for r in logged) == [5833, 5833, 9606, 9606])
+    assert(len(set(r['pid'] for r in logged)) > 1)
+
+
+def get_network(n=1000, parasite=5833, host=9606, parasite_proteins=100, host_proteins=300, seed=0):
+    '''Synthetic network of a parasite in the bundle format (wide columns, sorted by weight)'''
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({'taxid1': str(parasite), 'taxid2': str(host),
+                       'source': np.char.add('{}.p'.format(parasite), rng.integers(0, parasite_proteins, size=n).astype(str)),
+                       'target': np.char.add('{}.h'.format(host), rng.integers(0, host_proteins, size=n).astype(str)),
+                       'weight': np.round(rng.uniform(0.3, 1.0, size=n), 3)})
+    for col in ['source', 'target']:
+        df[col + '_color'] = 'red'
+        df[col + '_name'] = df[col]
+        df[col + '_shape'] = 'dot'
+
+    return df.sort_values(by='weight', ascending=False, kind='stable').reset_index(drop=True)
+
+
+def get_go_annotations(species, n_terms=40, annotations=4, seed=0):
+    '''Synthetic GO annotations of each species, as parsed by the pipeline (one dataframe per species)'''
+    rng = np.random.default_rng(seed)
+    go_dfs = []
+    for taxid, proteins in species.items():
+        go_dfs.append(pd.DataFrame({'#string_protein_id': rng.choice(np.asarray(proteins, dtype=object), size=len(proteins) * annotations),
+                                    'description': np.char.add('term', rng.integers(0, n_terms, size=len(proteins) * annotations).astype(str)).astype(object),
+                                    'taxid': taxid}))
+
+    return go_dfs
+
+
+def write_bundle(df, bundle_dir, taxid):
+    '''Writes a network as the bundle of a parasite'''
+    bundle_file = bundles.get_bundle_path(bundle_dir, taxid)
+    os.makedirs(os.path.dirname(bundle_file), exist_ok=True)
+    df.to_parquet(bundle_file, index=False)
+
+
+def get_tissue_predictions(n=400, seed=0):
+    '''Synthetic predictions of two parasites joined with the tissue and cell type annotation'''
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({'taxid1': rng.choice(['5833', '5759'], n), 'taxid2': '9606', 'target': np.char.add('9606.h', rng.integers(0, 50, n).astype(str)),
+                       'weight': np.round(rng.uniform(0.4, 1.0, n), 3)})
+    df['taxid1_label'] = df['taxid1'].map({'5833': 'Plasmodium falciparum', '5759': 'Entamoeba histolytica'})
+    df['Tissue'] = rng.choice(['liver', 'blood'], n)
+    df['Cell type'] = pd.Series(rng.choice(np.array(['hepatocytes', 'kupffer cells', 'erythrocytes', None], dtype=object), n))
+    df['pTPM'] = pd.Series(rng.choice(np.array(['1.5', '20.0', None], dtype=object), n))
+
+    return df
+
+
+def get_icicle_nodes(df, values):
+    '''Value, color and hover data of each node of the Home page icicle plot'''
+    trace = px.icicle(df, path=[px.Constant("Parasites"), 'taxid1_label', 'Tissue', 'Cell type'], values=values, color='edges_cell_type',
+                      hover_data=['edges_tissue', 'edges_cell_type', 'taxid1', 'taxid1_label', 'pTPM'], maxdepth=-1).data[0]
+
+    return {node: (value, color, list(hover)) for node, value, color, hover in zip(trace.ids, trace.values, trace.marker.colors, trace.customdata)}
+
+
+def test_home_summaries_match_figures():
+    '''Test that the precomputed Home page summaries give the icicle plot built from one row per interaction
+        and the counts and box plot statistics of the scores of each parasite
+    '''
+    df = get_tissue_predictions()
+    # icicle plot of the Home page before the summaries were precomputed
+    aux = df.copy()
+    aux['Cell type'] = aux['Cell type'].astype(str).where(aux['Cell type'].notna(), "Not available")
+    counts_tissues = aux.groupby(['taxid1', 'Tissue']).count()['taxid2'].reset_index().rename({'taxid2': 'edges_tissue'}, axis=1)
+    counts_cells = aux.groupby(['taxid1', 'Tissue', 'Cell type']).count()['taxid2'].reset_index().rename({'taxid2': 'edges_cell_type'}, axis=1)
+    aux = pd.merge(pd.merge(aux, counts_tissues, on=['taxid1', 'Tissue'], how='left'), counts_cells, on=['taxid1', 'Tissue', 'Cell type'], how='left')
+    expected = get_icicle_nodes(aux, 'edges_cell_type')
+    nodes = get_icicle_nodes(summaries.get_tissue_cell_type_counts(df), 'edges_cell_type_sum')
+    scores = summaries.get_parasite_scores(df).set_index('taxid1')
+
+    assert(sorted(nodes) == sorted(expected))
+    assert(all(nodes[n][0] == expected[n][0] and np.isclose(nodes[n][1], expected[n][1]) and nodes[n][2] == expected[n][2] for n in nodes))
+    assert(scores['edges'].to_dict() == df.groupby('taxid1')['weight'].count().to_dict())
+    for taxid, weights in df.groupby('taxid1')['weight']:
+        q1, median, q3 = weights.quantile([0.25, 0.5, 0.75])
+        inside = weights[(weights >= q1 - 1.5 * (q3 - q1)) & (weights <= q3 + 1.5 * (q3 - q1))]
+        assert(np.allclose(scores.loc[taxid, ['q1', 'median', 'q3', 'lowerfence', 'upperfence']].astype(float),
+                           [q1, median, q3, inside.min(), inside.max()]))
+        assert(scores.loc[taxid, 'outliers'] == sorted(set(weights[~weights.isin(inside)])))
+
+
+def test_build_parasite_bundles_concurrently(tmp_path):
+    '''Test that concurrent builds of the bundles from the prediction store replace the dataset atomically and leave no temporary directories'''
+    config = utils.read_config('config.yml')
+    tissues = bundles.get_parasite_tissues(config, 5833)
+    df = get_network()
+    df['weight'] = df['weight'].astype(str)
+    df['experimental_evidence_score'] = df['databases_evidence_score'] = df['weight']
+    df['taxid1_label'] = 'Plasmodium falciparum'
+    df['taxid2_label'] = 'Homo sapiens'
+    df['group1'] = 'KOG0001'
+    df['group2'] = 'KOG0002'
+    df['edge_type'] = 'inter-species'
+    prediction_store.build_store(df, str(tmp_path / 'prediction_store'))
+    targets = sorted(set(df['target']))
+    pd.DataFrame({'Gene': targets, 'Tissue': [tissues[i % len(tissues)] if i % 4 else 'other' for i in range(len(targets))],
+                  'Cell type': 'cell'}).to_parquet(str(tmp_path / 'tissues.parquet'), index=False)
+    output_dir = str(tmp_path / 'parasite_bundles')
+    errors = []
+
+    def build():
+        try:
+            bundles.build_parasite_bundles('config.yml', str(tmp_path / 'prediction_store'), str(tmp_path / 'tissues.parquet'), output_dir)
+        except Exception as err:
+            errors.append(err)
+
+    threads = [threading.Thread(target=build) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    bundle = bundles.read_parasite_bundle(output_dir, 5833)
+
+    assert(errors == [])
+    assert(sorted(os.listdir(str(tmp_path))) == ['parasite_bundles', 'prediction_store', 'tissues.parquet'])
+    assert(bundles.get_bundle_taxids(output_dir) == [5833])
+    assert(set(bundle['Tissue']) <= set(tissues) and len(bundle) > 0)
+    assert(bundle['weight'].dtype == np.float64 and bundle['weight'].is_monotonic_decreasing)
+    assert(sorted(bundle['weight']) == sorted(df[df['target'].isin(bundle['target'].astype(str))]['weight'].astype(float)))
+
+
+def test_datastore_loads_each_key_once(tmp_path):
+    '''Test that concurrent sessions load an object once and that loading one object does not block the others'''
+    files = [str(tmp_path / 'slow.txt'), str(tmp_path / 'fast.txt')]
+    for filepath in files:
+        open(filepath, 'w').write(filepath)
+    loads = []
+    slow_loading = threading.Event()
+
+    def slow_loader(path):
+        slow_loading.set()
+        time.sleep(0.5)
+        loads.append(path)
+        return path
+
+    threads = [threading.Thread(target=datastore.get_object, args=(files[0], slow_loader), kwargs={'kind': 'test'}) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    slow_loading.wait()
+    start = time.time()
+    fast = datastore.get_object(files[1], lambda path: path, kind='test')
+    elapsed = time.time() - start
+    for thread in threads:
+        thread.join()
+    datastore.clear()
+
+    assert(fast == files[1] and elapsed < 0.25)
+    assert(loads == [files[0]])
+
+
+def test_datastore_mapped_table(tmp_path):
+    '''Test that the memory-mapped copy of a parquet file is written atomically and replaced when the file changes'''
+    filepath = str(tmp_path / 'links.parquet')
+    pd.DataFrame({'a': [1, 2, 3]}).to_parquet(filepath, index=False)
+    first = datastore.read_mapped_table(filepath).to_pandas()
+    pd.DataFrame({'a': [4, 5]}).to_parquet(filepath, index=False)
+    os.utime(filepath, ns=(time.time_ns() + 10 ** 9, time.time_ns() + 10 ** 9))
+    second = datastore.read_mapped_table(filepath).to_pandas()
+    cached = sorted(os.listdir(str(tmp_path / datastore.CACHE_DIR)))
+
+    assert(first['a'].tolist() == [1, 2, 3] and second['a'].tolist() == [4, 5])
+    assert([f for f in cached if f.endswith('.arrow')] == [os.path.basename(datastore.get_feather_path(filepath, datastore.get_mtime(filepath)))])
+    assert(not any(f.endswith('.tmp') for f in cached))
+
+
+def test_score_slice_and_graph():
+    '''Test that score slices match the weight filter and the graph only has the edges above the score, with widths from their weights'''
+    df = get_network(n=300, parasite_proteins=40, host_proteins=60)
+    index = bundles.get_score_index(df['weight'].values)
+    expected = df[df['weight'] >= 0.7]
+    G = centrality.generate_graph(bundles.slice_by_score(df, 0.7, index), ('test', 0.7))
+
+    for score in [0.4, 0.45, 0.7, 0.7000000000000001, 0.9, 0.95, 0.2]:
+        assert(bundles.slice_by_score(df, score).equals(df[df['weight'] >= score]))
+        assert(bundles.slice_by_score(df, score, index).equals(df[df['weight'] >= score]))
+    assert(set(map(frozenset, G.edges())) == set(map(frozenset, expected[['source', 'target']].values)))
+    assert(set(G.nodes()) == set(expected['source']) | set(expected['target']))
+    assert(all(data['value'] == max(data['weight'] * 0.5 / 0.9, 0.05) for _, _, data in G.edges(data=True)))
+    assert(centrality.generate_graph(bundles.slice_by_score(df, 1.01), ('test', 1.01)).number_of_nodes() == 0)
+
+
+def test_precomputed_centralities(tmp_path):
+    '''Test that the centralities precomputed at each slider step are those of the network shown (the predictions above the score)'''
+    df = get_network(n=300, parasite_proteins=40, host_proteins=60)
+    write_bundle(df, str(tmp_path / 'bundles'), 5833)
+    config_file = str(tmp_path / 'config.yml')
+    with open(config_file, 'w') as out:
+        out.write('web:\n    centrality_exact_max_nodes: 2000\n')
+    centrality.precompute_centralities(config_file, str(tmp_path / 'bundles'), str(tmp_path / 'centralities.parquet'))
+    centralities_df = pd.read_parquet(str(tmp_path / 'centralities.parquet'))
+
+    for score in [0.4, 0.63, 0.9]:
+        df_score = bundles.slice_by_score(df, score)
+        G = nx.from_pandas_edgelist(df_score, 'source', 'target', 'weight')
+        precomputed = centrality.read_precomputed(centralities_df, 5833, len(df_score))
+        assert(precomputed == centrality.compute_centrality(G))
+        assert(dict(centrality.generate_graph(df_score, ('test', score), precomputed=precomputed).nodes(data='size')) ==
+               dict(centrality.generate_graph(df_score, ('test', score, 'live')).nodes(data='size')))
+    # network not precomputed (not a step of the slider or another parasite): computed live
+    assert(centrality.read_precomputed(centralities_df, 5833, len(df) + 1) is None)
+    assert(centrality.read_precomputed(centralities_df, 5759, len(df)) is None)
+
+
+def test_precomputed_enrichment(tmp_path):
+    '''Test that the precomputed enrichment of each slider step matches the live enrichment of the network'''
+    df = get_network()
+    write_bundle(df, str(tmp_path / 'bundles'), 5833)
+    go_dfs = get_go_annotations({5833: sorted(set(df['source'])),
+                                 9606: sorted(set(df['target'])) + ['9606.x{}'.format(i) for i in range(3000)]}, annotations=6)
+    go_df = pd.concat(go_dfs, ignore_index=True)
+    go_store.build_store(go_dfs, str(tmp_path / 'go_annotations'))
+    enrichment_store.build_enrichment_store(str(tmp_path / 'bundles'), str(tmp_path / 'go_annotations'), str(tmp_path / 'enrichment'))
+
+    for score in [0.4, 0.63, 0.9]:
+        expected = utils.calculate_enrichment(bundles.slice_by_score(df, score), go_df=go_df)
+        result = enrichment_store.read_enrichment(str(tmp_path / 'enrichment'), 5833, score)
+        assert(not result.empty)
+        pd.testing.assert_frame_equal(result, expected.reset_index(drop=True))
+    # not a step of the slider or not precomputed: computed live
+    assert(enrichment_store.read_enrichment(str(tmp_path / 'enrichment'), 5833, 0.7000000000000001) is None)
+    assert(enrichment_store.read_enrichment(str(tmp_path / 'enrichment'), 5759, 0.7) is None)
+
+
+def test_build_enrichment_store_concurrently(tmp_path):
+    '''Test that concurrent builds of the enrichment dataset replace it atomically and leave no temporary directories'''
+    df = get_network(n=300, parasite_proteins=40, host_proteins=60)
+    write_bundle(df, str(tmp_path / 'bundles'), 5833)
+    go_dfs = get_go_annotations({5833: sorted(set(df['source'])), 9606: sorted(set(df['target']))}, annotations=6)
+    go_store.build_store(go_dfs, str(tmp_path / 'go_annotations'))
+    output_dir = str(tmp_path / 'enrichment')
+    enrichment_store.build_enrichment_store(str(tmp_path / 'bundles'), str(tmp_path / 'go_annotations'), output_dir, scores=[0.4, 0.7])
+    expected = enrichment_store.read_enrichment(output_dir, 5833, 0.7)
+    errors = []
+    found = []
+
+    def build():
+        try:
+            enrichment_store.build_enrichment_store(str(tmp_path / 'bundles'), str(tmp_path / 'go_annotations'), output_dir, scores=[0.4, 0.7])
+        except Exception as err:
+            errors.append(err)
+
+    def read():
+        # the dataset is never missing while it is rebuilt
+        while any(thread.is_alive() for thread in threads):
+            found.append(os.path.isfile(enrichment_store.get_enrichment_path(output_dir, 5833)))
+
+    threads = [threading.Thread(target=build) for _ in range(3)]
+    reader = threading.Thread(target=read)
+    for thread in threads:
+        thread.start()
+    reader.start()
+    for thread in threads:
+        thread.join()
+    reader.join()
+
+    assert(errors == [] and all(found))
+    assert(sorted(os.listdir(str(tmp_path))) == ['bundles', 'enrichment', 'enrichment.lock', 'go_annotations'])
+    pd.testing.assert_frame_equal(enrichment_store.read_enrichment(output_dir, 5833, 0.7), expected)
+
+
+def test_go_store_round_trip(tmp_path):
+    '''Test that reading some species from the GO annotation store gives their rows of the annotations, and that it is rebuilt in place'''
+    go_dfs = get_go_annotations({taxid: ['{}.p{}'.format(taxid, i) for i in range(n)] for taxid, n in [(9606, 300), (5833, 100), (5759, 80)]},
+                                n_terms=50)
+    go_df = pd.concat(go_dfs, ignore_index=True)
+    go_store.build_store(go_dfs, str(tmp_path / 'go_annotations'))
+
+    assert(go_store.get_store_taxids(str(tmp_path / 'go_annotations')) == [9606, 5833, 5759])
+    for taxids in [(5833, 9606), (5759,), (9606, 5759, 5833), (1,)]:
+        expected = go_df[go_df['taxid'].isin(taxids)].reset_index(drop=True)
+        result = go_store.read_annotations(str(tmp_path / 'go_annotations'), taxids)
+        assert(list(result.columns) == ['#string_protein_id', 'description', 'taxid'])
+        assert(len(result) == len(expected))
+        for col in ['#string_protein_id', 'description']:
+            assert(result[col].astype(str).tolist() == expected[col].tolist())
+        assert(result['taxid'].tolist() == expected['taxid'].tolist())
+    # rebuilt in place: the previous store is replaced and no temporary directory is left
+    go_store.build_store(go_dfs[:2], str(tmp_path / 'go_annotations'))
+    assert(go_store.get_store_taxids(str(tmp_path / 'go_annotations')) == [9606, 5833])
+    assert(os.listdir(str(tmp_path)) == ['go_annotations'])
+
+
+def get_reference_enrichment(pred_df, go_df):
+    '''Enrichment computed term by term with scipy (as calculated before the vectorized engine)'''
+    nodes = pred_df['source'].unique().tolist() + pred_df['target'].unique().tolist()
+    total_nodes = len(nodes)
+    selected_gos = go_df[go_df['#string_protein_id'].isin(nodes)].groupby('description').filter(lambda x: (len(x) > 10) & (len(x) < 500))['description'].unique().tolist()
+    total_prots = len(go_df['#string_protein_id'].unique().tolist())
+    rows = []
+    for term in selected_gos:
+        total_members = len(go_df[go_df['description'] == term])
+        net_members = go_df[(go_df['description'] == term) & (go_df['#string_protein_id'].isin(nodes))]['#string_protein_id']
+        a = len(net_members)
+        odds_ratio, p_value = stats.fisher_exact([[a, total_nodes - a], [total_members - a, total_prots - total_members - total_nodes - a]])
+        rows.append([term, p_value, odds_ratio, ','.join(net_members)])
+    reference = pd.DataFrame(rows, columns=['go_term', 'p_value', 'odds_ratio', 'nodes'])
+    reference['fdr_bh'] = multipletests(reference['p_value'].tolist(), alpha=0.01, method='fdr_bh')[1]
+
+    return reference
+
+
+OBO = """format-version: 1.2
+
+[Term]
+id: GO:0008150
+name: biological_process
+
+[Term]
+id: GO:0009987
+name: cellular process
+is_a: GO:0008150 ! biological_process
+
+[Term]
+id: GO:0006915
+name: apoptotic process
+is_a: GO:0009987 ! cellular process
+relationship: part_of GO:0008219 ! cell death
+
+[Term]
+id: GO:0008219
+name: cell death
+is_a: GO:0009987 ! cellular process
+
+[Term]
+id: GO:0000001
+name: mitochondrion inheritance
+is_obsolete: true
+is_a: GO:0009987
+"""
+
+
+def test_gene_ontology_store_round_trip(tmp_path, monkeypatch):
+    '''Test that the GO annotations parsed by the pipeline are the annotations read back from the GO annotation store'''
+    rows = {9606: [('9606.ENSP01', 'Biological Process (Gene Ontology)', 'GO:0006915', 'apoptotic process'),
+                   ('9606.ENSP01', 'Cellular Component (Gene Ontology)', 'GO:0005886', 'plasma membrane'),
+                   ('9606.ENSP02', 'Biological Process (Gene Ontology)', 'GO:0008219', 'cell death'),
+                   ('9606.ENSP02', 'Biological Process (Gene Ontology)', 'GO:0006915', 'apoptotic process')],
+            5833: [('5833.PF3D7_01', 'Biological Process (Gene Ontology)', 'GO:0009987', 'cellular process')]}
+    files = {'/{}.protein.enrichment.terms.txt.gz'.format(taxid): gzip.compress(('#string_protein_id\tcategory\tterm\tdescription\n' +
+                                                                                ''.join('\t'.join(row) + '\n' for row in taxid_rows)).encode())
+             for taxid, taxid_rows in rows.items()}
+    files['/go-basic.obo'] = OBO.encode()
+    server, url = start_stand_in_server(files)
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('data')
+    with open('config.yml', 'w') as out:
+        out.write('urls:\n    string_go_url: {0}/TAXID.protein.enrichment.terms.txt.gz\n    go_ontology_url: {0}/go-basic.obo\n'
+                  'hosts:\n    9606:\n        label: Homo sapiens\nparasites:\n    5833:\n        label: Plasmodium falciparum\n'.format(url))
+    go.get_gene_ontology('config.yml', output_dir='data')
+    parsed = pd.concat([go.parse_gene_ontology(string_file=url + '/TAXID.protein.enrichment.terms.txt.gz', taxid=taxid) for taxid in [9606, 5833]],
+                       ignore_index=True)
+    server.shutdown()
+    df = go_store.read_annotations(os.path.join('data', 'go_annotations'), [5833, 9606])
+    hierarchy = pd.read_parquet(os.path.join('data', 'go_ontology.parquet'))
+
+    assert(list(df.columns) == list(parsed.columns))
+    assert(df.astype({'#string_protein_id': str, 'description': str}).astype({'taxid': int}).equals(parsed.astype({'taxid': int})))
+    assert(go_store.get_store_taxids(os.path.join('data', 'go_annotations')) == [9606, 5833])
+    assert(sorted(map(tuple, hierarchy[['parent', 'child']].values)) == [('Biological_process', 'Cellular process'), ('Cellular process', 'Apoptotic process'),
+                                                                           ('Cellular process', 'Cell death')])
+
+
+def test_nearest_enriched_ancestors(tmp_path):
+    '''Test that each enriched term is placed under its nearest enriched ancestor (deepest one in a DAG, ties by name)'''
+    ontology = pd.DataFrame([('Biological_process', 'Cellular process'), ('Biological_process', 'Metabolic process'),
+                             ('Cellular process', 'Cell death'), ('Cell death', 'Apoptotic process'), ('Cellular process', 'Apoptotic process'),
+                             ('Metabolic process', 'Lipid metabolic process'), ('Apoptotic process', 'Apoptotic lipid process'),
+                             ('Lipid metabolic process', 'Apoptotic lipid process'), ('Cellular process', 'Cellular metabolic process'),
+                             ('Metabolic process', 'Cellular metabolic process')], columns=['parent', 'child'])
+    ontology_file = os.path.join(str(tmp_path), 'go_ontology.parquet')
+    ontology.to_parquet(ontology_file, index=False)
+    go_hierarchy.get_go_index(ontology_file)
+    index = go_hierarchy.get_go_index(ontology_file)
+    terms = ['Apoptotic lipid process', 'Apoptotic process', 'Cellular process', 'Metabolic process', 'Lipid metabolic process',
+             'Cellular metabolic process', 'Biological_process', 'Unknown term']
+    parents = go_hierarchy.get_nearest_ancestors(index, terms)
+
+    assert(os.path.isfile(os.path.join(str(tmp_path), 'go_ontology_index.npz')))
+    assert(parents == ['Apoptotic process', 'Cellular process', 'Biological_process', 'Biological_process', 'Metabolic process',
+                       'Cellular process', None, None])
+    assert(go_hierarchy.get_nearest_ancestors(index, []) == [])
+
+
+def test_fisher_exact_matches_scipy():
+    '''Test that the vectorized Fisher's exact test gives the odds ratios and p-values of scipy.stats.fisher_exact'''
+    rng = np.random.default_rng(0)
+    tables = rng.integers(0, 30, size=(500, 4))
+    tables = np.vstack([tables, [[0, 0, 5, 3], [4, 0, 0, 7], [12, 5, 0, 0], [0, 9, 0, 2], [1, 1, 1, 1], [40, 2, 3, 900]]])
+    odds_ratio, p_value = enrichment.fisher_exact(tables[:, 0], tables[:, 1], tables[:, 2], tables[:, 3])
+    expected = [stats.fisher_exact([[a, b], [c, d]]) for a, b, c, d in tables]
+
+    assert(np.allclose(p_value, [e[1] for e in expected], rtol=1e-12, atol=0))
+    assert(np.allclose(odds_ratio, [e[0] for e in expected], rtol=1e-12, atol=0, equal_nan=True))
+
+
+def test_enrichment_matches_per_term_test():
+    '''Test that the p-values and the adjusted p-values of the enrichment engine are those of the per-term Fisher's tests'''
+    df = get_network()
+    go_df = pd.concat(get_go_annotations({5833: sorted(set(df['source'])),
+                                          9606: sorted(set(df['target'])) + ['9606.x{}'.format(i) for i in range(3000)]}, annotations=6), ignore_index=True)
+    network = bundles.slice_by_score(df, 0.6)
+    result = utils.calculate_enrichment(network, go_df=go_df).set_index('go_term')
+    reference = get_reference_enrichment(network, go_df).set_index('go_term')
+
+    assert(len(result) > 0 and sorted(result.index) == sorted(reference.index))
+    assert(np.allclose(result['p_value'], reference.loc[result.index, 'p_value'], rtol=1e-12, atol=0))
+    assert(np.allclose(result['fdr_bh'], reference.loc[result.index, 'fdr_bh'], rtol=1e-12, atol=0))
+    assert(np.allclose(result['odds_ratio'], reference.loc[result.index, 'odds_ratio'], rtol=1e-12, atol=0))
+    assert(result['fdr_bh'].is_monotonic_increasing)
+    assert(all(sorted(result.loc[term, 'nodes'].split(',')) == sorted(reference.loc[term, 'nodes'].split(',')) for term in result.index))
+
+
+def test_enrichment_of_network_larger_than_background():
+    '''Test that terms whose contingency table would have negative counts are not tested instead of failing'''
+    df = get_network()
+    nodes = sorted(set(df['source'])) + sorted(set(df['target']))
+    go_df = pd.concat(get_go_annotations({5833: sorted(set(df['source'])), 9606: sorted(set(df['target'])) + ['9606.x{}'.format(i) for i in range(200)]},
+                                         annotations=2), ignore_index=True)
+    # a term annotated to every (annotated) node of the network: its table has a negative count
+    nodes = [n for n in nodes if n in set(go_df['#string_protein_id'])]
+    large_term = pd.DataFrame({'#string_protein_id': nodes, 'description': 'large term', 'taxid': [int(n.split('.')[0]) for n in nodes]})
+    result = utils.calculate_enrichment(df, go_df=pd.concat([go_df, large_term], ignore_index=True)).set_index('go_term')
+    reference = get_reference_enrichment(df, go_df).set_index('go_term')
+    try:
+        get_reference_enrichment(df, pd.concat([go_df, large_term], ignore_index=True))
+        failed = False
+    except ValueError:
+        failed = True
+
+    assert(failed)
+    assert(len(result) > 0 and 'large term' not in result.index)
+    assert(all(result[col].min() >= 0 for col in ['A', 'B', 'C', 'D']))
+    assert(np.allclose(result['p_value'], reference.loc[result.index, 'p_value'], rtol=1e-12, atol=0))
@@ -1,7 +1,14 @@
 import os
+import mmap
+import fcntl
+import shutil
+import contextlib
 import yaml
 import json
-import requests
+import hashlib
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict
 import gzip
 import itertools
 import zipfile
@@ -9,8 +16,13 @@ import obonet
 import networkx as nx
 from Bio import SeqIO
 import pandas as pd
-import scipy.stats as stats
-from statsmodels.stats.multitest import multipletests
+import enrichment
+import downloader
+import instrumentation
+
+# in-memory exports and renderings of graphs. Key -> (graph content hash, output name), value -> output
+_graph_outputs = OrderedDict()
+_graph_outputs_lock = threading.Lock()
 
 def read_fasta(fasta_file_path):
     sequences = []
@@ -19,76 +31,233 @@ def read_fasta(fasta_file_path):
         sequences.append(fasta.id)
     return sequences
 
+@instrumentation.timed()
+def read_fasta_ids(fasta_file_path):
+    """
+    Indexes the sequence identifiers of a FASTA file scanning only the header lines (memory-mapped).
+    Identifiers are parsed as in Biopython: first word after '>'
+
+    :param str fasta_file_path: path to the FASTA file
+    :return: set of sequence identifiers
+    """
+    ids = set()
+    if os.path.getsize(fasta_file_path) == 0:
+        return ids
+    with open(fasta_file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        newline = m.find(b'\n>')
+        start = 1 if m[:1] == b'>' else (newline + 2 if newline != -1 else None)
+        while start is not None:
+            end = m.find(b'\n', start)
+            end = end if end != -1 else len(m)
+            header = m[start:end].split(None, 1)
+            ids.add(header[0].decode('utf-8') if header else '')
+            newline = m.find(b'\n>', end)
+            start = newline + 2 if newline != -1 else None
+
+    return ids
+
 def filter_sequences(sequences, valid_list):
-    filter_out = []
-    for parasite_id in valid_list:
-        if parasite_id not in sequences:
-            filter_out.append(parasite_id)
+    sequences = set(sequences)
+    filter_out = [parasite_id for parasite_id in valid_list if parasite_id not in sequences]
             
     return filter_out
 
 def convert_df(df):
     return df.to_csv(sep='\t', header=True, index=False).encode('utf-8')
 
-def export_graph(G, filename, format='graphml', output_dir='tmp'):
-    file_path = os.path.join(output_dir, filename)
-    if format == "graphml":
-        nx.write_graphml_lxml(G, file_path)
-    elif format == "cytoscape":
-        cytoscape_data= nx.cytoscape_data(G)
-        with open(file_path, 'w') as out:
-            out.write(json.dumps(cytoscape_data))
+def graph_fingerprint(G):
+    """
+    Content hash of a networkx graph (nodes, edges and their attributes)
+    :param graph G: networkx graph
+    :return: hexadecimal digest
+    """
+    content = json.dumps([sorted(G.nodes(data=True), key=lambda n: str(n[0])),
+                          sorted(G.edges(data=True), key=lambda e: (str(e[0]), str(e[1])))],
+                         sort_keys=True, default=str)
+
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
 
-def calculate_enrichment(pred_df, go_df):
+
+def get_graph_output(G, name, generate, max_size=64):
+    """
+    Returns an output generated from a graph (i.e. an export format or the rendered html), cached in memory
+    by the graph content so it is only generated once for all the sessions
+    :param graph G: networkx graph
+    :param str name: name of the output (i.e. graphml)
+    :param callable generate: function generating the output (bytes or str)
+    :param int max_size: maximum number of outputs kept in the cache
+    :return: the generated output
+    """
+    key = (graph_fingerprint(G), name)
+    with _graph_outputs_lock:
+        if key in _graph_outputs:
+            _graph_outputs.move_to_end(key)
+            return _graph_outputs[key]
+
+    output = generate()
+    with _graph_outputs_lock:
+        _graph_outputs[key] = output
+        while len(_graph_outputs) > max_size:
+            _graph_outputs.popitem(last=False)
+
+    return output
+
+
+@instrumentation.timed()
+def export_graph(G, format='graphml'):
+    """
+    Exports a graph into bytes in memory (cached by the graph content)
+    :param graph G: networkx graph
+    :param str format: export format (graphml or cytoscape)
+    :return: bytes with the exported graph
+    """
+    def generate():
+        if format == "graphml":
+            return ("<?xml version='1.0' encoding='utf-8'?>\n" + '\n'.join(nx.generate_graphml(G))).encode('utf-8')
+        elif format == "cytoscape":
+            cytoscape_data = nx.cytoscape_data(G)
+            return json.dumps(cytoscape_data).encode('utf-8')
+        raise ValueError("Export format {} not supported".format(format))
+
+    return get_graph_output(G, format, generate)
+
+@instrumentation.timed()
+def calculate_enrichment(pred_df, go_df=None, term_index=None):
+    """
+    Functional enrichment of the network nodes in the GO terms annotated to them (Fisher's exact test, FDR BH)
+
+    :param DataFrame pred_df: network edges (requires source and target columns)
+    :param DataFrame go_df: GO annotations for the species in the network (only needed when term_index is None)
+    :param dict term_index: precomputed index (enrichment.build_term_index) for the species in the network
+    :return: dataframe with columns go_term, A, B, C, D, p_value, odds_ratio, nodes, fdr_bh
+    """
     nodes = pred_df['source'].unique().tolist() + pred_df['target'].unique().tolist()
-    total_nodes = len(nodes)
-    selected_gos = go_df[go_df['#string_protein_id'].isin(nodes)].groupby('description').filter(lambda x: (len(x)> 10) & (len(x) < 500))['description'].unique().tolist()
-    total_prots = len(go_df['#string_protein_id'].unique().tolist())
-    enrichment = []
-    for term in selected_gos:   
-        members = go_df[(go_df['description'] == term)]['#string_protein_id']
-        #E
-        total_members = len(members)
-        net_members = go_df[(go_df['description'] == term) & (go_df['#string_protein_id'].isin(nodes))]['#string_protein_id']
-        #A
-        total_net_members = len(net_members)
-        
-        odd_ratio, p_value = stats.fisher_exact([[total_net_members, total_nodes - total_net_members],
-                                                [total_members - total_net_members, total_prots - total_members - total_nodes - total_net_members]])
-        enrichment.append([term, total_net_members, total_nodes - total_net_members, total_members - total_net_members,  total_prots - total_members - total_nodes - total_net_members, p_value, odd_ratio, ','.join(net_members)])
-    
-    enrichment = pd.DataFrame(enrichment, columns=['go_term', 'A', 'B', 'C', 'D', 'p_value', 'odds_ratio', 'nodes'])
-    if not enrichment.empty:
-        enrichment['fdr_bh'] = multipletests(enrichment['p_value'].tolist(), alpha=0.01, method='fdr_bh')[1]
-        enrichment = enrichment.sort_values(by='fdr_bh', ascending=True)
-    
-    return enrichment
+    if term_index is None:
+        term_index = enrichment.build_term_index(go_df)
+
+    return enrichment.calculate_enrichment(nodes, term_index)
 
 
 def save_to_parquet(df, output_file):
     df.to_parquet(output_file, compression='gzip', index=False)
 
 
+@instrumentation.timed()
 def read_parquet_file(input_file):
     df = pd.read_parquet(input_file)
 
     return df
 
 
-def annotate_alias_id(predictions_df, taxids, config_file, sources, new_col, mapping_col):
+@contextlib.contextmanager
+def file_lock(path):
+    """
+    Holds an exclusive lock on a lock file (path + '.lock'), shared by the threads and processes
+    that build the same dataset, i.e. the sessions of the web app
+    :param str path: path to the dataset being built
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path.rstrip(os.sep) + '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def get_tmp_path(path):
+    """
+    Temporary path where a file or directory is written before it is moved into place
+    (unique per process and thread, so concurrent writers never share it)
+    :param str path: final path
+    :return: temporary path
+    """
+    return '{}.{}.{}.tmp'.format(path.rstrip(os.sep), os.getpid(), threading.get_ident())
+
+
+def replace_dir(tmp_dir, output_dir):
+    """
+    Moves a directory written to a temporary path into place. The previous version is renamed
+    away before (a directory cannot replace a non-empty one) and removed after, so readers
+    never see a partially written or partially removed directory.
+    :param str tmp_dir: path to the complete directory
+    :param str output_dir: final path
+    """
+    old_dir = None
+    if os.path.isdir(output_dir):
+        old_dir = get_tmp_path(output_dir) + '.old'
+        os.replace(output_dir, old_dir)
+    os.replace(tmp_dir, output_dir)
+    if old_dir is not None:
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def get_workers(config_file):
+    """
+    Number of processes used to parse the files of each species (pipeline section of the configuration)
+    :param str config_file: path to the configuration file
+    :return: number of processes
+    """
+    pipeline = read_config(filepath=config_file, field='pipeline') or {}
+
+    return pipeline.get('workers') or os.cpu_count() or 1
+
+
+def run_species(function, taxid, kwargs):
+    """
+    Runs a function for one species inside a span (utils.map_taxids, with the function and taxid as fields).
+    In the worker processes the span is written to the structured log of the worker.
+    :param callable function: module-level function receiving the taxid (keyword) and kwargs
+    :param taxid: taxonomic identifier of the species
+    :param dict kwargs: other arguments of the function
+    :return: result of the function
+    """
+    with instrumentation.span('utils.map_taxids', function=function.__name__, taxid=taxid) as record:
+        result = function(taxid=taxid, **kwargs)
+        if record['rows'] is None:
+            record['rows'] = instrumentation.get_size(result)
+
+    return result
+
+
+def map_taxids(function, taxids, workers=1, **kwargs):
+    """
+    Runs a function for each species, in a pool of processes when more than one worker is used.
+    The results are returned in the order of the taxids (not in the order they finish), so merging
+    them is deterministic, and the time spent in each species is recorded in a span (see run_species).
+
+    :param callable function: module-level function receiving the taxid (keyword) and kwargs
+    :param list taxids: taxonomic identifiers of the species
+    :param int workers: number of processes (1 runs the species one after the other)
+    :return: list with the result for each taxid
+    """
+    taxids = list(taxids)
+    if workers <= 1 or len(taxids) <= 1:
+        results = [run_species(function, taxid, kwargs) for taxid in taxids]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(taxids))) as executor:
+            results = list(executor.map(run_species, [function] * len(taxids), taxids, [kwargs] * len(taxids)))
+
+    return results
+
+
+@instrumentation.timed()
+def annotate_alias_id(predictions_df, taxids, config_file, sources, new_col, mapping_col, workers=None):
     '''
     Adds an extra column to the provided dataframe with the String alias selected (e.g., UniProt id)
 
     :param DataFrame predictions_df: predictions dataframe to be annotated (requires mapping_col in columns)
     :param str config_file: path to config file (used to get the aliases for each species)
     :param list sources: what source ids need to be annotated
+    :param int workers: number of species parsed at the same time (default: pipeline section of the config)
 
     :return DataFrame predictions_df: annotated dataframe with the String aliases of interest
     '''
-    aliases = {}
-    for taxid in taxids:
-        aliases.update(parse_string_aliases(config_file=config_file, 
-                    sources=sources, taxid=str(taxid), reverse=True))
+    if workers is None:
+        workers = get_workers(config_file)
+    aliases = pd.concat(map_taxids(read_string_aliases, [str(taxid) for taxid in taxids], workers=workers,
+                                   config_file=config_file, sources=sources))
+    aliases = get_alias_mapping(aliases, reverse=True)
     
     predictions_df[new_col] = predictions_df[mapping_col].map(aliases)
     #predictions_df['target_uniprot'] = predictions_df['target'].map(aliases)
@@ -96,6 +265,57 @@ def annotate_alias_id(predictions_df, taxids, config_file, sources, new_col, map
     return predictions_df
 
 
+@instrumentation.timed()
+def read_string_aliases(config_file, sources, taxid='9606', cache_dir=os.path.join('data', 'aliases'), chunksize=1000000):
+    '''
+    Reads the alias file from String database keeping only the sources of interest. The file is read in chunks,
+    only with the needed columns, and the result is cached as parquet (per taxid and sources)
+    :param str config_file: path to the config file where the url to the String alias file should be defined
+    :param list sources: list of sources that should be considered in the mapping (i.e. Ensembl_gene)
+    :param str taxid: taxonomic identifier of the species for which to parse the aliases file
+    :param str cache_dir: path to the directory where the parsed aliases are cached
+    :param int chunksize: number of lines read at once
+    :return: dataframe with columns #string_protein_id, alias, source (in file order)
+    '''
+    urls = read_config(filepath=config_file, field='urls')
+    if 'string_alias_url' in urls:
+        filename = download_file(url=urls['string_alias_url'].replace('TAXID', taxid), data_dir='data')
+
+    sources_key = 'all' if sources is None else hashlib.sha1('|'.join(sorted(sources)).encode('utf-8')).hexdigest()[:12]
+    cache_file = os.path.join(cache_dir, '{}.{}.parquet'.format(os.path.basename(filename).split('.txt')[0], sources_key))
+    if os.path.isfile(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(filename):
+        return pd.read_parquet(cache_file)
+
+    data = []
+    reader = pd.read_csv(filename, sep='\t', header=0, usecols=['#string_protein_id', 'alias', 'source'],
+                         dtype={'#string_protein_id': str, 'alias': str, 'source': 'category'}, chunksize=chunksize)
+    for chunk in reader:
+        if sources is not None:
+            chunk = chunk[chunk['source'].isin(sources)]
+        data.append(chunk)
+    data = pd.concat(data, ignore_index=True) if data else pd.DataFrame(columns=['#string_protein_id', 'alias', 'source'])
+    data['source'] = data['source'].astype(str).astype('category')
+
+    os.makedirs(cache_dir, exist_ok=True)
+    save_to_parquet(data, cache_file)
+
+    return data
+
+
+def get_alias_mapping(aliases, reverse=False):
+    '''
+    Builds the mapping between String identifiers and aliases. When a key appears more than once
+    the last one in the file is kept
+    :param DataFrame aliases: dataframe with columns #string_protein_id and alias (see read_string_aliases)
+    :param bool reverse: whether to map alias --> string_id (False), or string_id --> alias (True)
+    :return: pandas Series with the mapping (can be used with Series.map)
+    '''
+    key, value = ('#string_protein_id', 'alias') if reverse else ('alias', '#string_protein_id')
+    aliases = aliases.drop_duplicates(subset=key, keep='last')
+
+    return pd.Series(aliases[value].values, index=aliases[key].values)
+
+
 def parse_string_aliases(config_file, sources, taxid='9606', reverse=False):
     '''
     Parses the alias file from String database and generates a dictionary
@@ -107,24 +327,9 @@ def parse_string_aliases(config_file, sources, taxid='9606', reverse=False):
     :return: dictionary with key --> alias, values --> string_id (reverse=False),
                 or key --> string_id, values --> alias
     '''
-    data_dict = {}
-    urls = read_config(filepath=config_file, field='urls')
-        
-    if 'string_alias_url' in urls:
-        filename = download_file(url=urls['string_alias_url'].replace('TAXID', taxid), data_dir='data')
-    
-    data = pd.read_csv(filename, sep='\t', header=0)
-    if sources is not None:
-        data = data[data['source'].isin(sources)]
-    
-
-    for i, row in data[['#string_protein_id', 'alias']].iterrows():
-        if not reverse:
-            data_dict[row['alias']] = row['#string_protein_id']
-        else:
-            data_dict[row['#string_protein_id']] = row['alias']
+    data = read_string_aliases(config_file=config_file, sources=sources, taxid=taxid)
          
-    return data_dict
+    return get_alias_mapping(data, reverse=reverse).to_dict()
 
 
 def read_yaml(yaml_file):
@@ -160,18 +365,12 @@ def read_config(filepath, field=None):
 
 def download_file(url, data_dir='data'):
     """
-    Download file from an url into an existing directory
+    Download file from an url into an existing directory (see downloader.download)
     :param str url: URL address where to download the data from
     :param str data_dir: path to directory where to download the data
     :return: filepath to the downloaded data
     """
-    header = {'user-agent':'Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/51.0.2704.103 Safari/537.36'}
-    filename = url.split('/')[-1]
-    filename = os.path.join(data_dir, filename)
-    if not os.path.isfile(filename):
-        r = requests.get(url, headers=header)
-        with open(filename, 'wb') as out:
-            out.write(r.content)
+    filename = downloader.download(url, data_dir=data_dir)
             
     return filename
 
@@ -1,5 +1,22 @@
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import streamlit as st
 from streamlit_option_menu import option_menu
+import bundles
+import datastore
+import go_store
+import instrumentation
+import prediction_store
+import summaries
+import utils
+
+BUNDLE_DIR = 'data/parasite_bundles'
+STORE_DIR = 'data/prediction_store'
+SUMMARY_DIR = 'data/home_summaries'
+GO_STORE_DIR = 'data/go_annotations'
+TISSUES_FILE = 'data/tissues_cell_types.parquet'
 
 def show_pages_menu(index=0):
     selected = option_menu(
@@ -15,12 +32,104 @@ def show_pages_menu(index=0):
 
 def filter_tissues(config, df):
     source = df['taxid1'].unique()[0]
-    mapped_tissues = config['tissues']
-    tissues = [mapped_tissues[t].lower() for t in config['parasites'][int(source)]['tissues']]
+    tissues = bundles.get_parasite_tissues(config, source)
     df = df[df['Tissue'].isin(tissues)]
     
     return df
 
+def get_predictions_file(predictions_file='data/annotated_predictions.parquet'):
+    """
+    Predictions file the prediction store is built from: the annotated predictions (with the UniProt accessions
+    of the proteins) or, if they are not available, the predictions
+    :param str predictions_file: path to the annotated predictions file
+    :return: path to the predictions file
+    """
+    try:
+        annotated = 'source_uniprot' in pq.read_schema(predictions_file).names
+    except (OSError, pa.ArrowInvalid):
+        # missing or not a parquet file (i.e. a git-lfs pointer that was not pulled)
+        annotated = False
+
+    return predictions_file if annotated else 'data/predictions.parquet'
+
+
+def is_stale(files, sources):
+    """
+    Checks whether a derived dataset is missing or older than any of the files it is built from
+    :param list files: files of the derived dataset
+    :param list sources: files it is built from (missing ones are ignored)
+    :return: bool
+    """
+    if len(files) == 0 or not all(os.path.isfile(f) for f in files):
+        return True
+    sources = [f for f in sources if os.path.isfile(f)]
+
+    return len(sources) > 0 and min(datastore.get_mtime(f) for f in files) < max(datastore.get_mtime(f) for f in sources)
+
+
+def ensure_parasite_bundles(config_file='config.yml', bundle_dir=BUNDLE_DIR, store_dir=STORE_DIR, tissues_file=TISSUES_FILE):
+    """
+    Builds the per-parasite bundles (normally generated by main.py) from the prediction store if they are not
+    available yet or older than the files they are built from. The build runs under a file lock, so only one
+    session (or process) builds them, and the dataset is moved into place once complete.
+    :param str config_file: path to the configuration file
+    :param str bundle_dir: path to the bundles dataset
+    :param str store_dir: path to the prediction store
+    :param str tissues_file: path to the tissues and cell types annotation file
+    """
+    ensure_prediction_store(store_dir=store_dir)
+    sources = [prediction_store.get_store_files(store_dir)['links'], tissues_file]
+
+    def get_files():
+        return [bundles.get_bundle_path(bundle_dir, taxid) for taxid in bundles.get_bundle_taxids(bundle_dir)]
+
+    if is_stale(get_files(), sources):
+        with utils.file_lock(bundle_dir):
+            # another session may have built them while waiting for the lock
+            if is_stale(get_files(), sources):
+                bundles.build_parasite_bundles(config_file, store_dir=store_dir, tissues_file=tissues_file, output_dir=bundle_dir)
+
+
+def get_parasite_options(config, bundle_dir=BUNDLE_DIR):
+    """
+    Parasites available in the bundles dataset
+    :param dict config: content of the configuration file
+    :param str bundle_dir: path to the bundles dataset
+    :return: dictionary sorted by label. Key -> parasite label, value -> taxid
+    """
+    ensure_parasite_bundles(bundle_dir=bundle_dir)
+    options = {config['parasites'][taxid]['label']: taxid for taxid in bundles.get_bundle_taxids(bundle_dir)
+               if taxid in config['parasites']}
+
+    return dict(sorted(options.items()))
+
+
+def load_parasite_bundle(taxid, bundle_dir=BUNDLE_DIR):
+    """
+    Predictions of a parasite joined with the tissue and cell type annotation (already filtered
+    to the parasite tissues and sorted by weight). Shared by all sessions: do not modify in place.
+    :param int taxid: taxonomic identifier of the parasite
+    :param str bundle_dir: path to the bundles dataset
+    :return: dataframe
+    """
+    ensure_parasite_bundles(bundle_dir=bundle_dir)
+
+    return datastore.get_frame(bundles.get_bundle_path(bundle_dir, taxid))
+
+
+def load_score_index(taxid, bundle_dir=BUNDLE_DIR):
+    """
+    Offset index of the slider score thresholds in the bundle of a parasite (see bundles.get_score_index),
+    computed once per process
+    :param int taxid: taxonomic identifier of the parasite
+    :param str bundle_dir: path to the bundles dataset
+    :return: dictionary. Key -> score, value -> number of predictions with a weight above or equal to the score
+    """
+    return datastore.get_object(bundles.get_bundle_path(bundle_dir, taxid),
+                                lambda path: bundles.get_score_index(load_parasite_bundle(taxid, bundle_dir=bundle_dir)['weight'].values),
+                                kind='score_index')
+
+
 def footer():
     st.write("Developed with data from:")
 
@@ -38,4 +147,89 @@ def footer():
     with cols[5]:
         st.image('images/ebi.png', width=200)
 
-    st.write("Code available at: https://github.com/Multiomics-Analytics-Group/OrthoHPI2.0")
\ No newline at end of file
+    st.write("Code available at: https://github.com/Multiomics-Analytics-Group/OrthoHPI2.0")
+
+def ensure_prediction_store(store_dir=STORE_DIR, predictions_file=None):
+    """
+    Builds the prediction store (normally generated by main.py) if it is not available or older than the predictions file.
+    The build runs under a file lock, so only one session (or process) builds it, and the store is moved into place once complete.
+    :param str store_dir: path to the prediction store
+    :param str predictions_file: path to the predictions file in wide format (default: see get_predictions_file)
+    """
+    if predictions_file is None:
+        predictions_file = get_predictions_file()
+    files = [prediction_store.get_store_files(store_dir)['links']]
+    if is_stale(files, [predictions_file]):
+        with utils.file_lock(store_dir):
+            # another session may have built it while waiting for the lock
+            if is_stale(files, [predictions_file]):
+                prediction_store.build_store(pd.read_parquet(predictions_file), store_dir)
+
+
+def load_go_annotations(taxids, store_dir=GO_STORE_DIR):
+    """
+    GO annotations of some species, read only from their partitions of the GO annotation store
+    (generated by the gene_ontology stage of main.py)
+    :param list taxids: taxonomic identifiers of the species
+    :param str store_dir: path to the GO annotation store
+    :return: dataframe with columns #string_protein_id, description and taxid (categorical strings)
+    """
+    return go_store.read_annotations(store_dir, taxids)
+
+
+def ensure_home_summaries(summary_dir=SUMMARY_DIR, store_dir=STORE_DIR, bundle_dir=BUNDLE_DIR):
+    """
+    Builds the Home page summaries (normally generated by main.py) if they are not available or
+    older than the prediction store or the bundles. The build runs under a file lock, so only one
+    session (or process) builds them, and they are moved into place once complete.
+    :param str summary_dir: path to the summaries directory
+    :param str store_dir: path to the prediction store
+    :param str bundle_dir: path to the bundles dataset
+    """
+    ensure_parasite_bundles(bundle_dir=bundle_dir, store_dir=store_dir)
+    sources = [prediction_store.get_store_files(store_dir)['links']] + [bundles.get_bundle_path(bundle_dir, taxid)
+                                                                        for taxid in bundles.get_bundle_taxids(bundle_dir)]
+    files = [summaries.get_summary_path(summary_dir, name) for name in summaries.SUMMARY_FILES]
+    if is_stale(files, sources):
+        with utils.file_lock(summary_dir):
+            # another session may have built them while waiting for the lock
+            if is_stale(files, sources):
+                summaries.build_home_summaries(prediction_store.read_predictions(store_dir, columns=['taxid1', 'taxid1_label', 'target', 'weight']),
+                                               pd.concat([bundles.read_parasite_bundle(bundle_dir, taxid) for taxid in bundles.get_bundle_taxids(bundle_dir)]),
+                                               summary_dir)
+
+
+def load_home_summaries(summary_dir=SUMMARY_DIR):
+    """
+    Aggregates shown in the Home page (see summaries.build_home_summaries), read once per process.
+    Shared by all sessions: do not modify in place.
+    :param str summary_dir: path to the summaries directory
+    :return: dictionary. Key -> summary name, value -> dataframe
+    """
+    ensure_home_summaries(summary_dir=summary_dir)
+
+    return {name: datastore.get_frame(summaries.get_summary_path(summary_dir, name)) for name in summaries.SUMMARY_FILES}
+
+
+def show_diagnostics(param='diagnostics'):
+    """
+    Finishes the instrumentation of the page rerun and, only when the page is opened with ?diagnostics=1,
+    shows a panel with the time, rows, bytes read and memory of each instrumented block of the rerun
+    (in call order, nested blocks indented) and the memory used by the cached datasets
+    :param str param: query parameter that shows the panel
+    """
+    rerun = instrumentation.end_rerun()
+    if st.query_params.get(param) not in ('1', 'true'):
+        return
+
+    columns = ['start', 'name', 'seconds', 'rows', 'bytes_read', 'rss_delta', 'peak_rss', 'status']
+    spans = pd.DataFrame(rerun['spans'], columns=columns + ['depth']).sort_values(by='start', kind='stable')
+    spans['name'] = ['  ' * int(depth) + name for name, depth in zip(spans['name'], spans['depth'])]
+    for col in ['bytes_read', 'rss_delta', 'peak_rss']:
+        spans[col] = (spans[col] / 1024 ** 2).round(2)
+    spans = spans[columns].rename(columns={'bytes_read': 'read (MB)', 'rss_delta': 'RSS delta (MB)', 'peak_rss': 'peak RSS (MB)'})
+    with st.expander("Diagnostics -- {} rerun in {:.3f} s".format(rerun['page'], rerun['seconds'] or 0.0), expanded=True):
+        st.dataframe(spans, hide_index=True, use_container_width=True)
+        if rerun['profile'] is not None:
+            st.text("Profile: {}".format(rerun['profile']))
+        st.dataframe(pd.DataFrame(datastore.memory_usage()), hide_index=True, use_container_width=True)